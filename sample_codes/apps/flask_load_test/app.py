@@ -1,53 +1,150 @@
 from flask import Flask, request, jsonify, Response
-import time, json, hashlib, secrets, mmap
-import socket, urllib.request, urllib.error
+import time, json, hashlib, secrets, mmap, os, asyncio, threading, multiprocessing
+import socket, urllib.request, urllib.error, tempfile, glob, fcntl
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, InvalidStateError, wait
+from urllib.parse import parse_qsl
+from collections import OrderedDict, deque
+
+try:
+    import orjson  # 任意: serializer=orjson で使う高速エンコーダ
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
-# --- IMDSv2でprivate DNS/IPを取得（失敗時はソケットでフォールバック） ---
-_IMDS_BASE = "http://169.254.169.254/latest"
-_cached_meta = {}
-
-def _get_imds_token(timeout=0.2):
-    req = urllib.request.Request(
-        f"{_IMDS_BASE}/api/token",
-        method="PUT",
-        headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"},
-    )
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return resp.read().decode("utf-8")
-
-def _get_imds(path, token, timeout=0.2):
-    req = urllib.request.Request(
-        f"{_IMDS_BASE}/meta-data/{path}",
-        headers={"X-aws-ec2-metadata-token": token},
-    )
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return resp.read().decode("utf-8")
+# --- 実行モード: sync=Flask(WSGI) / async=ASGI（gunicorn.service の GUNICORN_OPTS と合わせて切り替え） ---
+APP_MODE = os.getenv("APP_MODE", "sync").lower()
+# --- pbkdf2 の実行エンジン: inline=リクエスト処理中にそのまま実行 / thread / process=プールへ逃がす ---
+#   既定は thread（hashlib は計算中に GIL を解放するので、sync ワーカーでもプールのスレッド数まで並列化できる）。
+#   inline では下の待ち行列・締め切り・リクエストごとの並列上限はどれも効かない（比較用に残している）。
+CPU_ENGINE  = os.getenv("CPU_ENGINE", "thread").lower()
+# gunicorn のワーカー数。gunicorn 自身も WEB_CONCURRENCY を -w の既定に使うので、gunicorn.service ではこちらで指定する
+GUNICORN_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# ワーカーごとのプールの並列数。既定はコア数をワーカー数で割った値（全ワーカーのプールを合わせてコア数になる）
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(max(1, (os.cpu_count() or 1) // GUNICORN_WORKERS))))
+CPU_PER_REQUEST = int(os.getenv("CPU_PER_REQUEST", str(max(1, CPU_WORKERS // 2))))  # 1リクエストが同時にプールへ入れるラウンド数
+CPU_QUEUE   = int(os.getenv("CPU_QUEUE", "64"))           # 実行中以外に待たせてよいタスク数（1ラウンド=1タスク）
+CPU_DEADLINE_MS = int(os.getenv("CPU_DEADLINE_MS", "10000"))  # 既定のリクエスト締め切り（?deadline_ms= で上書き）
+CPU_RETRY_AFTER = os.getenv("CPU_RETRY_AFTER", "1")       # 503 で返す Retry-After（秒）
 
-def get_private_identity():
-    """(private_dns, private_ip) を返す。最初の呼び出し時だけIMDSに当ててキャッシュ。"""
-    global _cached_meta
-    if _cached_meta:
-        return _cached_meta["dns"], _cached_meta["ip"]
+# --- /io で読むファイル（cloud-init の dd で作成） ---
+BLOB_PATH  = os.getenv("BLOB_PATH", "/opt/app/blob.bin")
+IO_CHUNK   = 65536
 
-    # まずIMDSv2
-    try:
-        token = _get_imds_token()
-        priv_ip  = _get_imds("local-ipv4", token)
-        priv_dns = _get_imds("local-hostname", token)
-        _cached_meta = {"dns": priv_dns, "ip": priv_ip}
-        return priv_dns, priv_ip
-    except Exception:
-        # フォールバック: ソケット解決（DNSはホスト名、IPはプライベートIP）
+# --- /json, /mix のエンコード済みペイロードキャッシュ（?cache=1 で使用）の上限 ---
+PAYLOAD_CACHE_MB = int(os.getenv("PAYLOAD_CACHE_MB", "64"))
+
+# --- /mem の確保方法: fresh=毎回 bytearray / arena=予約済み mmap から MEM_ARENA_MB の予算内で貸し出す ---
+MEM_ALLOC       = os.getenv("MEM_ALLOC", "fresh").lower()
+MEM_MAX_MB      = 1024  # ?mb= の上限
+MEM_ARENA_MB    = int(os.getenv("MEM_ARENA_MB", "512"))  # 全ワーカー合計の予算（arena では ?mb= の上限もこれに揃える）
+MEM_WAIT_MS     = int(os.getenv("MEM_WAIT_MS", "1000"))  # 予算に空きが出るまで待つ最大時間
+MEM_RETRY_AFTER = os.getenv("MEM_RETRY_AFTER", "1")
+
+# --- /metrics: ワーカーごとの集計ファイルを置くディレクトリ（gunicorn の全ワーカーで共有） ---
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "flask_load_test_metrics"))
+
+# --- EMF（CloudWatch Embedded Metric Format）出力先: 空=無効 / file:/path / tcp://host:port / udp://host:port ---
+EMF_SINK      = os.getenv("EMF_SINK", "")
+EMF_NAMESPACE = os.getenv("EMF_NAMESPACE", "FlaskLoadTest")
+EMF_LOG_GROUP = os.getenv("EMF_LOG_GROUP", "/flask_load_test/emf")
+EMF_FLUSH_S   = float(os.getenv("EMF_FLUSH_S", "10"))
+EMF_BUFFER    = int(os.getenv("EMF_BUFFER", "100000"))  # リングバッファの長さ（溢れたら古いものから捨てる）
+
+# --- アドミッション制御（ADMIT_CAPACITY=0 で無効）。容量は全ワーカー合計のコスト、待ち行列はワーカーごと ---
+ADMIT_CAPACITY    = int(os.getenv("ADMIT_CAPACITY", "0"))
+ADMIT_MAX_WAIT_MS = int(os.getenv("ADMIT_MAX_WAIT_MS", "100"))  # 空きを待てる最大時間
+ADMIT_QUEUE       = int(os.getenv("ADMIT_QUEUE", "64"))         # 空き待ちできるリクエスト数
+ADMIT_COSTS       = os.getenv("ADMIT_COSTS", "/cpu:4,/mem:4,/mix:3,/json:2,/io:2")  # 未指定は 1
+ADMIT_RETRY_AFTER = os.getenv("ADMIT_RETRY_AFTER", "1")
+ADMIT_POLL_MS     = int(os.getenv("ADMIT_POLL_MS", "5"))        # 他のワーカーの空きを見に行く間隔
+
+# --- IMDSv2 のインスタンス情報: 起動時にバックグラウンドで取得し、リクエスト処理中は IMDS に当てない ---
+#   IMDS_BASE をローカルのスタブ（imds_stub.py）に向ければ EC2 の外でも試せる
+IMDS_BASE      = os.getenv("IMDS_BASE", "http://169.254.169.254/latest")
+IMDS_TOKEN_TTL = int(os.getenv("IMDS_TOKEN_TTL", "21600"))      # トークンの TTL（秒）。期限の 9 割まで使い回す
+IMDS_REFRESH_S = float(os.getenv("IMDS_REFRESH_S", "300"))      # 取得できた後の再取得間隔
+IMDS_RETRY_S   = float(os.getenv("IMDS_RETRY_S", "60"))         # 失敗後の再試行間隔（その間は失敗をキャッシュ）
+
+class ImdsIdentity:
+    """IMDSv2 の値とトークンをキャッシュし、バックグラウンドスレッドで定期的に取り直す"""
+    PATHS = ("local-hostname", "local-ipv4", "instance-id",
+             "tags/instance/aws:autoscaling:groupName")  # タグは instance_metadata_tags = "enabled" のときだけ
+
+    def __init__(self, base, token_ttl, refresh_s, retry_s, timeout=0.2):
+        self.base, self.token_ttl, self.timeout = base, token_ttl, timeout
+        self.refresh_s, self.retry_s = refresh_s, retry_s
+        self._values = {}
+        self._token, self._token_exp = None, 0.0
+        self._lock, self._thread = threading.Lock(), None
+        os.register_at_fork(after_in_child=self._restart)  # --preload 時は取得済みの値を引き継いでスレッドだけ作り直す
+
+    def _restart(self):
+        self._lock, self._thread = threading.Lock(), None
+        self.start()
+
+    def _request(self, method, path, headers):
+        req = urllib.request.Request(f"{self.base}/{path}", method=method, headers=headers)
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return resp.read().decode("utf-8")
+
+    def _get_token(self):
+        if self._token is None or time.monotonic() >= self._token_exp:
+            self._token = self._request("PUT", "api/token",
+                                        {"X-aws-ec2-metadata-token-ttl-seconds": str(self.token_ttl)})
+            self._token_exp = time.monotonic() + self.token_ttl * 0.9
+        return self._token
+
+    def _fetch(self, path):
+        """1項目を取る。404 だけ None（この項目が無い）、それ以外のエラーは送出して refresh() に失敗を伝える"""
+        for attempt in range(2):
+            token = self._get_token()  # トークン取得の失敗はそのまま送出
+            try:
+                return self._request("GET", f"meta-data/{path}", {"X-aws-ec2-metadata-token": token})
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None  # タグ非公開など、この項目だけ無し
+                if e.code != 401 or attempt:
+                    raise  # 5xx や 403 など: 取得済みの値を残して retry_s 後に取り直す
+                self._token = None  # トークン失効: 取り直して再試行
+
+    def refresh(self):
+        """全項目を取り直す。IMDS に届かなければ False（取得済みの値は残す）"""
         try:
-            hn = socket.gethostname()
-            ip = socket.gethostbyname(hn)
-            _cached_meta = {"dns": hn, "ip": ip}
-            return hn, ip
+            self._values = {path: self._fetch(path) for path in self.PATHS}
+            return True
         except Exception:
-            # 最後の最後の保険
-            return "unknown.local", "127.0.0.1"
+            if not self._values:
+                # フォールバック: ソケット解決（DNSはホスト名、IPはプライベートIP）
+                try:
+                    hn = socket.gethostname()
+                    self._values = {"local-hostname": hn, "local-ipv4": socket.gethostbyname(hn)}
+                except Exception:
+                    pass
+            return False
+
+    def _loop(self):
+        while True:
+            time.sleep(self.refresh_s if self.refresh() else self.retry_s)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="imds", daemon=True)
+                self._thread.start()
+
+    def get(self, path, default=None):
+        """キャッシュから返すだけでブロックしない。未取得なら default"""
+        if self._thread is None:
+            self.start()
+        return self._values.get(path) or default
+
+imds = ImdsIdentity(IMDS_BASE, IMDS_TOKEN_TTL, IMDS_REFRESH_S, IMDS_RETRY_S)
+imds.start()  # ワーカー起動時（--preload ならマスターで）に取得を始める
+
+def get_private_identity():
+    """(private_dns, private_ip) を返す。"""
+    return imds.get("local-hostname", "unknown.local"), imds.get("local-ipv4", "127.0.0.1")
 
 def to_int(q, name, default, lo=None, hi=None):
     try:
@@ -68,53 +165,436 @@ def root():
 def health():
     return "ok", 200, {"Content-Type": "text/plain"}
 
+# --- CPU エンジン: 1ラウンド=1タスクでプールへ。溢れたら 503、締め切り超過は未着手分を取り消して 504 ---
+#   1リクエストがプールに入れるのは per_request ラウンドまで。1つ終わるごとに次を入れるので、
+#   後から来たリクエストのラウンドも FIFO の間に挟まり、ラウンド数の多い1件が全コアを占有しない
+class CpuRejected(Exception):
+    """CPU エンジンがリクエストを受け付けなかった/締め切りに間に合わなかった"""
+    def __init__(self, reason, status):
+        super().__init__(reason)
+        self.status = status
+
+class CpuEngine:
+    def __init__(self, kind, workers, queue, per_request):
+        self.kind = kind
+        self.workers = workers
+        self.capacity = workers + queue
+        self.per_request = max(1, per_request)
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        # gunicorn の fork 後に各ワーカー内で作る（fork 前のプールは子に引き継げない）
+        if self._pool is None or self._pid != os.getpid():
+            if self.kind == "process":
+                ctx = multiprocessing.get_context("forkserver")
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu")
+            self._pid = os.getpid()
+        return self._pool
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    def _release(self, _fut=None):
+        with self._lock:
+            self._inflight -= 1
+
+    def _submit(self, tasks):
+        """ラウンドごとの Future を返す。プールへは per_request 個ずつ順に投入する"""
+        with self._lock:
+            if self._inflight + len(tasks) > self.capacity:
+                raise CpuRejected("cpu queue full", 503)
+            self._inflight += len(tasks)  # 待ち行列の上限は未投入のラウンドも含めて数える
+        pool = self._executor()
+        outs = [Future() for _ in tasks]
+        waiting = deque(zip(tasks, outs))
+        waiting_lock = threading.Lock()
+
+        def settle(out, fut=None, exc=None):
+            try:
+                if out.done():
+                    return
+                if fut is not None and fut.cancelled():
+                    out.cancel()
+                elif (exc := exc or fut.exception()) is not None:
+                    out.set_exception(exc)
+                else:
+                    out.set_result(fut.result())
+            except InvalidStateError:
+                pass  # 締め切りで取り消されたのと競合した
+
+        def feed(_fut=None):
+            while True:
+                with waiting_lock:
+                    if not waiting:
+                        return
+                    (fn, args), out = waiting.popleft()
+                if out.cancelled():  # 締め切り超過で取り消し済み: 投入せずに枠だけ返す
+                    self._release()
+                    continue
+                try:
+                    fut = pool.submit(fn, *args)
+                except Exception as e:
+                    self._release()
+                    settle(out, exc=e)
+                    continue
+                out.add_done_callback(lambda o, fut=fut: o.cancelled() and fut.cancel())
+                fut.add_done_callback(lambda f, out=out: (self._release(f), settle(out, f), feed()))
+                return
+
+        for _ in range(min(self.per_request, len(tasks))):
+            feed()
+        return outs
+
+    def run(self, tasks, timeout):
+        """同期版: 全タスクの結果をリストで返す"""
+        if self.kind == "inline":
+            return [fn(*args) for fn, args in tasks]
+        futs = self._submit(tasks)
+        _, pending = wait(futs, timeout=timeout)
+        if pending:
+            for f in futs: f.cancel()
+            raise CpuRejected("cpu deadline exceeded", 504)
+        return [f.result() for f in futs]
+
+    async def arun(self, tasks, timeout):
+        """async 版: イベントループを塞がずに結果を待つ"""
+        if self.kind == "inline":
+            return self.run(tasks, timeout)
+        futs = self._submit(tasks)
+        try:
+            return await asyncio.wait_for(
+                asyncio.gather(*(asyncio.wrap_future(f) for f in futs)), timeout)
+        except asyncio.TimeoutError:
+            for f in futs: f.cancel()
+            raise CpuRejected("cpu deadline exceeded", 504)
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+cpu_engine = CpuEngine(CPU_ENGINE, CPU_WORKERS, CPU_QUEUE, CPU_PER_REQUEST)
+
+def cpu_rejected_response(e):
+    headers = {"Content-Type": "text/plain"}
+    if e.status == 503:
+        headers["Retry-After"] = CPU_RETRY_AFTER
+    return f"{e}\n", e.status, headers
+
+# --- 各エンドポイントの実処理（sync/async 両モードで共有） ---
+# タスクは (関数, 引数)。hashlib の関数を直接渡すのでプロセスプール側で app.py を import しない
+def _cpu_tasks(iters, rounds):
+    pw = b"p"*64
+    return [(hashlib.pbkdf2_hmac, ("sha256", pw, secrets.token_bytes(16), iters, 32))
+            for _ in range(rounds)]
+
+_PAGE_PATTERN = bytes(range(256))
+
+def _touch_pages(buf):
+    """4096 バイトごとにページ番号の下位8bitを書く。ストライド付きスライス代入で一括処理して buf[0] を返す"""
+    n = (len(buf) + 4095) // 4096
+    buf[::4096] = (_PAGE_PATTERN * (n // 256 + 1))[:n]
+    return int(buf[0])
+
+def _mem_alloc(mb):
+    buf = bytearray(mb*1024*1024)
+    _touch_pages(buf)
+    return buf
+
+class SharedBudget:
+    """全ワーカーで共有する予算（/mem は MiB、アドミッション制御はコスト）。各ワーカーが
+    METRICS_DIR/<master pid>-<worker pid>.<kind> に使用量を書き、予約時はロックファイルを flock して
+    生きているワーカーの合計と比べる（落ちたワーカーの分は数えない）"""
+    def __init__(self, directory, limit, kind="mem"):
+        self.directory = directory
+        self.limit = limit
+        self.kind = kind
+        self._fd = None
+        self._pid = None
+        self._used = 0
+
+    def _open(self):
+        if self._pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            ppid = os.getppid()
+            for old in glob.glob(os.path.join(self.directory, f"*.{self.kind}*")):
+                if not os.path.basename(old).startswith((f"{ppid}-", f"{ppid}.")):
+                    try: os.remove(old)  # 前回起動時のマスター配下のファイル
+                    except OSError: pass
+            self._lock_path = os.path.join(self.directory, f"{ppid}.{self.kind}lock")
+            self._fd = os.open(os.path.join(self.directory, f"{ppid}-{os.getpid()}.{self.kind}"),
+                               os.O_RDWR | os.O_CREAT, 0o644)
+            self._used = 0
+            os.pwrite(self._fd, b"0".ljust(20), 0)
+            self._pid = os.getpid()
+
+    def _total(self):
+        total = 0
+        for path in glob.glob(os.path.join(self.directory, f"{os.getppid()}-*.{self.kind}")):
+            pid = int(os.path.basename(path).rsplit(".", 1)[0].split("-")[1])
+            try:
+                os.kill(pid, 0)
+                with open(path, "rb") as f:
+                    total += int(f.read().strip() or 0)
+            except (OSError, ValueError):
+                continue
+        return total
+
+    def _update(self, delta, check):
+        self._open()
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if check and self._total() + delta > self.limit:
+                return False
+            self._used += delta
+            os.pwrite(self._fd, str(self._used).encode().ljust(20), 0)
+            return True
+
+    def reserve(self, n):
+        return self._update(n, True)
+
+    def release(self, n):
+        self._update(-n, False)
+
+class MemArena:
+    """ワーカー起動時に予約した匿名 mmap を MiB 単位で貸す。予算は全ワーカーで共有し、
+    返却時に MADV_DONTNEED で物理メモリを手放す"""
+    def __init__(self, mb, budget):
+        self.mb = mb
+        self.budget = budget
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)  # --preload 時もワーカーごとに作り直す
+
+    def _reset(self):
+        # 仮想アドレスだけ確保（触るまで物理メモリは使わない）。1ワーカーが予算全部を使う場合に備えて予算と同じ大きさ
+        self._mm = mmap.mmap(-1, self.mb << 20, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+        self._free = [(0, self.mb)]  # 空き領域 (先頭 MiB, 長さ MiB)
+        self._cond = threading.Condition()
+
+    def _try_alloc(self, mb):
+        if not self.budget.reserve(mb):
+            return None
+        for i, (off, n) in enumerate(self._free):
+            if n >= mb:
+                self._free[i:i+1] = [(off+mb, n-mb)] if n > mb else []
+                return off
+        self.budget.release(mb)
+        return None
+
+    def acquire(self, mb, wait_s):
+        """先頭 MiB を返す。予算を超える/待っても空かなければ None"""
+        if mb > self.mb:
+            return None
+        deadline = time.monotonic() + wait_s
+        with self._cond:
+            while (off := self._try_alloc(mb)) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # 他のワーカーの返却は通知されないので短い間隔で見直す
+                self._cond.wait(min(remaining, 0.01))
+            return off
+
+    async def aacquire(self, mb, wait_s):
+        off = self.acquire(mb, 0)
+        deadline = time.monotonic() + wait_s
+        while off is None and mb <= self.mb and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            off = self.acquire(mb, 0)
+        return off
+
+    def view(self, off, mb):
+        return memoryview(self._mm)[off << 20:(off+mb) << 20]
+
+    def release(self, off, mb):
+        self._mm.madvise(mmap.MADV_DONTNEED, off << 20, mb << 20)
+        with self._cond:
+            self._free.append((off, mb))
+            self._free.sort()
+            merged = [self._free[0]]
+            for o, n in self._free[1:]:
+                if merged[-1][0] + merged[-1][1] == o:
+                    merged[-1] = (merged[-1][0], merged[-1][1] + n)
+                else:
+                    merged.append((o, n))
+            self._free = merged
+            self.budget.release(mb)
+            self._cond.notify_all()
+
+mem_arena = MemArena(MEM_ARENA_MB, SharedBudget(METRICS_DIR, MEM_ARENA_MB)) if MEM_ALLOC == "arena" else None
+MEM_LIMIT_MB = MEM_MAX_MB if mem_arena is None else min(MEM_MAX_MB, MEM_ARENA_MB)
+
+def mem_rejected_response():
+    return "mem budget exceeded\n", 503, {"Content-Type": "text/plain", "Retry-After": MEM_RETRY_AFTER}
+
+class SharedBlob:
+    """blob.bin をプロセス内で1回だけ mmap し、memoryview のスライスで（コピーせずに）読む"""
+    def __init__(self, path):
+        self.path = path
+        self._view = None
+        self._lock = threading.Lock()
+
+    def view(self):
+        if self._view is None:
+            with self._lock:
+                if self._view is None:
+                    with open(self.path, "rb") as f:
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._view = memoryview(mm)
+        return self._view
+
+    def chunks(self, nbytes, chunk=IO_CHUNK):
+        """先頭から nbytes 分を chunk ごとの memoryview で返す（ファイル末尾に来たら先頭へ戻る）"""
+        mv = self.view(); size = len(mv); pos = 0
+        while nbytes > 0:
+            n = min(chunk, size - pos, nbytes)
+            yield mv[pos:pos+n]
+            nbytes -= n; pos += n
+            if pos >= size: pos = 0
+
+blob = SharedBlob(BLOB_PATH)
+
+def _io_work(kb):
+    h = hashlib.sha256()
+    for mv in blob.chunks(kb*1024):
+        h.update(mv)
+    return h.hexdigest()
+
+def _mix_tasks(iters):
+    return [(hashlib.pbkdf2_hmac, ("sha256", b"p"*64, b"salt", iters, 32))]
+
+# --- ペイロード生成: serializer= でエンコーダを選び、cache=1 ならエンコード済み bytes を使い回す ---
+_SERIALIZERS = {"json": lambda obj: json.dumps(obj).encode("utf-8")}
+if orjson is not None:
+    _SERIALIZERS["orjson"] = orjson.dumps
+
+_PAYLOADS = {
+    "json": lambda kb: {"size_kb": kb, "data": "x" * (kb*1024)},
+    "mix":  lambda kb: {"blob": "y" * (kb*1024)},
+}
+
+class PayloadCache:
+    """(種類, kb, serializer) -> エンコード済み bytes の LRU"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._data.get(key)
+            if body is not None:
+                self._data.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                return
+            self._data[key] = body
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self.nbytes -= len(old)
+
+payload_cache = PayloadCache(PAYLOAD_CACHE_MB*1024*1024)
+
+def build_payload(kind, kb, q):
+    """(body bytes, 使った serializer, キャッシュ状態 hit/miss/off) を返す"""
+    serializer = q.get("serializer", "json")
+    if serializer not in _SERIALIZERS:
+        serializer = "json"  # orjson 未インストール時などは stdlib にフォールバック
+    if q.get("cache") != "1":
+        return _SERIALIZERS[serializer](_PAYLOADS[kind](kb)), serializer, "off"
+    key = (kind, kb, serializer)
+    body = payload_cache.get(key)
+    if body is not None:
+        return body, serializer, "hit"
+    body = _SERIALIZERS[serializer](_PAYLOADS[kind](kb))
+    payload_cache.put(key, body)
+    return body, serializer, "miss"
+
+def payload_headers(t0, serializer, cache):
+    return {"X-Serialize-Seconds": f"{time.perf_counter()-t0:.6f}",
+            "X-Serializer": serializer, "X-Payload-Cache": cache}
+
 @app.get("/cpu")
 def cpu():
     iters  = to_int(request.args, "iters", 200_000, 10_000, 2_000_000)
     rounds = to_int(request.args, "rounds", 4, 1, 64)
+    deadline_ms = to_int(request.args, "deadline_ms", CPU_DEADLINE_MS, 1, 600_000)
     t0 = time.perf_counter()
-    pw = b"p"*64; dig = None
-    for _ in range(rounds):
-        dig = hashlib.pbkdf2_hmac("sha256", pw, secrets.token_bytes(16), iters, dklen=32)
+    try:
+        dig = cpu_engine.run(_cpu_tasks(iters, rounds), deadline_ms/1000)[-1]
+    except CpuRejected as e:
+        return cpu_rejected_response(e)
     return jsonify(kind="cpu", iters=iters, rounds=rounds,
                    seconds=time.perf_counter()-t0, hex=dig.hex())
 
+def mem_granted_headers(requested_mb, mb):
+    # ?mb= は MEM_LIMIT_MB までに抑えるので、実際に確保した量を返して負荷試験の結果を読み違えないようにする
+    return {"X-Mem-Requested-MB": str(requested_mb), "X-Mem-Granted-MB": str(mb)}
+
 @app.get("/mem")
 def mem():
-    mb = to_int(request.args, "mb", 64, 1, 1024)
+    requested_mb = to_int(request.args, "mb", 64, 1)
+    mb = min(requested_mb, MEM_LIMIT_MB)
     ms = to_int(request.args, "ms", 500, 1, 60_000)
     t0 = time.perf_counter()
-    buf = bytearray(mb*1024*1024)
-    for i in range(0, len(buf), 4096): buf[i] = (i//4096) & 0xFF
-    time.sleep(ms/1000.0)
-    res = jsonify(kind="mem", mb=mb, ms=ms, seconds=time.perf_counter()-t0, sample=int(buf[0]))
-    del buf
-    return res
+    if mem_arena is None:
+        buf = _mem_alloc(mb)
+        time.sleep(ms/1000.0)
+        sample = int(buf[0])
+        del buf
+    else:
+        off = mem_arena.acquire(mb, MEM_WAIT_MS/1000)
+        if off is None:
+            return mem_rejected_response()
+        try:
+            sample = _touch_pages(mem_arena.view(off, mb))
+            time.sleep(ms/1000.0)
+        finally:
+            mem_arena.release(off, mb)
+    return (jsonify(kind="mem", mb=mb, requested_mb=requested_mb, ms=ms, seconds=time.perf_counter()-t0, sample=sample),
+            200, mem_granted_headers(requested_mb, mb))
 
 @app.get("/json")
 def big_json():
     kb = to_int(request.args, "kb", 256, 1, 8192)
-    s  = "x" * (kb*1024)
     t0 = time.perf_counter()
-    body = json.dumps({"size_kb": kb, "data": s})
+    body, serializer, cache = build_payload("json", kb, request.args)
     return Response(body, mimetype="application/json",
-                    headers={"X-Serialize-Seconds": f"{time.perf_counter()-t0:.6f}"})
+                    headers=payload_headers(t0, serializer, cache))
 
 @app.get("/io")
 def io():
     kb   = to_int(request.args, "kb", 512, 1, 16384)
-    path = "/opt/app/blob.bin"
+    if request.args.get("stream") == "1":
+        return _io_stream(kb)
     t0 = time.perf_counter()
-    h = hashlib.sha256(); read_bytes = 0
-    with open(path, "rb") as f:
-        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-        bs = kb*1024; pos = 0
-        while read_bytes < bs:
-            chunk = mm[pos:min(pos+65536, mm.size())]
-            if not chunk: pos = 0; continue
-            h.update(chunk); read_bytes += len(chunk); pos += len(chunk)
-        mm.close()
-    return jsonify(kind="io", kb=kb, seconds=time.perf_counter()-t0, sha256=h.hexdigest())
+    digest = _io_work(kb)
+    return jsonify(kind="io", kb=kb, seconds=time.perf_counter()-t0, sha256=digest)
+
+def _io_stream(kb):
+    nbytes = kb*1024
+    headers = {"X-IO-Bytes": str(nbytes)}
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and hasattr(os, "sendfile") and nbytes <= len(blob.view()):
+        # gunicorn は file_wrapper を os.sendfile で送る（送信量は Content-Length で指定）
+        headers["Content-Length"] = str(nbytes)
+        return Response(file_wrapper(open(BLOB_PATH, "rb"), IO_CHUNK), headers=headers,
+                        mimetype="application/octet-stream", direct_passthrough=True)
+    # それ以外はマッピングから chunked で返す（WSGI は bytes 必須なのでここだけコピー）
+    return Response((bytes(mv) for mv in blob.chunks(nbytes)), headers=headers,
+                    mimetype="application/octet-stream")
 
 @app.get("/mix")
 def mix():
@@ -122,11 +602,570 @@ def mix():
     kb     = to_int(request.args, "kb", 128, 1, 4096)
     sleepm = to_int(request.args, "sleep_ms", 50, 0, 5000)
     t0 = time.perf_counter()
-    d1 = hashlib.pbkdf2_hmac("sha256", b"p"*64, b"salt", iters, dklen=32)
-    s  = json.dumps({"blob": "y"*(kb*1024)})
+    try:
+        d1 = cpu_engine.run(_mix_tasks(iters), CPU_DEADLINE_MS/1000)[0]
+    except CpuRejected as e:
+        return cpu_rejected_response(e)
+    t1 = time.perf_counter()
+    s, serializer, cache = build_payload("mix", kb, request.args)
+    headers = payload_headers(t1, serializer, cache)
     time.sleep(sleepm/1000)
-    return jsonify(kind="mix", iters=iters, kb=kb, sleep_ms=sleepm,
-                   seconds=time.perf_counter()-t0, hex=d1.hex(), json_len=len(s))
+    res = jsonify(kind="mix", iters=iters, kb=kb, sleep_ms=sleepm,
+                  seconds=time.perf_counter()-t0, hex=d1.hex(), json_len=len(s))
+    res.headers.update(headers)
+    return res
+
+# =========================================================
+# async モード: 同じルートを素の ASGI アプリとして提供（sleep は await、pbkdf2 は CPU エンジンへ）
+# =========================================================
+_async_routes = {}
+
+def async_route(path):
+    def deco(fn):
+        _async_routes[path] = fn
+        return fn
+    return deco
+
+def _json_resp(**kw):
+    body = json.dumps(kw, separators=(",", ":")) + "\n"
+    return body, 200, {"Content-Type": "application/json"}
+
+async def _run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+@async_route("/")
+async def a_root(q):
+    priv_dns, priv_ip = get_private_identity()
+    return f"Hello from {priv_dns} ({priv_ip})\n", 200, {"Content-Type": "text/plain"}
+
+@async_route("/health")
+async def a_health(q):
+    return "ok", 200, {"Content-Type": "text/plain"}
+
+@async_route("/cpu")
+async def a_cpu(q):
+    iters  = to_int(q, "iters", 200_000, 10_000, 2_000_000)
+    rounds = to_int(q, "rounds", 4, 1, 64)
+    deadline_ms = to_int(q, "deadline_ms", CPU_DEADLINE_MS, 1, 600_000)
+    t0 = time.perf_counter()
+    try:
+        dig = (await cpu_engine.arun(_cpu_tasks(iters, rounds), deadline_ms/1000))[-1]
+    except CpuRejected as e:
+        return cpu_rejected_response(e)
+    return _json_resp(kind="cpu", iters=iters, rounds=rounds,
+                      seconds=time.perf_counter()-t0, hex=dig.hex())
+
+@async_route("/mem")
+async def a_mem(q):
+    requested_mb = to_int(q, "mb", 64, 1)
+    mb = min(requested_mb, MEM_LIMIT_MB)
+    ms = to_int(q, "ms", 500, 1, 60_000)
+    t0 = time.perf_counter()
+    if mem_arena is None:
+        buf = await _run_blocking(_mem_alloc, mb)
+        await asyncio.sleep(ms/1000.0)
+        sample = int(buf[0])
+        del buf
+    else:
+        off = await mem_arena.aacquire(mb, MEM_WAIT_MS/1000)
+        if off is None:
+            return mem_rejected_response()
+        try:
+            sample = await _run_blocking(_touch_pages, mem_arena.view(off, mb))
+            await asyncio.sleep(ms/1000.0)
+        finally:
+            mem_arena.release(off, mb)
+    body, status, headers = _json_resp(kind="mem", mb=mb, requested_mb=requested_mb, ms=ms,
+                                       seconds=time.perf_counter()-t0, sample=sample)
+    return body, status, {**headers, **mem_granted_headers(requested_mb, mb)}
+
+@async_route("/json")
+async def a_big_json(q):
+    kb = to_int(q, "kb", 256, 1, 8192)
+    t0 = time.perf_counter()
+    # 最大 8MB のエンコードはイベントループを塞ぐのでスレッドで行う
+    body, serializer, cache = await _run_blocking(build_payload, "json", kb, q)
+    return body, 200, {"Content-Type": "application/json", **payload_headers(t0, serializer, cache)}
+
+@async_route("/io")
+async def a_io(q):
+    kb = to_int(q, "kb", 512, 1, 16384)
+    if q.get("stream") == "1":
+        # body にイテレータを返すとマッピングの memoryview をそのまま chunked で送る
+        return blob.chunks(kb*1024), 200, {"Content-Type": "application/octet-stream",
+                                           "X-IO-Bytes": str(kb*1024)}
+    t0 = time.perf_counter()
+    digest = await _run_blocking(_io_work, kb)
+    return _json_resp(kind="io", kb=kb, seconds=time.perf_counter()-t0, sha256=digest)
+
+@async_route("/mix")
+async def a_mix(q):
+    iters  = to_int(q, "iters", 150_000, 10_000, 2_000_000)
+    kb     = to_int(q, "kb", 128, 1, 4096)
+    sleepm = to_int(q, "sleep_ms", 50, 0, 5000)
+    t0 = time.perf_counter()
+    try:
+        d1 = (await cpu_engine.arun(_mix_tasks(iters), CPU_DEADLINE_MS/1000))[0]
+    except CpuRejected as e:
+        return cpu_rejected_response(e)
+    t1 = time.perf_counter()
+    s, serializer, cache = await _run_blocking(build_payload, "mix", kb, q)
+    headers = payload_headers(t1, serializer, cache)
+    await asyncio.sleep(sleepm/1000)
+    body, status, base = _json_resp(kind="mix", iters=iters, kb=kb, sleep_ms=sleepm,
+                                    seconds=time.perf_counter()-t0, hex=d1.hex(), json_len=len(s))
+    return body, status, {**base, **headers}
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                cpu_engine.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    handler = _async_routes.get(scope["path"]) if scope["method"] == "GET" else None
+    if handler is None:
+        body, status, headers = "Not Found", 404, {"Content-Type": "text/plain"}
+    else:
+        q = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+        body, status, headers = await handler(q)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+    if isinstance(body, bytes):
+        raw_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+        return
+    # イテレータは Content-Length なし（= chunked）でチャンクごとに送る
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    for chunk in body:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+# =========================================================
+# メトリクス: 各ワーカーが METRICS_DIR/<master pid>-<worker pid>.bin（float64 配列）に書き、
+#   /metrics は全ワーカー分を合算して Prometheus 形式で返す
+# =========================================================
+METRIC_ROUTES  = ["/", "/health", "/cpu", "/mem", "/json", "/io", "/mix", "/metrics", "other"]
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+# ルートごとのスロット: バケット(+Inf 含む) / sum / count / in-flight / 5xx
+_R_SUM, _R_COUNT, _R_INFLIGHT, _R_ERRORS = range(len(LATENCY_BUCKETS)+1, len(LATENCY_BUCKETS)+5)
+_R_WIDTH = len(LATENCY_BUCKETS) + 5
+# ワーカー全体のスロット: CPU 秒 / CPU エンジンの待ち+実行中タスク数
+_W_CPU = len(METRIC_ROUTES) * _R_WIDTH
+_W_ENGINE = _W_CPU + 1
+_SLOTS = _W_ENGINE + 1
+
+class MetricsStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._arr = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _values(self):
+        # fork 後の各ワーカーで自分用のファイルを作る
+        if self._pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            ppid = os.getppid()
+            for old in glob.glob(os.path.join(self.directory, "*.bin")):
+                if not os.path.basename(old).startswith(f"{ppid}-"):
+                    try: os.remove(old)  # 前回起動時のマスター配下のファイル
+                    except OSError: pass
+            path = os.path.join(self.directory, f"{ppid}-{os.getpid()}.bin")
+            with open(path, "w+b") as f:
+                f.truncate(_SLOTS * 8)
+                mm = mmap.mmap(f.fileno(), _SLOTS * 8)
+            self._arr = memoryview(mm).cast("d")
+            self._pid = os.getpid()
+        return self._arr
+
+    @staticmethod
+    def route_index(path):
+        return METRIC_ROUTES.index(path if path in METRIC_ROUTES else "other") * _R_WIDTH
+
+    def enter(self, base):
+        with self._lock:
+            self._values()[base + _R_INFLIGHT] += 1
+
+    def exit(self, base, seconds, status):
+        b = 0
+        while b < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[b]:
+            b += 1
+        with self._lock:
+            arr = self._values()
+            arr[base + _R_INFLIGHT] -= 1
+            arr[base + b] += 1
+            arr[base + _R_SUM] += seconds
+            arr[base + _R_COUNT] += 1
+            if status >= 500:
+                arr[base + _R_ERRORS] += 1
+            arr[_W_CPU] = time.process_time()
+            arr[_W_ENGINE] = cpu_engine.inflight
+
+    def collect(self):
+        """全ワーカー分を合算: (スロットごとの合計, {pid: (cpu, engine)})"""
+        self._values()[_W_CPU] = time.process_time()
+        totals = [0.0] * _SLOTS
+        workers = {}
+        for path in glob.glob(os.path.join(self.directory, f"{os.getppid()}-*.bin")):
+            pid = int(os.path.basename(path)[:-4].split("-")[1])
+            try:
+                with open(path, "rb") as f:
+                    vals = memoryview(f.read()).cast("d")
+            except (OSError, TypeError):
+                continue
+            try:
+                os.kill(pid, 0); alive = True
+            except OSError:
+                alive = False  # 落ちたワーカーは累積値だけ数え、in-flight は捨てる
+            for i, v in enumerate(vals):
+                if not alive and i < _W_CPU and i % _R_WIDTH == _R_INFLIGHT:
+                    continue
+                totals[i] += v
+            if alive:
+                workers[pid] = (vals[_W_CPU], vals[_W_ENGINE])
+        return totals, workers
+
+    def render(self):
+        totals, workers = self.collect()
+        out = ["# HELP app_request_duration_seconds Request latency per route.",
+               "# TYPE app_request_duration_seconds histogram"]
+        for r, route in enumerate(METRIC_ROUTES):
+            base = r * _R_WIDTH; acc = 0.0
+            for b, le in enumerate(LATENCY_BUCKETS + ["+Inf"]):
+                acc += totals[base + b]
+                out.append(f'app_request_duration_seconds_bucket{{route="{route}",le="{le}"}} {acc:g}')
+            out.append(f'app_request_duration_seconds_sum{{route="{route}"}} {totals[base+_R_SUM]:.6f}')
+            out.append(f'app_request_duration_seconds_count{{route="{route}"}} {totals[base+_R_COUNT]:g}')
+        out += ["# HELP app_requests_in_flight Requests currently being handled.",
+                "# TYPE app_requests_in_flight gauge"]
+        out += [f'app_requests_in_flight{{route="{route}"}} {totals[r*_R_WIDTH+_R_INFLIGHT]:g}'
+                for r, route in enumerate(METRIC_ROUTES)]
+        out += ["# HELP app_request_errors_total Responses with status 5xx.",
+                "# TYPE app_request_errors_total counter"]
+        out += [f'app_request_errors_total{{route="{route}"}} {totals[r*_R_WIDTH+_R_ERRORS]:g}'
+                for r, route in enumerate(METRIC_ROUTES)]
+        out += ["# HELP app_worker_cpu_seconds_total CPU time used by each worker process.",
+                "# TYPE app_worker_cpu_seconds_total counter"]
+        out += [f'app_worker_cpu_seconds_total{{pid="{pid}"}} {cpu:.6f}' for pid, (cpu, _) in sorted(workers.items())]
+        out += ["# HELP app_cpu_engine_tasks Pending and running CPU engine tasks.",
+                "# TYPE app_cpu_engine_tasks gauge",
+                f"app_cpu_engine_tasks {sum(e for _, e in workers.values()):g}",
+                "# HELP app_workers Live worker processes.",
+                "# TYPE app_workers gauge",
+                f"app_workers {len(workers)}"]
+        return "\n".join(out) + "\n"
+
+metrics = MetricsStore(METRICS_DIR)
+_METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# =========================================================
+# EMF 出力: リクエスト処理中は deque に追記するだけ。バックグラウンドスレッドが
+#   EMF_FLUSH_S ごとにルート単位で集計してまとめて書き出す（CW エージェントは 25888 で受ける）
+# =========================================================
+class EmfEmitter:
+    def __init__(self, sink, namespace, log_group, flush_s, maxlen):
+        self.sink = sink
+        self.namespace = namespace
+        self.log_group = log_group
+        self.flush_s = flush_s
+        self.maxlen = maxlen
+        self._start_lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._buf = deque(maxlen=self.maxlen)
+        self._thread = None
+
+    def record(self, route, seconds, status):
+        if not self.sink:
+            return
+        self._buf.append((route, seconds, status))
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="emf", daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_s)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.warning("emf flush failed: %s", e)
+
+    def dimensions(self):
+        """AutoScalingGroupName / InstanceId を環境変数 → IMDS の順で決める"""
+        return {"AutoScalingGroupName": os.getenv("EMF_ASG_NAME")
+                                        or imds.get("tags/instance/aws:autoscaling:groupName", "unknown"),
+                "InstanceId": os.getenv("EMF_INSTANCE_ID") or imds.get("instance-id", socket.gethostname())}
+
+    def drain(self):
+        """バッファを空にしてルートごとの [latency_ms, ...], 件数, 5xx を返す"""
+        per_route = {}
+        for _ in range(len(self._buf)):
+            route, seconds, status = self._buf.popleft()
+            lat, n, err = per_route.get(route, ([], 0, 0))
+            lat.append(round(seconds*1000, 3))
+            per_route[route] = (lat, n + 1, err + (status >= 500))
+        return per_route
+
+    def documents(self, per_route, timestamp_ms):
+        dims = self.dimensions()
+        for route, (lat, n, err) in per_route.items():
+            for i in range(0, len(lat), 100):  # EMF のメトリクス値は数値か、100 個までの数値の配列
+                names = [("Latency", "Milliseconds")]
+                doc = {**dims, "Route": route, "Latency": lat[i:i+100]}
+                if i == 0:  # 件数系は最初の1行にだけ載せる
+                    names += [("Requests", "Count"), ("Errors5xx", "Count")]
+                    doc.update(Requests=n, Errors5xx=err)
+                doc["_aws"] = {"Timestamp": timestamp_ms, "LogGroupName": self.log_group, "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["AutoScalingGroupName"], ["AutoScalingGroupName", "Route"], ["InstanceId"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in names],
+                }]}
+                yield json.dumps(doc, separators=(",", ":"))
+
+    def flush(self):
+        per_route = self.drain()
+        if not per_route:
+            return 0
+        lines = list(self.documents(per_route, int(time.time() * 1000)))
+        if self.sink.startswith("file:"):
+            with open(self.sink[5:], "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        else:
+            scheme, _, addr = self.sink.partition("://")
+            host, _, port = addr.rpartition(":")
+            if scheme == "udp":
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    for line in lines:
+                        sock.sendto(line.encode("utf-8") + b"\n", (host, int(port)))
+            else:
+                with socket.create_connection((host, int(port)), timeout=2) as sock:
+                    sock.sendall(("\n".join(lines) + "\n").encode("utf-8"))
+        return len(lines)
+
+emf = EmfEmitter(EMF_SINK, EMF_NAMESPACE, EMF_LOG_GROUP, EMF_FLUSH_S, EMF_BUFFER)
+
+def _request_done(base, t0, status):
+    seconds = time.perf_counter() - t0
+    metrics.exit(base, seconds, status)
+    emf.record(METRIC_ROUTES[base // _R_WIDTH], seconds, status)
+
+class MetricsMiddleware:
+    """WSGI ミドルウェア: サーバーが本文を送り終えて close() するまでを計測する"""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        base = metrics.route_index(environ.get("PATH_INFO", ""))
+        status = [500]
+        def _start_response(st, headers, exc_info=None):
+            status[0] = int(st.split(" ", 1)[0])
+            return start_response(st, headers, exc_info)
+        t0 = time.perf_counter()
+        metrics.enter(base)
+        try:
+            result = self.wsgi_app(environ, _start_response)
+        except BaseException:
+            _request_done(base, t0, 500)
+            raise
+        return on_close(environ, result, lambda: _request_done(base, t0, status[0]))
+
+def on_close(environ, result, callback):
+    """WSGI の戻り値の close() に callback を足す"""
+    inner_close = getattr(result, "close", None)
+    def close():
+        try:
+            if inner_close is not None: inner_close()
+        finally:
+            callback()
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and isinstance(result, file_wrapper):
+        # sendfile を効かせるため file_wrapper はそのまま返し、close() だけ差し替える
+        result.close = close
+        return result
+    return _ClosingIter(result, close)
+
+class _ClosingIter:
+    def __init__(self, inner, close):
+        self._inner = inner
+        self.close = close
+
+    def __iter__(self):
+        return iter(self._inner)
+
+def metrics_asgi(inner):
+    """ASGI ミドルウェア版"""
+    async def wrapper(scope, receive, send):
+        if scope["type"] != "http":
+            return await inner(scope, receive, send)
+        base = metrics.route_index(scope["path"])
+        status = [500]
+        async def _send(msg):
+            if msg["type"] == "http.response.start":
+                status[0] = msg["status"]
+            await send(msg)
+        t0 = time.perf_counter()
+        metrics.enter(base)
+        try:
+            await inner(scope, receive, _send)
+        finally:
+            _request_done(base, t0, status[0])
+    return wrapper
+
+# =========================================================
+# アドミッション制御: コストの合計を ADMIT_CAPACITY までに抑え、ADMIT_MAX_WAIT_MS 待っても
+#   入れなければ 503。/health と /metrics は常に通す。容量は SharedBudget で全ワーカーの合計を数えるので、
+#   1件ずつしか受けない sync ワーカーでも効く。空き待ちは同じワーカー内の返却か ADMIT_POLL_MS ごとの確認で起きる
+# =========================================================
+class AdmissionController:
+    EXEMPT = ("/health", "/metrics")
+
+    def __init__(self, capacity, max_wait_ms, queue, costs, budget, poll_ms):
+        self.capacity = capacity
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue
+        self.costs = {p: int(c) for p, _, c in (kv.partition(":") for kv in costs.split(",") if kv)}
+        self.budget = budget
+        self.poll = poll_ms / 1000
+        self.waiting = 0
+        self._cond = threading.Condition()
+        self._wakeups = []
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.waiting = 0
+        self._cond = threading.Condition()
+        self._wakeups = []
+
+    def cost(self, path):
+        if not self.capacity or path in self.EXEMPT:
+            return 0
+        return min(self.costs.get(path, 1), self.capacity)
+
+    def acquire(self, cost):
+        deadline = time.monotonic() + self.max_wait
+        if self.budget.reserve(cost):
+            return True
+        with self._cond:
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                with self._cond:
+                    self._cond.wait(min(remaining, self.poll))
+                if self.budget.reserve(cost):
+                    return True
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    async def aacquire(self, cost):
+        # waiting と _wakeups はイベントループ内からしか触らない。release() で待機中の Future を起こす
+        deadline = time.monotonic() + self.max_wait
+        if self.budget.reserve(cost):
+            return True
+        if self.waiting >= self.queue:
+            return False
+        self.waiting += 1
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                fut = asyncio.get_running_loop().create_future()
+                self._wakeups.append(fut)
+                try:
+                    await asyncio.wait_for(fut, min(remaining, self.poll))
+                except asyncio.TimeoutError:
+                    pass
+                if self.budget.reserve(cost):
+                    return True
+        finally:
+            self.waiting -= 1
+
+    def release(self, cost):
+        self.budget.release(cost)
+        with self._cond:
+            self._cond.notify_all()
+        wakeups, self._wakeups = self._wakeups, []
+        for fut in wakeups:
+            if not fut.done(): fut.set_result(None)
+
+admission = AdmissionController(ADMIT_CAPACITY, ADMIT_MAX_WAIT_MS, ADMIT_QUEUE, ADMIT_COSTS,
+                                SharedBudget(METRICS_DIR, ADMIT_CAPACITY, kind="admit"), ADMIT_POLL_MS)
+_SHED_HEADERS = [("Content-Type", "text/plain"), ("Retry-After", ADMIT_RETRY_AFTER)]
+
+class AdmissionMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        cost = admission.cost(environ.get("PATH_INFO", ""))
+        if not cost:
+            return self.wsgi_app(environ, start_response)
+        if not admission.acquire(cost):
+            start_response("503 Service Unavailable", _SHED_HEADERS)
+            return [b"overloaded\n"]
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except BaseException:
+            admission.release(cost)
+            raise
+        return on_close(environ, result, lambda: admission.release(cost))
+
+def admission_asgi(inner):
+    async def wrapper(scope, receive, send):
+        cost = admission.cost(scope["path"]) if scope["type"] == "http" else 0
+        if not cost:
+            return await inner(scope, receive, send)
+        if not await admission.aacquire(cost):
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(k.lower().encode(), v.encode()) for k, v in _SHED_HEADERS]})
+            await send({"type": "http.response.body", "body": b"overloaded\n"})
+            return
+        try:
+            await inner(scope, receive, send)
+        finally:
+            admission.release(cost)
+    return wrapper
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": _METRICS_CONTENT_TYPE}
+
+@async_route("/metrics")
+async def a_metrics(q):
+    return metrics.render(), 200, {"Content-Type": _METRICS_CONTENT_TYPE}
+
+# 外側から メトリクス → アドミッション制御 → アプリ（503 で落としたリクエストも計測に入る）
+app.wsgi_app = MetricsMiddleware(AdmissionMiddleware(app.wsgi_app))
+asgi_app = metrics_asgi(admission_asgi(asgi_app))
+
+# gunicorn の app:app を実行モードに合わせて差し替える
+flask_app = app
+if APP_MODE == "async":
+    app = asgi_app
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    if APP_MODE == "async":
+        import uvicorn
+        uvicorn.run(asgi_app, host="0.0.0.0", port=8080)
+    else:
+        flask_app.run(host="0.0.0.0", port=8080)
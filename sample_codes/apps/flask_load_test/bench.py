@@ -0,0 +1,243 @@
+"""flask_load_test をローカルで起動し、シナリオ（サーバー構成）ごとに Locust を headless で流して比較する
+
+    python bench.py --workers 4 --out bench_out
+    python bench.py --tags cpu,mem,json,io,mix          # エンドポイントごとに単独で流す（RSS もエンドポイント別になる）
+    python bench.py --baseline bench_out/report.json     # 前回の結果と比べ、悪化していれば exit 1
+
+AWS は不要。Locust のタスク構成は ../locust_asg_common/locustfile.py をそのまま使う。
+"""
+import argparse, csv, json, os, shlex, signal, subprocess, sys, threading, time
+import urllib.request
+from pathlib import Path
+
+_HERE = Path(__file__).resolve().parent
+_LOCUSTFILE = _HERE.parent / "locust_asg_common" / "locustfile.py"
+
+# 短時間で終わる固定ステージ（locustfile の --stages-file にそのまま渡す）
+_DEFAULT_STAGES = [
+    {"duration": 15, "users": 10, "spawn_rate": 10},
+    {"duration": 30, "users": 20, "spawn_rate": 10},
+]
+
+def default_scenarios(workers):
+    """gunicorn.service の GUNICORN_OPTS と同じ書き方で、比較したい構成を並べる"""
+    return [
+        {"name": f"sync-w{workers}", "env": {"APP_MODE": "sync", "WEB_CONCURRENCY": str(workers)},
+         "gunicorn_opts": f"-w {workers} --threads 1"},
+        {"name": f"gthread-w{workers}x8", "env": {"APP_MODE": "sync", "WEB_CONCURRENCY": str(workers)},
+         "gunicorn_opts": f"-w {workers} --threads 8"},
+        {"name": f"async-w{workers}", "env": {"APP_MODE": "async", "WEB_CONCURRENCY": str(workers)},
+         "gunicorn_opts": f"-w {workers} -k uvicorn.workers.UvicornWorker"},
+    ]
+
+# =========================================================
+# RSS の計測: gunicorn マスターと子孫プロセスの VmRSS の合計（共有ページはプロセスごとに数える）
+# =========================================================
+def _children_map():
+    children = {}
+    for d in os.listdir("/proc"):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f"/proc/{d}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(d))
+    return children
+
+def tree_rss_mb(pid):
+    children, stack, total_kb = _children_map(), [pid], 0
+    while stack:
+        p = stack.pop()
+        stack.extend(children.get(p, []))
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return total_kb / 1024
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.samples = []
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.samples.append(tree_rss_mb(self.pid))
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        s = self.samples or [0.0]
+        return {"rss_peak_mb": round(max(s), 1), "rss_avg_mb": round(sum(s) / len(s), 1)}
+
+# =========================================================
+# 1シナリオ分の実行
+# =========================================================
+def start_server(scenario, port, workdir):
+    env = dict(os.environ)
+    env.update({"BLOB_PATH": str(workdir / "blob.bin"),
+                "METRICS_DIR": str(workdir / f"metrics-{scenario['name']}"),
+                "IMDS_BASE": env.get("IMDS_BASE", "http://127.0.0.1:9/latest")})  # EC2 の外では即失敗させる
+    env.update({k: str(v) for k, v in scenario.get("env", {}).items()})
+    cmd = [sys.executable, "-m", "gunicorn", *shlex.split(scenario["gunicorn_opts"]),
+           "-b", f"127.0.0.1:{port}", "app:app"]
+    log = open(workdir / f"{scenario['name']}.server.log", "a")
+    return subprocess.Popen(cmd, cwd=_HERE, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+def wait_healthy(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become healthy")
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=15)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+def run_locust(port, stages_file, tags, csv_prefix, log_path):
+    cmd = [sys.executable, "-m", "locust", "-f", str(_LOCUSTFILE), "--headless", "--only-summary",
+           "-H", f"http://127.0.0.1:{port}", "--stages-file", str(stages_file), "--csv", str(csv_prefix)]
+    if tags:
+        cmd += ["--tags", *tags]
+    with open(log_path, "w") as log:
+        subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, check=False)
+
+def read_stats(csv_prefix):
+    """Locust の *_stats.csv をエンドポイント（Name）ごとの dict にする"""
+    rows = {}
+    with open(f"{csv_prefix}_stats.csv", newline="") as f:
+        for r in csv.DictReader(f):
+            rows[r["Name"]] = {
+                "requests": int(r["Request Count"]),
+                "failures": int(r["Failure Count"]),
+                "rps": round(float(r["Requests/s"]), 2),
+                "p50_ms": float(r["50%"]),
+                "p95_ms": float(r["95%"]),
+                "p99_ms": float(r["99%"]),
+                "avg_ms": round(float(r["Average Response Time"]), 1),
+            }
+    return rows
+
+def run_scenario(scenario, tags, port, stages_file, workdir):
+    label = f"{scenario['name']}[{','.join(tags) if tags else 'all'}]"
+    print(f"== {label}", flush=True)
+    proc = start_server(scenario, port, workdir)
+    try:
+        wait_healthy(port, proc)
+        sampler = RssSampler(proc.pid)
+        sampler.start()
+        prefix = workdir / label.replace("[", "_").replace("]", "").replace(",", "-")
+        run_locust(port, stages_file, tags, prefix, f"{prefix}.locust.log")
+        rss = sampler.stop()
+    finally:
+        stop_server(proc)
+    rows = []
+    for name, st in read_stats(prefix).items():
+        rows.append({"scenario": scenario["name"], "tags": ",".join(tags) or "all", "endpoint": name,
+                     **st, **rss})
+    return rows
+
+# =========================================================
+# 前回結果との比較
+# =========================================================
+def compare(rows, baseline_rows, threshold):
+    """スループット低下・p95 悪化・ピーク RSS 増加が threshold（比率）を超えたものを返す"""
+    base = {(r["scenario"], r["tags"], r["endpoint"]): r for r in baseline_rows}
+    regressions = []
+    for r in rows:
+        b = base.get((r["scenario"], r["tags"], r["endpoint"]))
+        if b is None:
+            continue
+        checks = [("rps", b["rps"], r["rps"], b["rps"] > 0 and r["rps"] < b["rps"] * (1 - threshold)),
+                  ("p95_ms", b["p95_ms"], r["p95_ms"], r["p95_ms"] > b["p95_ms"] * (1 + threshold)),
+                  ("rss_peak_mb", b["rss_peak_mb"], r["rss_peak_mb"],
+                   r["rss_peak_mb"] > b["rss_peak_mb"] * (1 + threshold))]
+        for metric, old, new, bad in checks:
+            if bad:
+                regressions.append(f"{r['scenario']} [{r['tags']}] {r['endpoint']}: {metric} {old} -> {new}")
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser(description="Local scenario-matrix benchmark for flask_load_test")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="gunicorn -w for the default scenarios")
+    ap.add_argument("--scenarios-file", help="JSON list of {name, env, gunicorn_opts} (replaces the defaults)")
+    ap.add_argument("--only", default="", help="comma separated scenario names to run")
+    ap.add_argument("--stages-file", help="stages JSON passed to locustfile (default: short built-in stages)")
+    ap.add_argument("--tags", default="", help="comma separated locust tags; each tag runs alone (default: full mix)")
+    ap.add_argument("--port", type=int, default=8100)
+    ap.add_argument("--out", default="bench_out", help="directory for report.json / report.csv and logs")
+    ap.add_argument("--baseline", help="previous report.json to compare against")
+    ap.add_argument("--threshold", type=float, default=0.2, help="allowed regression ratio (default 0.2)")
+    args = ap.parse_args()
+
+    out = Path(args.out).resolve()
+    out.mkdir(parents=True, exist_ok=True)
+    # 比較前に読む（--out と同じ場所を指していても上書き前の内容を使う）
+    baseline_rows = json.loads(Path(args.baseline).read_text())["rows"] if args.baseline else None
+
+    scenarios = (json.loads(Path(args.scenarios_file).read_text()) if args.scenarios_file
+                 else default_scenarios(args.workers))
+    if args.only:
+        wanted = set(args.only.split(","))
+        scenarios = [s for s in scenarios if s["name"] in wanted]
+    tag_runs = [[t] for t in args.tags.split(",") if t] or [[]]
+
+    if args.stages_file:
+        stages_file = Path(args.stages_file).resolve()
+    else:
+        stages_file = out / "stages.json"
+        stages_file.write_text(json.dumps(_DEFAULT_STAGES, indent=2))
+
+    with open(out / "blob.bin", "wb") as f:
+        f.truncate(10 * 1024 * 1024)  # cloud-init の dd と同じ 10MB（スパースファイル）
+    rows = []
+    for scenario in scenarios:
+        for tags in tag_runs:
+            rows += run_scenario(scenario, tags, args.port, stages_file, out)
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "workers": args.workers,
+              "stages": json.loads(stages_file.read_text()), "scenarios": scenarios, "rows": rows}
+    (out / "report.json").write_text(json.dumps(report, indent=2))
+    with open(out / "report.csv", "w", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else ["scenario"])
+        w.writeheader()
+        w.writerows(rows)
+
+    print(f"{'scenario':<22}{'tags':<8}{'endpoint':<20}{'rps':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'fail':>6}{'rss':>8}")
+    for r in rows:
+        print(f"{r['scenario']:<22}{r['tags']:<8}{r['endpoint']:<20}{r['rps']:>8}{r['p50_ms']:>8.0f}"
+              f"{r['p95_ms']:>8.0f}{r['p99_ms']:>8.0f}{r['failures']:>6}{r['rss_peak_mb']:>8.0f}")
+    print(f"report: {out / 'report.json'}")
+
+    if baseline_rows is not None:
+        regressions = compare(rows, baseline_rows, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""EC2 の外で IMDSv2 を真似るローカルスタブ
+
+    python imds_stub.py --port 1338 --delay-ms 150
+    IMDS_BASE=http://127.0.0.1:1338/latest gunicorn -w 2 app:app
+
+トークン発行とメタデータ取得の回数をログに出すので、トークンの使い回しや
+失敗時のキャッシュ（--fail で全リクエストを 500 にする）を確認できる。
+"""
+import argparse, secrets, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_META = {
+    "local-hostname": "ip-10-0-1-23.ap-northeast-1.compute.internal",
+    "local-ipv4": "10.0.1.23",
+    "instance-id": "i-0123456789abcdef0",
+    "tags/instance/aws:autoscaling:groupName": "local-asg",
+}
+
+class ImdsStub:
+    def __init__(self, meta, delay_s=0.0, fail=False):
+        self.meta, self.delay_s, self.fail = meta, delay_s, fail
+        self.tokens = {}  # token -> 失効時刻
+        self.counts = {"token": 0, "meta": 0}
+        self.lock = threading.Lock()
+
+    def issue(self, ttl):
+        token = secrets.token_urlsafe(32)
+        with self.lock:
+            self.tokens[token] = time.monotonic() + ttl
+            self.counts["token"] += 1
+        return token
+
+    def valid(self, token):
+        with self.lock:
+            self.counts["meta"] += 1
+            return self.tokens.get(token, 0) > time.monotonic()
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body=""):
+            data = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _begin(self):
+            time.sleep(stub.delay_s)
+            if stub.fail:
+                self._send(500)
+                return False
+            return True
+
+        def do_PUT(self):
+            if not self._begin():
+                return
+            if self.path != "/latest/api/token":
+                return self._send(404)
+            try:
+                ttl = int(self.headers.get("X-aws-ec2-metadata-token-ttl-seconds", ""))
+            except ValueError:
+                return self._send(400)
+            if not 1 <= ttl <= 21600:
+                return self._send(400)
+            self._send(200, stub.issue(ttl))
+
+        def do_GET(self):
+            if not self._begin():
+                return
+            if not stub.valid(self.headers.get("X-aws-ec2-metadata-token", "")):
+                return self._send(401)
+            prefix = "/latest/meta-data/"
+            key = self.path[len(prefix):] if self.path.startswith(prefix) else None
+            if key not in stub.meta:
+                return self._send(404)
+            self._send(200, stub.meta[key])
+
+        def log_message(self, fmt, *args):
+            print(f"{self.command} {self.path} tokens={stub.counts['token']} meta={stub.counts['meta']}", flush=True)
+
+    return Handler
+
+def main():
+    ap = argparse.ArgumentParser(description="IMDSv2 stub for local runs")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=1338)
+    ap.add_argument("--delay-ms", type=int, default=0, help="every response is delayed by this much")
+    ap.add_argument("--fail", action="store_true", help="answer every request with 500")
+    ap.add_argument("--set", action="append", default=[], metavar="PATH=VALUE",
+                    help="override a meta-data value, e.g. --set instance-id=i-abc")
+    args = ap.parse_args()
+
+    meta = dict(DEFAULT_META)
+    for item in args.set:
+        path, _, value = item.partition("=")
+        meta[path] = value
+    stub = ImdsStub(meta, args.delay_ms / 1000.0, args.fail)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(stub))
+    print(f"IMDS stub on http://{args.host}:{args.port}/latest", flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,351 @@
 import gradio as gr
 import torch
-from torchvision import models
-from torchvision.models import ResNet50_Weights
-from torchvision import transforms
-import requests
+from PIL import Image
+import os
 import json
+import time
+import queue
+import hashlib
+import tempfile
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 
-# 事前学習済みのResNet-50モデルをロード（新API） / Load the pretrained ResNet-50 model with the new API.
-model = models.resnet50(weights=ResNet50_Weights.DEFAULT)
-model.eval()
-
-# クラスラベルのロード（ImageNet） / Load class labels for ImageNet.
-LABELS_URL = "https://raw.githubusercontent.com/anishathalye/imagenet-simple-labels/master/imagenet-simple-labels.json"
-labels = json.loads(requests.get(LABELS_URL).text)
-
-# 画像の前処理 / Preprocess the image.
-def preprocess(image):
-    preprocess_transform = transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225]
-        )
-    ])
-    return preprocess_transform(image).unsqueeze(0)
+import model_artifacts
+
+# マイクロバッチの設定 / Micro-batching settings.
+# 最大 BATCH_MAX_SIZE 枚、または最初の1枚から BATCH_MAX_WAIT_MS ミリ秒まで集めてまとめて推論する
+# / Collect up to BATCH_MAX_SIZE images, or wait up to BATCH_MAX_WAIT_MS after the first one, then run a single forward pass.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# 結果キャッシュの設定 / Result cache settings.
+# RESULT_CACHE_SIZE 件までメモリに LRU で持つ（0 で無効）。RESULT_CACHE_DIR を指定するとディスクにも置き、
+# 同じディレクトリを見る他のワーカーと共有する。ディスクは RESULT_CACHE_DISK_MAX 件を超えたら更新時刻の古い順に消す
+# / Keep up to RESULT_CACHE_SIZE results in an in-memory LRU (0 disables it). With RESULT_CACHE_DIR, results also go to disk
+# and are shared with other workers using the same directory. Past RESULT_CACHE_DISK_MAX files, the oldest by mtime are removed.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MAX = int(os.getenv("RESULT_CACHE_DISK_MAX", "10000"))
+
+# ウォームアップと readiness の設定 / Warm-up and readiness settings.
+# 起動時に WARMUP_BATCH_SIZES の各バッチサイズ（未指定なら 1..BATCH_MAX_SIZE）でダミー画像を WARMUP_ROUNDS 回ずつ推論し、
+# 終わるまで /readyz は 503 を返す。推論待ちが READY_MAX_QUEUE 件以上になったら 503 に落とし、半分まで減ったら戻す
+# / At startup, run dummy images through the model WARMUP_ROUNDS times at each size in WARMUP_BATCH_SIZES (default 1..BATCH_MAX_SIZE).
+# /readyz returns 503 until that is done. It also returns 503 once READY_MAX_QUEUE requests are waiting, and recovers at half of that.
+WARMUP_BATCH_SIZES = os.getenv("WARMUP_BATCH_SIZES", "")
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", "2"))
+READY_MAX_QUEUE = int(os.getenv("READY_MAX_QUEUE", str(BATCH_MAX_SIZE * 4)))
+
+# 事前学習済みのResNet-50モデルとクラスラベル（ImageNet）をビルド時に作った artifacts から読み込む
+# / Load the pretrained ResNet-50 model and the ImageNet class labels from the artifacts built at build time.
+# 推論バックエンドは INFER_BACKEND（eager / channels_last / int8_static / torchscript / compile / onnx）、
+# スレッド数は INFER_THREADS（未指定なら CPU クォータ）で選ぶ
+# / Pick the inference backend with INFER_BACKEND and the thread count with INFER_THREADS (defaults to the CPU quota).
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts"))
+INFER_BACKEND = os.getenv("INFER_BACKEND", "eager")
+infer_threads = model_artifacts.configure_threads()
+model, labels, load_seconds = model_artifacts.load(ARTIFACTS_DIR, INFER_BACKEND)
+print(f"[app] {INFER_BACKEND} model and labels loaded from {ARTIFACTS_DIR} in {load_seconds:.2f}s "
+      f"(threads={infer_threads})", flush=True)
+
+# 画像の前処理（一度だけ作り、バッチ単位で確保済みのバッファを使い回す） / Preprocess images. Built once and reuses preallocated buffers per batch.
+preprocessor = model_artifacts.BatchPreprocessor(BATCH_MAX_SIZE)
+
+# --- 動的マイクロバッチ --- / Dynamic micro-batching.
+class MicroBatcher:
+    """
+    同時に来たリクエストの画像を1つのバッチにまとめて推論し、結果を各呼び出し元に返す
+    / Runs concurrent requests as one batched forward pass and hands each result back to its caller.
+    """
+    def __init__(self, model, preprocessor, max_size, max_wait_ms):
+        self.model = model
+        self.preprocessor = preprocessor
+        self.max_size = min(max(1, max_size), preprocessor.max_batch)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, src):
+        """PIL 画像か画像のバイト列を登録し Future を返す。デコードと縮小はすぐにスレッドプールで始まる
+        / Queue a PIL image or encoded image bytes and return a Future. Decoding and resizing start right away in the thread pool."""
+        future = Future()
+        self.requests.put((self.preprocessor.decode_async(src), future))
+        return future
+
+    def _collect(self):
+        # 1枚目は来るまで待ち、その後は締め切りか上限まで集める / Block for the first item, then gather until the deadline or the size limit.
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            arrays, futures = [], []
+            for decoded, f in self._collect():
+                # 取り消し済みの Future は除く / Drop futures that were already cancelled.
+                if not f.set_running_or_notify_cancel():
+                    continue
+                try:
+                    arrays.append(decoded.result())
+                except Exception as e:  # 読めない画像はその呼び出し元だけ失敗させる / Fail only the caller whose image could not be decoded.
+                    f.set_exception(e)
+                    continue
+                futures.append(f)
+            if not futures:
+                continue
+            try:
+                with self.preprocessor.lock, torch.no_grad():
+                    probabilities = torch.nn.functional.softmax(self.model(self.preprocessor.to_batch(arrays)), dim=1)
+                top5_prob, top5_catid = torch.topk(probabilities, 5, dim=1)
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            for row, f in enumerate(futures):
+                results = {labels[c]: float(p) for p, c in zip(top5_prob[row].tolist(), top5_catid[row].tolist())}
+                f.set_result((results, len(futures)))
+
+batcher = MicroBatcher(model, preprocessor, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+# --- ウォームアップと readiness --- / Warm-up and readiness.
+class Readiness:
+    """
+    ウォームアップが終わるまでと推論待ちが溢れている間は「準備できていない」と答える
+    / Reports not ready until the warm-up has finished and while the inference queue is saturated.
+    """
+    def __init__(self, batcher, batch_sizes, rounds, max_queue):
+        self.batcher = batcher
+        self.batch_sizes = batch_sizes
+        self.rounds = max(1, rounds)
+        self.max_queue = max(1, max_queue)
+        self.warmed = threading.Event()
+        self.warmup_seconds = None
+        self.error = None
+        self.saturated = False
+        self.lock = threading.Lock()
+
+    def warm_up(self):
+        # 最初の forward はメモリ確保や（compile なら）コンパイルで遅いので、実際に来るバッチサイズを一通り流しておく
+        # / The first forward pass is slow (allocations, and compilation for the compile backend), so run every expected batch size once up front.
+        t0 = time.perf_counter()
+        try:
+            array = model_artifacts.decode_crop(Image.new("RGB", (640, 480), (127, 127, 127)))
+            for size in self.batch_sizes:
+                for _ in range(self.rounds):
+                    with self.batcher.preprocessor.lock, torch.no_grad():
+                        logits = self.batcher.model(self.batcher.preprocessor.to_batch([array] * size))
+                        torch.topk(torch.nn.functional.softmax(logits, dim=1), 5, dim=1)
+        except Exception as e:  # 失敗したら ready にしない（ALB が切り離す） / Never become ready on failure, so the ALB takes the target out.
+            self.error = repr(e)
+            print(f"[app] warm-up failed: {self.error}", flush=True)
+            return
+        self.warmup_seconds = time.perf_counter() - t0
+        self.warmed.set()
+        print(f"[app] warm-up done in {self.warmup_seconds:.2f}s (batch sizes {self.batch_sizes}, rounds={self.rounds})", flush=True)
+
+    def start(self):
+        # /livez はウォームアップ中も答えられるよう別スレッドで回す / Run in a thread so /livez answers during the warm-up.
+        threading.Thread(target=self.warm_up, name="warm-up", daemon=True).start()
+
+    def check(self):
+        depth = self.batcher.requests.qsize()
+        with self.lock:
+            # 閾値の上下でばたつかないよう、戻すのは半分まで減ってから / Recover only at half the limit so the state does not flap around it.
+            if depth >= self.max_queue:
+                self.saturated = True
+            elif depth <= self.max_queue // 2:
+                self.saturated = False
+            saturated = self.saturated
+        if not self.warmed.is_set():
+            reason = "warm-up failed" if self.error else "warming up"
+        else:
+            reason = "queue saturated" if saturated else None
+        return reason is None, {"status": reason or "ready", "queue_depth": depth, "max_queue": self.max_queue,
+                                "warmup_seconds": self.warmup_seconds, "error": self.error}
+
+warmup_sizes = sorted({min(int(b), preprocessor.max_batch) for b in WARMUP_BATCH_SIZES.split(",") if b.strip() and int(b) > 0}) \
+    or list(range(1, batcher.max_size + 1))
+readiness = Readiness(batcher, warmup_sizes, WARMUP_ROUNDS, READY_MAX_QUEUE)
+readiness.start()
+
+# --- 結果キャッシュ --- / Result cache.
+class ResultCache:
+    """
+    画像の内容のハッシュをキーにした推論結果のキャッシュ（メモリの LRU + 任意のディスク）
+    / Inference results keyed by a hash of the image content: an in-memory LRU plus an optional disk tier.
+    """
+    def __init__(self, max_items, disk_dir, namespace, disk_max_items):
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self.disk_max_items = max(1, disk_max_items)
+        self.disk_items = None  # 最後に数えた件数＋その後の書き込み数 / Count at the last scan plus writes since.
+        self.prune_lock = threading.Lock()
+        self.namespace = namespace  # バックエンドが違えば結果も違う / Different backends give different results.
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    @property
+    def enabled(self):
+        return self.max_items > 0 or bool(self.disk_dir)
+
+    def key(self, src):
+        # バイト列はそのまま、PIL 画像はデコード済みの画素でハッシュする / Hash raw bytes as-is and PIL images by their decoded pixels.
+        h = hashlib.blake2b(self.namespace.encode(), digest_size=20)
+        if isinstance(src, (bytes, bytearray)):
+            h.update(b"bytes:" + src)
+        else:
+            h.update(f"pixels:{src.mode}:{src.size}:".encode())
+            h.update(src.tobytes())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _remember(self, key, results):
+        with self.lock:
+            self.items[key] = results
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            results = self.items.get(key)
+            if results is not None:
+                self.items.move_to_end(key)
+                self.counts["memory_hits"] += 1
+                return results
+        if self.disk_dir:
+            path = self._path(key)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    results = json.load(f)
+            except (OSError, ValueError):
+                pass
+            else:
+                try:
+                    os.utime(path)  # 読まれたものは消す順番を後ろにする / A hit moves the file to the back of the eviction order.
+                except OSError:
+                    pass
+                if self.max_items > 0:
+                    self._remember(key, results)
+                with self.lock:
+                    self.counts["disk_hits"] += 1
+                return results
+        with self.lock:
+            self.counts["misses"] += 1
+        return None
+
+    def put(self, key, results):
+        if self.max_items > 0:
+            self._remember(key, results)
+        if self.disk_dir:
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 他のワーカーが書きかけを読まないよう置き換えで書く。一時ファイル名はスレッド間でも重ならない
+                # / Replace atomically so other workers never read a partial file. The temp name is unique across threads too.
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(results, f)
+                    os.replace(tmp, path)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+            except OSError as e:
+                print(f"[cache] disk write failed: {e}", flush=True)
+            else:
+                self._count_disk_write()
+
+    def _count_disk_write(self):
+        with self.lock:
+            if self.disk_items is not None:
+                self.disk_items += 1
+            over = self.disk_items is None or self.disk_items > self.disk_max_items
+        # 1 スレッドだけが数え直して消す / One thread at a time rescans and evicts.
+        if over and self.prune_lock.acquire(blocking=False):
+            try:
+                self._prune()
+            finally:
+                self.prune_lock.release()
+
+    def _prune(self):
+        # 上限の 9 割まで古い順に消し、書き込みのたびに走査しないようにする
+        # / Evict down to 90% of the cap, oldest first, so the directory is not rescanned on every write.
+        files, stale = [], []
+        now = time.time()
+        for sub in os.scandir(self.disk_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue  # 他のワーカーが消した / Removed by another worker.
+                if entry.name.endswith(".json"):
+                    files.append((mtime, entry.path))
+                elif entry.name.endswith(".tmp") and now - mtime > 60:
+                    stale.append(entry.path)  # 落ちたワーカーの書きかけ / Left behind by a worker that died mid-write.
+        keep = len(files)
+        if keep > self.disk_max_items:
+            files.sort()
+            evict = keep - self.disk_max_items * 9 // 10
+            stale.extend(path for _, path in files[:evict])
+            keep -= evict
+        for path in stale:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self.lock:
+            self.disk_items = keep
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+            size = len(self.items)
+        lookups = sum(counts.values())
+        hits = counts["memory_hits"] + counts["disk_hits"]
+        return {**counts, "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_items": size, "memory_max_items": self.max_items, "disk_dir": self.disk_dir or None,
+                "disk_items": self.disk_items, "disk_max_items": self.disk_max_items}
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR, INFER_BACKEND, RESULT_CACHE_DISK_MAX)
+
+def submit_cached(src):
+    """キャッシュにあれば完了済みの Future（batch_size は 0）を、無ければバッチに回した Future を返す
+    / Returns a finished Future (batch_size 0) on a cache hit, otherwise the batcher's Future."""
+    if not result_cache.enabled:
+        return batcher.submit(src)
+    key = result_cache.key(src)
+    results = result_cache.get(key)
+    if results is not None:
+        future = Future()
+        future.set_result((results, 0))
+        return future
+    future = batcher.submit(src)
+    future.add_done_callback(lambda f: f.exception() is None and result_cache.put(key, f.result()[0]))
+    return future
 
 # 予測関数 / Prediction function.
 def classify_image(image):
-    input_tensor = preprocess(image)
-    with torch.no_grad():
-        outputs = model(input_tensor)
-    probabilities = torch.nn.functional.softmax(outputs[0], dim=0)
-    top5_prob, top5_catid = torch.topk(probabilities, 5)
-    results = {}
-    for i in range(top5_prob.size(0)):
-        results[labels[top5_catid[i]]] = float(top5_prob[i].item())
+    results, _batch_size = submit_cached(image).result()
     return results
 
 iface = gr.Interface(
@@ -47,18 +353,52 @@ iface = gr.Interface(
     inputs=gr.Image(type="pil"),
     outputs=gr.Label(num_top_classes=5),
     title="画像分類アプリケーション / Image Classification App",
-    description="事前学習済みのResNet-50モデルを使用して、アップロードした画像を分類します。 / Classifies uploaded images by using a pretrained ResNet-50 model."
+    description="事前学習済みのResNet-50モデルを使用して、アップロードした画像を分類します。 / Classifies uploaded images by using a pretrained ResNet-50 model.",
+    # Gradio の既定は同時実行 1 なので、バッチが埋まるだけ通す / Gradio runs one event at a time by default, so let a full batch through.
+    concurrency_limit=BATCH_MAX_SIZE,
 )
 
 # --- FastAPI 側でヘルスチェック追加 --- / Add a health check on the FastAPI side.
 app = FastAPI()
 
+# liveness: プロセスが応答できれば ok（ウォームアップ中も） / Liveness: ok whenever the process answers, including during the warm-up.
+@app.get("/livez")
+def livez():
+    return {"status": "ok"}
+
+# 以前からのパスは liveness と同じ扱いで残す / Keep the old path as an alias of liveness.
 @app.get("/healthz")
 def healthz():
-    # 依存リソースの簡易チェックを入れたければここで行う（例: モデル読み込み済みかなど） / Add simple dependency checks here if needed, such as whether the model is loaded.
-    return {"status": "ok"}
+    return livez()
+
+# readiness: ウォームアップ済みで推論待ちが溢れていなければ 200、それ以外は 503。ALB のヘルスチェックはこちらを見る
+# / Readiness: 200 once warmed up and while the inference queue is not saturated, 503 otherwise. Point the ALB health check here.
+@app.get("/readyz")
+def readyz():
+    ready, detail = readiness.check()
+    return JSONResponse(detail, status_code=200 if ready else 503)
+
+# 結果キャッシュのヒット・ミス数（プロセスごと） / Result cache hit and miss counters, per process.
+@app.get("/stats")
+def stats():
+    return {"pid": os.getpid(), "infer_backend": INFER_BACKEND, "result_cache": result_cache.stats()}
+
+# 負荷試験用の推論エンドポイント（本文に画像のバイト列をそのまま送る） / Inference endpoint for load tests. Send the raw image bytes as the request body.
+#   curl -X POST --data-binary @example_image.png http://<host>/predict
+@app.post("/predict")
+async def predict(request: Request):
+    body = await request.body()
+    try:
+        # ハッシュとディスクの読み込み、バッチの完了をイベントループを塞がずに待つ
+        # / Hash, read the disk tier and wait for the batch without blocking the event loop.
+        future = await run_in_threadpool(submit_cached, body)
+        results, batch_size = await asyncio.wrap_future(future)
+    except model_artifacts.InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"predictions": results, "batch_size": batch_size, "cached": batch_size == 0}
 
-# Gradioを "/" にマウント（UIは "/", ヘルスチェックは "/healthz"） / Mount Gradio at "/". The UI is at "/", and the health check is at "/healthz".
+# Gradioを "/" にマウント（UIは "/", ヘルスチェックは "/livez" と "/readyz", 推論 API は "/predict", キャッシュ統計は "/stats"）
+# / Mount Gradio at "/". The UI is at "/", the health checks are at "/livez" and "/readyz", the inference API is at "/predict", and cache stats are at "/stats".
 app = gr.mount_gradio_app(app, iface, path="/")
 
 if __name__ == "__main__":
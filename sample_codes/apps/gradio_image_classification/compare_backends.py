@@ -0,0 +1,114 @@
+"""
+推論バックエンドごとの精度と遅延を手元の少数の画像で比べる
+/ Compares accuracy and latency of the inference backends on a small local image set.
+
+    python compare_backends.py --images ./images --batch-sizes 1,8 --p95-target-ms 300
+    INFER_THREADS=2 python compare_backends.py --backends eager,int8_static,onnx   # 2 vCPU のインスタンス相当 / Like a 2 vCPU instance.
+
+int8_static は model_artifacts.py --backends int8_static --calib-dir で先に作っておく（無ければ skipped になる）。
+/ Prebuild int8_static with model_artifacts.py --backends int8_static --calib-dir; without it the backend is skipped.
+
+精度は eager（FP32）との top-1 一致率と top-5 の重なりで見る（正解ラベルが無くても比べられる）。
+--labels に "ファイル名,ラベル" の CSV を渡すと正解に対する top-1 正解率も出す。
+スレッド数はアプリと同じく INFER_THREADS（未指定なら CPU クォータ）。インスタンスタイプごとに流し、
+p95 が目標以内に収まる最安のものを選ぶ。
+/ Accuracy is top-1 agreement and top-5 overlap with eager FP32, so no ground truth is needed.
+Pass a "filename,label" CSV with --labels to also get top-1 accuracy against ground truth.
+Threads follow INFER_THREADS (or the CPU quota) like the app. Run it on each instance type and
+pick the cheapest one whose p95 meets the target.
+"""
+import csv
+import json
+import time
+import argparse
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+import model_artifacts
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def load_images(image_dir):
+    paths = model_artifacts.list_images(image_dir)
+    if not paths:
+        raise SystemExit("no images found (pass --images)")
+    names = [p.name for p in paths]
+    tensors = [model_artifacts.to_tensor(model_artifacts.decode_crop(Image.open(p))) for p in paths]
+    return names, tensors
+
+def top5(model, tensors):
+    with torch.no_grad():
+        logits = torch.cat([model(torch.stack(tensors[i:i + 8])) for i in range(0, len(tensors), 8)])
+    return torch.topk(logits, 5, dim=1).indices.tolist()
+
+def measure(model, tensors, batch_size, warmup, repeat):
+    """1バッチあたりの遅延（ms）のリスト / Per-batch latencies in ms."""
+    batch = torch.stack([tensors[i % len(tensors)] for i in range(batch_size)])
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            t0 = time.perf_counter()
+            model(batch)
+            if i >= warmup:
+                latencies.append((time.perf_counter() - t0) * 1000)
+    return latencies
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare accuracy and latency of the inference backends")
+    ap.add_argument("--artifacts", default=str(Path(__file__).resolve().parent / "artifacts"))
+    ap.add_argument("--backends", default=",".join(model_artifacts.BACKENDS))
+    ap.add_argument("--images", help="directory of .png/.jpg images (default: example_image.png)")
+    ap.add_argument("--labels", help='CSV of "filename,label" for top-1 accuracy against ground truth')
+    ap.add_argument("--batch-sizes", default="1,8")
+    ap.add_argument("--warmup", type=int, default=3)
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--p95-target-ms", type=float, help="mark each row as meeting this p95 or not")
+    ap.add_argument("--out", default="backends_report.json")
+    args = ap.parse_args()
+
+    threads = model_artifacts.configure_threads()
+    names, tensors = load_images(args.images)
+    truth = {}
+    if args.labels:
+        with open(args.labels, newline="") as f:
+            truth = {row[0]: row[1] for row in csv.reader(f) if len(row) >= 2}
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",") if b]
+
+    reference, rows = None, []
+    for backend in [b for b in args.backends.split(",") if b]:
+        try:
+            model, labels, load_s = model_artifacts.load(args.artifacts, backend)
+            preds = top5(model, tensors)  # torch.compile はここで最初のコンパイルが走る / torch.compile compiles here.
+        except Exception as e:
+            print(f"{backend}: skipped ({e})", flush=True)
+            continue
+        if reference is None:
+            reference = preds  # 先頭（既定では eager）を基準にする / The first backend (eager by default) is the reference.
+        accuracy = {
+            "top1_agree": round(sum(p[0] == r[0] for p, r in zip(preds, reference)) / len(preds), 4),
+            "top5_overlap": round(sum(len(set(p) & set(r)) / 5 for p, r in zip(preds, reference)) / len(preds), 4),
+        }
+        if truth:
+            scored = [(labels[p[0]], truth[n]) for n, p in zip(names, preds) if n in truth]
+            accuracy["top1_acc"] = round(sum(a == b for a, b in scored) / len(scored), 4) if scored else None
+        for bs in batch_sizes:
+            lat = measure(model, tensors, bs, args.warmup, args.repeat)
+            p95 = percentile(lat, 0.95)
+            rows.append({
+                "backend": backend, "threads": threads, "batch_size": bs, "load_s": round(load_s, 2),
+                "p50_ms": round(percentile(lat, 0.5), 1), "p95_ms": round(p95, 1), "p99_ms": round(percentile(lat, 0.99), 1),
+                "images_per_s": round(bs * 1000 / (sum(lat) / len(lat)), 1), **accuracy,
+                **({"meets_p95": p95 <= args.p95_target_ms} if args.p95_target_ms else {}),
+            })
+            print(f"{backend:<14}bs={bs:<3}p50={rows[-1]['p50_ms']:>8}ms p95={rows[-1]['p95_ms']:>8}ms "
+                  f"{rows[-1]['images_per_s']:>7} img/s top1_agree={accuracy['top1_agree']:.2%}", flush=True)
+
+    Path(args.out).write_text(json.dumps({"threads": threads, "images": len(names), "rows": rows}, indent=2))
+    print(f"report: {args.out}")
+
+if __name__ == "__main__":
+    main()
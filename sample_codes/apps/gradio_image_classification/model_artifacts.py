@@ -0,0 +1,317 @@
+"""
+ラベルと学習済みモデルを artifacts/ に書き出し、起動時にそこから読み込む
+/ Writes the labels and the pretrained model to artifacts/ and loads them from there at startup.
+
+    python model_artifacts.py --out /opt/app/artifacts
+    python model_artifacts.py --out /opt/app/artifacts --backends onnx,int8_static --calib-dir ./calib
+
+ビルド時（EC2 は cloud-init、App Runner は docker build）に一度だけ実行すれば、アプリの起動時はネットワークに出ない。
+ラベルは重みに同梱のカテゴリ名を使うので、何度ビルドしても同じ文字列になる。
+モデルは state_dict で保存し、meta デバイス上に作った ResNet-50 へ mmap で割り当てるので、
+重みの初期化とコピーが起きず数秒以内に読み込める。
+重みは MODEL_WEIGHTS（ResNet50_Weights のメンバー名、既定は DEFAULT）で選ぶ。
+/ Run once at build time (cloud-init on EC2, docker build on App Runner) and the app makes no network calls at startup.
+Labels are the category names bundled with the weights, so every build writes the same strings.
+The model is saved as a state_dict and assigned via mmap to a ResNet-50 built on the meta device,
+so no weight initialization or copy happens and loading takes seconds at most.
+Weights are chosen by MODEL_WEIGHTS (a ResNet50_Weights member name, DEFAULT by default).
+
+推論バックエンド（INFER_BACKEND） / Inference backends (INFER_BACKEND):
+    eager         FP32 の PyTorch そのまま / Plain FP32 PyTorch.
+    channels_last eager と同じ重みを NHWC で実行 / Same weights run in NHWC memory format.
+    int8_static   FX グラフモードの静的 INT8 量子化。ビルド時に --calib-dir の画像（CALIB_MIN_IMAGES 枚以上）でキャリブレーションする
+                  / FX graph mode static INT8, calibrated at build time on the --calib-dir images (at least CALIB_MIN_IMAGES).
+    torchscript   trace + freeze した TorchScript / Traced and frozen TorchScript.
+    compile       torch.compile（初回呼び出しでコンパイルする） / torch.compile; compiles on the first call.
+    onnx          ONNX Runtime（pip install onnxruntime が必要） / ONNX Runtime; needs pip install onnxruntime.
+
+動的 INT8 量子化（quantize_dynamic）は ResNet-50 では全結合層 1 つにしか効かず FP32 とほぼ同じなので、バックエンドから外した。
+/ Dynamic INT8 (quantize_dynamic) was removed as a backend: on ResNet-50 it only quantizes the single fc layer, so it is practically FP32.
+"""
+import io
+import os
+import copy
+import json
+import math
+import time
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import models
+from torchvision.models import ResNet50_Weights
+
+# App Runner は従来の pretrained=True と同じ IMAGENET1K_V1 を使う / App Runner uses IMAGENET1K_V1, the former pretrained=True weights.
+WEIGHTS = ResNet50_Weights[os.getenv("MODEL_WEIGHTS", "DEFAULT")]
+LABELS_FILE = "labels.json"
+MODEL_FILE = "resnet50.pt"
+
+# 動的 INT8 を入れていない理由は先頭の説明を参照 / See the module docstring for why dynamic INT8 is not here.
+BACKENDS = ("eager", "channels_last", "int8_static", "torchscript", "compile", "onnx")
+# ビルド時にファイルを作るバックエンド / Backends that write their own file at build time.
+BACKEND_FILES = {"int8_static": "resnet50_int8.pt", "torchscript": "resnet50_ts.pt", "onnx": "resnet50.onnx"}
+_EXAMPLE_SHAPE = (1, 3, 224, 224)
+# 活性化の範囲を推定するのに必要な枚数。運用で来る画像に近いものを用意する
+# / Images needed to estimate activation ranges. Use images close to what production traffic looks like.
+CALIB_MIN_IMAGES = 32
+
+# --- 前処理 --- / Preprocessing.
+# transforms.Compose([Resize(256), CenterCrop(224), ToTensor(), Normalize(MEAN, STD)]) と同じ処理を、
+# デコード・縮小はスレッドプールで、正規化はバッチ単位の1回の演算で行う（JPEG は縮小デコードするので画素値はわずかに違う）
+# / Same steps as transforms.Compose([Resize(256), CenterCrop(224), ToTensor(), Normalize(MEAN, STD)]),
+# with decode and resize in a thread pool and normalization as one op over the whole batch
+# (JPEG is decoded at a reduced scale, so pixel values differ slightly).
+RESIZE = 256
+CROP = 224
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+# (x / 255 - mean) / std = x * SCALE + SHIFT
+_SCALE = torch.tensor([1.0 / (255.0 * s) for s in STD]).view(1, 3, 1, 1)
+_SHIFT = torch.tensor([-m / s for m, s in zip(MEAN, STD)]).view(1, 3, 1, 1)
+
+class InvalidImage(ValueError):
+    """画像として読めない入力 / Input that cannot be decoded as an image."""
+
+def decode_crop(src):
+    """PIL 画像または画像のバイト列を、短辺 RESIZE に縮小して中央 CROP 四方を切り出した (CROP, CROP, 3) の uint8 配列にする
+    / Turns a PIL image or encoded bytes into a (CROP, CROP, 3) uint8 array: shorter side resized to RESIZE, center crop of CROP."""
+    try:
+        image = Image.open(io.BytesIO(src)) if isinstance(src, (bytes, bytearray)) else src
+        # JPEG は必要な大きさまで縮小しながらデコードする（他の形式では何もしない） / JPEG decodes at a reduced scale; a no-op for other formats.
+        image.draft("RGB", (RESIZE, RESIZE))
+        image = image.convert("RGB")
+    except Exception as e:
+        raise InvalidImage(f"invalid image: {e}") from e
+    w, h = image.size
+    short, long = (w, h) if w <= h else (h, w)
+    size = (RESIZE, int(RESIZE * long / short))
+    image = image.resize(size if w <= h else size[::-1], Image.Resampling.BILINEAR)
+    w, h = image.size
+    left, top = int(round((w - CROP) / 2.0)), int(round((h - CROP) / 2.0))
+    return np.asarray(image.crop((left, top, left + CROP, top + CROP)))
+
+def to_tensor(array):
+    """decode_crop の結果1枚を正規化した (3, CROP, CROP) のテンソルにする（新しく確保する） / Normalizes one decode_crop result into a new (3, CROP, CROP) tensor."""
+    x = torch.from_numpy(np.ascontiguousarray(array)).permute(2, 0, 1).unsqueeze(0).float()
+    return torch.addcmul(_SHIFT, x, _SCALE)[0]
+
+class BatchPreprocessor:
+    """
+    デコードと縮小をスレッドプールで並列に行い、バッチは確保済みのバッファに詰めて正規化する
+    / Decodes and resizes in a thread pool, then fills and normalizes batches in preallocated buffers.
+    """
+    def __init__(self, max_batch, workers=None):
+        self.max_batch = max(1, max_batch)
+        self.pool = ThreadPoolExecutor(max_workers=workers or cpu_quota(), thread_name_prefix="preprocess")
+        self.u8 = torch.empty((self.max_batch, CROP, CROP, 3), dtype=torch.uint8)
+        self.u8_np = self.u8.numpy()  # 同じメモリを numpy から書く / Writes into the same memory from numpy.
+        self.f32 = torch.empty((self.max_batch, 3, CROP, CROP), dtype=torch.float32)
+        # バッファは1つなので、同時に使えるバッチは1つ / There is one buffer, so one batch at a time.
+        self.lock = threading.Lock()
+
+    def decode_async(self, src):
+        """decode_crop をスレッドプールで実行する Future / A Future running decode_crop in the thread pool."""
+        return self.pool.submit(decode_crop, src)
+
+    def to_batch(self, arrays):
+        """decode_crop の結果を (N, 3, CROP, CROP) に詰めて正規化する。返すのは内部バッファのビューなので、
+        次の呼び出しまでに使い終えること（lock を持って呼ぶ）
+        / Packs decode_crop results into (N, 3, CROP, CROP) and normalizes them. Returns a view of the internal buffer,
+        so finish with it before the next call (call while holding lock)."""
+        n = len(arrays)
+        for i, a in enumerate(arrays):
+            self.u8_np[i] = a
+        out = self.f32[:n]
+        out.copy_(self.u8[:n].permute(0, 3, 1, 2))  # uint8 NHWC -> float32 NCHW
+        return torch.addcmul(_SHIFT, out, _SCALE, out=out)
+
+# --- スレッド数 --- / Thread settings.
+def cpu_quota():
+    """cgroup の CPU クォータ（コア数）。制限が無ければ使えるコア数 / The cgroup CPU quota in cores, or the usable cores without a limit."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]  # cgroup v2
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try:
+            quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())  # cgroup v1
+            period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+            if quota > 0:
+                return max(1, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    return max(1, len(os.sched_getaffinity(0)))
+
+def configure_threads():
+    """演算スレッド数を INFER_THREADS（未指定なら CPU クォータ）に合わせる。モデルを動かす前に呼ぶ
+    / Sets intra-op threads to INFER_THREADS, or the CPU quota when unset. Call before running the model."""
+    threads = int(os.getenv("INFER_THREADS", "0")) or cpu_quota()
+    torch.set_num_threads(threads)
+    try:
+        # 並列の仕事はバッチ内で十分なので op 間並列は 1 本 / Batches already give enough parallelism, so one inter-op thread.
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # 既に並列処理が走った後は変えられない / Cannot be changed after parallel work has started.
+    return threads
+
+# --- ビルド --- / Build.
+def category_labels():
+    # ネットワークに依存せず、ビルドごとに変わらない / No network involved, so every build gives the same labels.
+    names = list(WEIGHTS.meta["categories"])
+    # "crane"（134, 517）と "maillot"（638, 639）が重複するので、{label: prob} で潰れないようクラス番号を付ける
+    # / "crane" (134, 517) and "maillot" (638, 639) repeat, so add the class id to keep {label: prob} from merging them.
+    labels = [f"{name} ({i})" if names.count(name) > 1 else name for i, name in enumerate(names)]
+    assert len(set(labels)) == len(labels), "category labels must be unique"
+    return labels
+
+def _save(path, write):
+    # 途中で止まっても壊れたファイルを残さない / Write to a temp file so an interrupted build leaves no broken artifact.
+    tmp = path.with_name(path.name + ".tmp")
+    write(tmp)
+    tmp.replace(path)
+
+def list_images(image_dir):
+    """image_dir の画像（無ければ同じフォルダの example_image.png） / Images in image_dir, or example_image.png next to this file."""
+    paths = sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in (".png", ".jpg", ".jpeg")) if image_dir else []
+    if not paths:
+        paths = [p for p in [Path(__file__).resolve().parent / "example_image.png"] if p.exists()]
+    return paths
+
+def _calibration_batches(calib_dir, batch_size=8):
+    # サンプル画像 1 枚では範囲が偏るので、既定の画像には頼らない / Never fall back to the sample image; one image skews the ranges.
+    if not calib_dir:
+        raise FileNotFoundError(f"int8_static needs a calibration set: prebuild it with --calib-dir (at least {CALIB_MIN_IMAGES} images)")
+    paths = sorted(p for p in Path(calib_dir).iterdir() if p.suffix.lower() in (".png", ".jpg", ".jpeg"))
+    if len(paths) < CALIB_MIN_IMAGES:
+        raise ValueError(f"int8_static needs at least {CALIB_MIN_IMAGES} calibration images, found {len(paths)} in {calib_dir}")
+    tensors = [to_tensor(decode_crop(Image.open(p))) for p in paths]
+    return [torch.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+def _quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    return "x86" if "x86" in engines else "fbgemm"
+
+def build_backend(out_dir, backend, model, calib_dir=None):
+    """backend 用のファイルを作る（不要なバックエンドでは何もしない） / Writes the file for backend; no-op for backends without one."""
+    if backend not in BACKEND_FILES:
+        return
+    out_dir = Path(out_dir)
+    path = out_dir / BACKEND_FILES[backend]
+    example = torch.randn(_EXAMPLE_SHAPE)
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        if backend == "torchscript":
+            scripted = torch.jit.freeze(torch.jit.trace(model, example))
+            _save(path, lambda p: torch.jit.save(scripted, str(p)))
+        elif backend == "int8_static":
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            engine = _quantized_engine()
+            torch.backends.quantized.engine = engine
+            prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(example,))
+            for batch in _calibration_batches(calib_dir):
+                prepared(batch)
+            quantized = torch.jit.trace(convert_fx(prepared), example)
+            _save(path, lambda p: torch.jit.save(quantized, str(p)))
+        elif backend == "onnx":
+            _save(path, lambda p: torch.onnx.export(
+                model, example, str(p), input_names=["input"], output_names=["logits"],
+                dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}}, opset_version=17, dynamo=False,
+            ))
+
+def build(out_dir, backends=(), calib_dir=None):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    (out_dir / LABELS_FILE).write_text(json.dumps(category_labels()), encoding="utf-8")
+    model = models.resnet50(weights=WEIGHTS)
+    _save(out_dir / MODEL_FILE, lambda p: torch.save(model.state_dict(), p))
+    for backend in backends:
+        build_backend(out_dir, backend, model, calib_dir)
+
+# --- 読み込み --- / Load.
+class _ChannelsLast:
+    def __init__(self, model):
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def __call__(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+class _OnnxModel:
+    def __init__(self, path):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("INFER_BACKEND=onnx needs onnxruntime (pip install onnxruntime)") from e
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = torch.get_num_threads()
+        opts.inter_op_num_threads = 1
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(path), opts, providers=["CPUExecutionProvider"])
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {"input": x.contiguous().numpy()})[0])
+
+def _load_eager(out_dir):
+    with torch.device("meta"):
+        model = models.resnet50()
+    state = torch.load(out_dir / MODEL_FILE, mmap=True, weights_only=True)
+    model.load_state_dict(state, assign=True)
+    return model.eval()
+
+def load(out_dir, backend="eager"):
+    """(model, labels, 読み込み秒数) を返す。model は (N, 3, 224, 224) を受けてロジットを返す呼び出し可能オブジェクト。
+    artifacts が無ければその場で作る
+    / Returns (model, labels, load seconds). model is a callable taking (N, 3, 224, 224) and returning logits.
+    Builds the artifacts first if missing."""
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r} (one of {', '.join(BACKENDS)})")
+    out_dir = Path(out_dir)
+    if not (out_dir / MODEL_FILE).exists() or not (out_dir / LABELS_FILE).exists():
+        print(f"[artifacts] {out_dir} is missing; building it now (needs network)", flush=True)
+        build(out_dir)
+    if backend == "int8_static" and not (out_dir / BACKEND_FILES[backend]).exists():
+        # キャリブレーション画像が無いのでその場では作れない / Cannot be built lazily: there are no calibration images here.
+        raise RuntimeError(f"INFER_BACKEND=int8_static needs {out_dir / BACKEND_FILES[backend]}; prebuild it with "
+                           f"python model_artifacts.py --out {out_dir} --backends int8_static --calib-dir DIR")
+    if backend in BACKEND_FILES and not (out_dir / BACKEND_FILES[backend]).exists():
+        print(f"[artifacts] building {backend} artifact", flush=True)
+        build_backend(out_dir, backend, _load_eager(out_dir))
+
+    t0 = time.perf_counter()
+    labels = json.loads((out_dir / LABELS_FILE).read_text(encoding="utf-8"))
+    if len(set(labels)) != len(labels):
+        raise ValueError(f"{out_dir / LABELS_FILE} has duplicate labels; rebuild the artifacts")
+    if backend == "onnx":
+        model = _OnnxModel(out_dir / BACKEND_FILES["onnx"])
+    elif backend in ("torchscript", "int8_static"):
+        if backend == "int8_static":
+            torch.backends.quantized.engine = _quantized_engine()
+        model = torch.jit.load(str(out_dir / BACKEND_FILES[backend])).eval()
+    else:
+        model = _load_eager(out_dir)
+        if backend == "channels_last":
+            model = _ChannelsLast(model)
+        elif backend == "compile":
+            model = torch.compile(model)
+    return model, labels, time.perf_counter() - t0
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Build the labels and ResNet-50 artifacts")
+    ap.add_argument("--out", default=str(Path(__file__).resolve().parent / "artifacts"))
+    ap.add_argument("--backends", default="", help=f"comma separated extra backends to prebuild ({', '.join(BACKEND_FILES)})")
+    ap.add_argument("--calib-dir", help=f"images for int8_static calibration (required for it, at least {CALIB_MIN_IMAGES})")
+    args = ap.parse_args()
+    backends = [b for b in args.backends.split(",") if b]
+    for b in backends:
+        if b not in BACKENDS:
+            ap.error(f"unknown backend {b!r} (one of {', '.join(BACKENDS)})")
+    t0 = time.perf_counter()
+    build(args.out, backends, args.calib_dir)
+    print(f"[artifacts] built {args.out} in {time.perf_counter() - t0:.1f}s", flush=True)
+    for b in ["eager", *backends]:
+        _, labels, seconds = load(args.out, b)
+        print(f"[artifacts] load check ({b}): {len(labels)} labels, model loaded in {seconds:.2f}s", flush=True)
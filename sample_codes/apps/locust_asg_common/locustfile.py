@@ -1,12 +1,30 @@
 import os
+import re
+import csv
+import bisect
 import json
+import math
+import time
 import random
 import logging
 from pathlib import Path
-from typing import Optional, Dict, Any
-from urllib.parse import urlencode
+from typing import Optional, Dict, List, Tuple
 
-from locust import HttpUser, task, between, tag, events, LoadTestShape
+import gevent
+import urllib3
+from geventhttpclient.client import HTTPClientPool
+from locust import User, HttpUser, FastHttpUser, task, tag, events, LoadTestShape
+from locust.runners import MasterRunner, LocalRunner, WorkerRunner, CPU_MONITOR_INTERVAL
+
+try:
+    import boto3  # 任意: mix の target.source = "cloudwatch" で使う
+except ImportError:
+    boto3 = None
+
+try:
+    from hdrh.histogram import HdrHistogram  # 任意: STAGE_REPORT_DIR を使うときだけ必要（pip install hdrhistogram）
+except ImportError:
+    HdrHistogram = None
 
 # =========================================
 # Logger
@@ -38,9 +56,38 @@ MIX_SLEEPMS = int(os.getenv("MIX_SLEEPMS", "50"))
 WAIT_MIN_S  = float(os.getenv("WAIT_MIN_S", "0.05"))
 WAIT_MAX_S  = float(os.getenv("WAIT_MAX_S", "0.2"))
 
+# HTTP クライアント: requests=HttpUser（python-requests） / fast=FastHttpUser（geventhttpclient）
+HTTP_CLIENT = os.getenv("HTTP_CLIENT", "requests").lower()
+if HTTP_CLIENT not in ("requests", "fast"):
+    raise ValueError(f'HTTP_CLIENT must be "requests" or "fast", got "{HTTP_CLIENT}"')
+
 CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "3.0"))
 READ_TIMEOUT    = float(os.getenv("READ_TIMEOUT", "30.0"))
 
+# 接続ポリシー（ユーザーごとに重み付きで割り当てる。例: "keepalive:3,close:1"）
+#   keepalive: ユーザーごとの接続プールを使い回す（ブラウザ相当）
+#   close    : 1リクエストごとに接続し直す（Connection: close。短命なモバイルクライアント相当）
+#   shared   : プロセス内の全ユーザーで CONN_POOL_SIZE 本のプールを共有する（ゲートウェイ / プロキシ相当）
+#              requests は超えた分をその場限りの接続で送り、fast は空きが出るまで待つ
+# ※ gunicorn の sync ワーカーは keep-alive しないので、どのポリシーでも毎回接続になる
+CONN_POLICY    = os.getenv("CONN_POLICY", "keepalive")
+CONN_POOL_SIZE = int(os.getenv("CONN_POOL_SIZE", "10"))
+
+# 負荷生成側（Locust プロセス）の CPU 使用率がこの値以上なら、頭打ちの原因はクライアント側とみなす
+# （Locust 自身が CPU_MONITOR_INTERVAL 秒ごとに測る値で判定）
+GEN_CPU_WARN_PCT = float(os.getenv("GEN_CPU_WARN_PCT", "90"))
+
+# ステージの spawn_rate / max_users 未指定時の値
+DEFAULT_SPAWN_RATE = float(os.getenv("DEFAULT_SPAWN_RATE", "50"))
+ARRIVAL_MAX_USERS  = int(os.getenv("ARRIVAL_MAX_USERS", "1000"))
+
+# 到着率モード（stages.json で "rps" を指定したステージ）
+ARRIVAL_HEADROOM   = float(os.getenv("ARRIVAL_HEADROOM", "1.5"))   # 必要ユーザー数 = rps x p95応答時間 x この係数
+SEND_LOG_CSV       = os.getenv("SEND_LOG_CSV", "")  # 指定すると予定/実際の送信時刻を1リクエスト1行で書き出す
+
+# 指定するとステージごと・エンドポイントごとのパーセンタイルをこのディレクトリに書き出す（実行ごとに上書き）
+STAGE_REPORT_DIR   = os.getenv("STAGE_REPORT_DIR", "")
+
 # =========================================
 # CLI 引数追加（--stages-file）
 # =========================================
@@ -66,132 +113,927 @@ def _capture_cli_and_set_shape(environment, **kwargs):
     # 2) 相対なら locustfile.py の場所基準で解決
     resolved = raw_path if raw_path.is_absolute() else (_LOCUSTFILE_DIR / raw_path).resolve()
 
-    # 3) shape を明示的にインスタンス化して差し替え
-    environment.shape_class = StepLoadShape(resolved)
+    # 3) shape を明示的にインスタンス化して差し替え（形状を進めるのは master / 単一プロセスだけ）
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    try:
+        environment.shape_class = StepLoadShape(resolved)
+    except StageError as e:
+        logger.error(f"[Locust Init] invalid stages: {e}")
+        raise SystemExit(1)
+    environment.shape_class.runner = environment.runner  # runner 作成後に差し替えるので自分で紐付ける
     logger.info(f"[Locust Init] stages path resolved to: {resolved}")
 
+# =========================================================
+# 到着率モード: 送信予定時刻をプロセス内で一定間隔に払い出し、予定と実際の差を記録する
+#   応答が遅くても予定どおり送ろうとするので、遅れ（= 空きユーザー不足）がそのまま記録に残る
+# =========================================================
+class _ArrivalPacer:
+    def __init__(self):
+        self.rate = 0.0  # このプロセスの目標 rps（0 なら通常の wait_time）
+        self._next: Optional[float] = None
+        self.records: List[Tuple[str, float, float, float]] = []  # (name, 予定時刻, 実際の送信時刻, 応答 ms)
+
+    def set_rate(self, rate: float):
+        self.rate = max(0.0, float(rate))
+        if self.rate == 0:
+            self._next = None
+
+    def ticket(self) -> float:
+        """次の送信予定時刻（epoch 秒）。遅れている分は過去の時刻が返り、すぐ送ることになる"""
+        now = time.time()
+        if self._next is None:
+            self._next = now
+        t = self._next
+        self._next = t + 1.0 / self.rate
+        return t
+
+_pacer = _ArrivalPacer()
+
+@events.init.add_listener
+def _register_arrival_rate(environment, **kwargs):
+    # master の shape が決めた worker ごとの rps を受け取る
+    if isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message("arrival_rate", lambda msg, **kw: _pacer.set_rate(msg.data))
+
+@events.request.add_listener
+def _record_send_time(name, response_time, start_time=None, context=None, **kwargs):
+    intended = (context or {}).get("intended")
+    if intended is not None and start_time is not None:
+        _pacer.records.append((name, intended, start_time, response_time))
+
+def _pct(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+@events.test_stop.add_listener
+def _report_send_lag(environment, **kwargs):
+    records, _pacer.records = _pacer.records, []
+    _pacer.set_rate(0)
+    if not records:
+        return
+    by_name: Dict[str, List[Tuple[float, float]]] = {}
+    for name, intended, actual, rt in records:
+        lag_ms = max(0.0, (actual - intended) * 1000)
+        by_name.setdefault(name, []).append((lag_ms, lag_ms + rt))
+    for name, rows in sorted(by_name.items()):
+        lags, corrected = [r[0] for r in rows], [r[1] for r in rows]
+        logger.info(
+            f"[Arrival] {name}: n={len(rows)} send lag p50/p95/p99="
+            f"{_pct(lags, .5):.0f}/{_pct(lags, .95):.0f}/{_pct(lags, .99):.0f} ms, "
+            f"latency from intended send p50/p95/p99="
+            f"{_pct(corrected, .5):.0f}/{_pct(corrected, .95):.0f}/{_pct(corrected, .99):.0f} ms"
+        )
+    if SEND_LOG_CSV:
+        path = SEND_LOG_CSV
+        if isinstance(environment.runner, WorkerRunner):
+            root, ext = os.path.splitext(path)
+            path = f"{root}.{os.getpid()}{ext}"  # worker ごとに別ファイル
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["name", "intended_send", "actual_send", "send_lag_ms", "response_ms"])
+            for name, intended, actual, rt in records:
+                w.writerow([name, f"{intended:.6f}", f"{actual:.6f}", f"{max(0.0, (actual - intended) * 1000):.1f}", f"{rt:.1f}"])
+        logger.info(f"[Arrival] send log written: {path}")
+
+# =========================================================
+# ワークロード構成（mix）: エンドポイントの重みとパラメーター分布
+#   ステージの "mix" で指定する。未指定なら従来どおり（root:2, 他:1、環境変数の値 ±20%）。
+#   master / 単一プロセスが決めて、worker には "mix" メッセージで配る。
+#     "mix": {
+#       "weights": {"root": 1, "cpu": 3, "mem": 1},          # 書かなかったエンドポイントは 0
+#       "params":  {"cpu": {"iters": {"uniform": [100000, 300000]}, "rounds": 4},
+#                   "mem": {"mb": {"choice": [32, 64, 128]}, "ms": {"normal": [500, 100]}}},
+#       "target":  {"metric": "cpu", "value": 60, "source": "cloudwatch", "asg": "<ASG 名>"}
+#     }
+#   分布: 数値（固定） / uniform [min, max] / normal [mean, sd] / lognormal [median, sigma]
+#         / choice [v, ...] / jitter [base, 比率]
+#   target を付けると、その使用率（cpu: CPUUtilization / mem: CWAgent mem_used_percent の ASG 平均）が
+#   value に近づくよう cpu と mem の重みの比率を interval 秒ごとに調整する（閉ループ）。
+# =========================================================
+_ENDPOINTS = ("root", "cpu", "mem", "json", "io", "mix")
+_DEFAULT_WEIGHTS = {"root": 2, "cpu": 1, "mem": 1, "json": 1, "io": 1, "mix": 1}
+# エンドポイント -> パラメーター -> (既定の基準値, 下限)
+_PARAM_DEFAULTS = {
+    "cpu":  {"iters": (CPU_ITERS, 10000), "rounds": (CPU_ROUNDS, 1)},
+    "mem":  {"mb": (MEM_MB, 1), "ms": (MEM_MS, 1)},
+    "json": {"kb": (JSON_KB, 1)},
+    "io":   {"kb": (IO_KB, 1)},
+    "mix":  {"iters": (MIX_ITERS, 10000), "kb": (MIX_KB, 1), "sleep_ms": (MIX_SLEEPMS, 0)},
+}
+_MIX_INTERVAL_S = 60.0
+
+def _sampler(spec, where: str):
+    """分布の指定から、呼ぶたびに値を返す関数を作る"""
+    if isinstance(spec, (int, float)) and not isinstance(spec, bool):
+        return lambda: spec
+    if not (isinstance(spec, dict) and len(spec) == 1):
+        raise StageError(f"{where} must be a number or a single-key distribution object, got {spec!r}")
+    (kind, args), = spec.items()
+    if not (isinstance(args, list) and args and all(isinstance(a, (int, float)) and not isinstance(a, bool) for a in args)):
+        raise StageError(f"{where}.{kind} must be a list of numbers, got {args!r}")
+    arity = {"uniform": 2, "normal": 2, "lognormal": 2, "jitter": 2}
+    if kind in arity and len(args) != arity[kind]:
+        raise StageError(f"{where}.{kind} takes {arity[kind]} values, got {len(args)}")
+    if kind == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "normal":
+        return lambda: random.gauss(args[0], args[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(max(args[0], 1e-9)), args[1])
+    if kind == "jitter":
+        return lambda: args[0] * random.uniform(1 - args[1], 1 + args[1])
+    if kind == "choice":
+        return lambda: random.choice(args)
+    raise StageError(f"{where}: unknown distribution {kind!r} (number, uniform, normal, lognormal, choice, jitter)")
+
+def _compile_mix(mix, where: str) -> Optional[dict]:
+    """ステージの "mix" を検証する。戻り値はそのままメッセージで送れる dict"""
+    if mix is None:
+        return None
+    where = f"{where}.mix"
+    if not isinstance(mix, dict):
+        raise StageError(f"{where} must be an object")
+    unknown = set(mix) - {"weights", "params", "target"}
+    if unknown:
+        raise StageError(f"{where}: unknown keys: {sorted(unknown)}")
+    weights = mix.get("weights", _DEFAULT_WEIGHTS)
+    if not isinstance(weights, dict) or set(weights) - set(_ENDPOINTS):
+        raise StageError(f"{where}.weights must map endpoints {list(_ENDPOINTS)} to numbers, got {weights!r}")
+    for ep in weights:
+        _stage_num(weights, f"{where}.weights", ep)
+    if sum(weights.values()) <= 0:
+        raise StageError(f"{where}.weights must not all be 0")
+    params = mix.get("params", {})
+    if not isinstance(params, dict):
+        raise StageError(f"{where}.params must be an object")
+    for ep, ps in params.items():
+        if ep not in _PARAM_DEFAULTS or not isinstance(ps, dict):
+            raise StageError(f"{where}.params.{ep}: expected one of {list(_PARAM_DEFAULTS)} with an object")
+        for name, spec in ps.items():
+            if name not in _PARAM_DEFAULTS[ep]:
+                raise StageError(f"{where}.params.{ep}: unknown parameter {name!r} ({list(_PARAM_DEFAULTS[ep])})")
+            _sampler(spec, f"{where}.params.{ep}.{name}")
+    target = mix.get("target")
+    if target is not None:
+        tw = f"{where}.target"
+        if not isinstance(target, dict):
+            raise StageError(f"{tw} must be an object")
+        if target.get("metric") not in ("cpu", "mem"):
+            raise StageError(f'{tw}.metric must be "cpu" or "mem", got {target.get("metric")!r}')
+        _stage_num(target, tw, "value")
+        for k in ("gain", "interval", "min_ratio", "max_ratio"):
+            if k in target:
+                _stage_num(target, tw, k)
+        source = target.get("source", "cloudwatch")
+        if source not in ("cloudwatch", "local"):
+            raise StageError(f'{tw}.source must be "cloudwatch" or "local", got {source!r}')
+        if source == "cloudwatch":
+            if boto3 is None:
+                raise StageError(f"{tw}: source cloudwatch needs boto3 (pip install boto3)")
+            if not (target.get("asg") or os.getenv("ASG_NAME")):
+                raise StageError(f"{tw}: source cloudwatch needs asg (or ASG_NAME env)")
+        if not {"cpu", "mem"} & {ep for ep, w in weights.items() if w > 0} and "weights" in mix:
+            raise StageError(f"{tw}: weights must include cpu or mem to adjust")
+    return {"weights": dict(weights), "params": params, **({"target": target} if target else {})}
+
+class _WorkloadMix:
+    """このプロセスで使う重みとパラメーター分布"""
+    def __init__(self):
+        self.version = 0
+        self.set(None)
+
+    def set(self, mix: Optional[dict]):
+        mix = mix or {}
+        self.weights = dict(mix.get("weights", _DEFAULT_WEIGHTS))
+        params = mix.get("params", {})
+        self.samplers = {
+            ep: {name: _sampler(params.get(ep, {}).get(name, {"jitter": [base, 0.2]}), f"mix.params.{ep}.{name}")
+                 for name, (base, _lo) in ps.items()}
+            for ep, ps in _PARAM_DEFAULTS.items()
+        }
+        self.version += 1
+
+    def value(self, ep: str, name: str) -> int:
+        return max(_PARAM_DEFAULTS[ep][name][1], int(self.samplers[ep][name]()))
+
+    def weighted_tasks(self, class_tasks: list) -> list:
+        """タグ絞り込み後のタスクを現在の重みで並べ直す（random.choice で選ばれる前提で 100 枠に展開）"""
+        by_ep = {}
+        for fn in class_tasks:
+            for t in getattr(fn, "locust_tag_set", ()):
+                by_ep.setdefault(t, fn)
+        weights = {ep: w for ep, w in self.weights.items() if ep in by_ep and w > 0}
+        total = sum(weights.values())
+        if not total:
+            return list(class_tasks)  # 重みが付いたエンドポイントが --tags で全部外れたら元のまま
+        out = []
+        for ep, w in weights.items():
+            out += [by_ep[ep]] * max(1, round(100 * w / total))
+        return out
+
+_mix = _WorkloadMix()
+
+def _read_utilization(metric: str, target: dict, state: dict) -> Optional[float]:
+    """cpu / mem の使用率（%）。cloudwatch は ASG 平均の直近値、local はこのマシンの /proc"""
+    if target.get("source", "cloudwatch") == "local":
+        if metric == "mem":
+            info = {}
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    k, v = line.split(":", 1)
+                    info[k] = int(v.split()[0])
+            return 100.0 * (1 - info["MemAvailable"] / info["MemTotal"])
+        with open("/proc/stat") as f:
+            vals = [int(x) for x in f.readline().split()[1:]]
+        idle, total = vals[3] + vals[4], sum(vals)
+        prev, state["cpu"] = state.get("cpu"), (idle, total)
+        if prev is None or total == prev[1]:
+            return None
+        return 100.0 * (1 - (idle - prev[0]) / (total - prev[1]))
+    namespace, name = ("AWS/EC2", "CPUUtilization") if metric == "cpu" else ("CWAgent", "mem_used_percent")
+    client = state.setdefault("cw", boto3.client("cloudwatch"))
+    now = time.time()
+    res = client.get_metric_statistics(
+        Namespace=namespace, MetricName=name,
+        Dimensions=[{"Name": "AutoScalingGroupName", "Value": target.get("asg") or os.getenv("ASG_NAME")}],
+        StartTime=now - 600, EndTime=now, Period=60, Statistics=["Average"],
+    )
+    points = sorted(res.get("Datapoints", []), key=lambda d: d["Timestamp"])
+    return float(points[-1]["Average"]) if points else None
+
+class _MixController:
+    """target の使用率に近づくよう cpu:mem の重みの比率を動かす（比例制御）"""
+    def __init__(self, mix: dict):
+        self.mix, self.target = mix, mix["target"]
+        w = mix["weights"]
+        self.pair_total = (w.get("cpu", 0) + w.get("mem", 0)) or 2.0
+        self.ratio = w.get("cpu", 0) / self.pair_total if (w.get("cpu", 0) + w.get("mem", 0)) else 0.5
+        self.next_at = 0.0
+        self.state: dict = {}
+
+    def current(self) -> dict:
+        weights = dict(self.mix["weights"], cpu=self.pair_total * self.ratio, mem=self.pair_total * (1 - self.ratio))
+        return {**self.mix, "weights": weights}
+
+    def update(self, run_time: float) -> Optional[dict]:
+        """調整したら新しい mix を返す"""
+        if run_time < self.next_at:
+            return None
+        self.next_at = run_time + float(self.target.get("interval", _MIX_INTERVAL_S))
+        metric = self.target["metric"]
+        try:
+            used = _read_utilization(metric, self.target, self.state)
+        except Exception as e:
+            logger.warning(f"[Mix] failed to read {metric} utilization: {e}")
+            return None
+        if used is None:
+            return None
+        error = (float(self.target["value"]) - used) / 100.0
+        step = float(self.target.get("gain", 0.5)) * error * (1 if metric == "cpu" else -1)
+        lo, hi = float(self.target.get("min_ratio", 0.05)), float(self.target.get("max_ratio", 0.95))
+        self.ratio = min(hi, max(lo, self.ratio + step))
+        logger.info(f"[Mix] {metric}={used:.1f}% target={self.target['value']} -> "
+                    f"cpu:mem = {self.ratio:.2f}:{1 - self.ratio:.2f}")
+        return self.current()
+
+@events.init.add_listener
+def _register_mix(environment, **kwargs):
+    if isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message("mix", lambda msg, **kw: _mix.set(msg.data))
+
+# =========================================================
+# 接続ポリシーと接続確立時間
+#   新しい接続を張るたびに確立までの時間を記録する（http は TCP、https は TCP + TLS ハンドシェイク）。
+#   リクエストの統計（Aggregated）には混ぜず、終了時に "[Connect]" として別に集計を出す。
+#   worker の分は report_to_master で master に集める。STAGE_REPORT_DIR 指定時はステージ別レポートにも
+#   "CONNECT https" のような行で出る。
+# =========================================================
+_CONN_POLICIES = ("keepalive", "close", "shared")
+_CONNECT_PREFIX = "CONNECT "
+
+def _parse_conn_policy(spec: str) -> List[Tuple[str, float]]:
+    out = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        name, _, weight = item.partition(":")
+        if name not in _CONN_POLICIES:
+            raise ValueError(f"CONN_POLICY: unknown policy {name!r} (one of {', '.join(_CONN_POLICIES)})")
+        try:
+            w = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f"CONN_POLICY: weight of {name!r} must be a number, got {weight!r}") from None
+        if w < 0:
+            raise ValueError(f"CONN_POLICY: weight of {name!r} must be >= 0")
+        out.append((name, w))
+    if not out or sum(w for _, w in out) <= 0:
+        raise ValueError(f"CONN_POLICY must name at least one policy with a positive weight, got {spec!r}")
+    return out
+
+_conn_policies = _parse_conn_policy(CONN_POLICY)
+if CONN_POOL_SIZE < 1:
+    raise ValueError(f"CONN_POOL_SIZE must be >= 1, got {CONN_POOL_SIZE}")
+
+def _pick_conn_policy() -> str:
+    names, weights = zip(*_conn_policies)
+    return random.choices(names, weights=weights)[0]
+
+class _ConnectStats:
+    """接続確立時間（ms）をスキームごとに貯める"""
+    def __init__(self):
+        self.times: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+
+    def add(self, scheme: str, ms: float, failed: bool):
+        if failed:
+            self.failures[scheme] = self.failures.get(scheme, 0) + 1
+        else:
+            self.times.setdefault(scheme, []).append(ms)
+
+    def take(self) -> dict:
+        data, self.times, self.failures = {"times": self.times, "failures": self.failures}, {}, {}
+        return data
+
+    def merge(self, data: dict):
+        for scheme, ms in data["times"].items():
+            self.times.setdefault(scheme, []).extend(ms)
+        for scheme, n in data["failures"].items():
+            self.failures[scheme] = self.failures.get(scheme, 0) + n
+
+_connect_stats = _ConnectStats()
+
+def _fire_connect(scheme: str, t0: float, exception: Optional[BaseException]):
+    ms = (time.perf_counter() - t0) * 1000
+    _connect_stats.add(scheme, ms, exception is not None)
+    if _stage_recorder is not None:
+        _stage_recorder.record(f"{_CONNECT_PREFIX}{scheme}", ms, exception is not None)
+
+@events.report_to_master.add_listener
+def _send_connect_stats(client_id, data, **kwargs):
+    data["connect"] = _connect_stats.take()
+
+@events.worker_report.add_listener
+def _merge_connect_stats(client_id, data, **kwargs):
+    if "connect" in data:
+        _connect_stats.merge(data["connect"])
+
+@events.test_start.add_listener
+def _reset_connect_stats(environment, **kwargs):
+    _connect_stats.take()
+
+@events.quitting.add_listener
+def _report_connect_stats(environment, **kwargs):
+    # master の test_stop は worker の最後の報告より先に来ることがあるので、終了時に出す
+    if isinstance(environment.runner, WorkerRunner):
+        return  # master が集計して出す
+    requests_total = environment.stats.total.num_requests
+    data = _connect_stats.take()
+    for scheme in sorted(set(data["times"]) | set(data["failures"])):
+        ms, failed = data["times"].get(scheme, []), data["failures"].get(scheme, 0)
+        logger.info(
+            f"[Connect] {scheme}: connections={len(ms)} failed={failed} "
+            f"p50/p95/p99={_pct(ms, .5):.1f}/{_pct(ms, .95):.1f}/{_pct(ms, .99):.1f} ms, "
+            f"requests per connection={requests_total / max(1, len(ms)):.1f} (policy {CONN_POLICY})"
+        )
+
+# --- python-requests（urllib3）: 接続クラスを差し替えたプールを使う ---
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        t0 = time.perf_counter()
+        try:
+            super().connect()
+        except Exception as e:
+            _fire_connect("http", t0, e)
+            raise
+        _fire_connect("http", t0, None)
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        t0 = time.perf_counter()
+        try:
+            super().connect()
+        except Exception as e:
+            _fire_connect("https", t0, e)
+            raise
+        _fire_connect("https", t0, None)
+
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+def _timed_pool_manager() -> urllib3.PoolManager:
+    # block=True だと停止時に kill されたユーザーが接続を返さず、残りが待ち続けることがあるので使わない
+    pm = urllib3.PoolManager(maxsize=CONN_POOL_SIZE, block=False)
+    pm.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+    return pm
+
+# --- geventhttpclient: ホストごとの HTTPClient が持つ接続プールのソケット生成を計測する ---
+class _TimedHTTPClientPool(HTTPClientPool):
+    def get_client(self, url):
+        client = super().get_client(url)
+        pool = client._connection_pool
+        if not getattr(pool, "_timed", False):
+            create, scheme = pool._create_socket, "https" if client.ssl else "http"
+
+            def timed_create_socket():
+                t0 = time.perf_counter()
+                try:
+                    sock = create()
+                except Exception as e:
+                    _fire_connect(scheme, t0, e)
+                    raise
+                _fire_connect(scheme, t0, None)
+                return sock
+
+            pool._create_socket, pool._timed = timed_create_socket, True
+        return client
+
+_shared_pools: Dict[str, object] = {}  # shared ポリシー用（クライアント種別ごとに1つ）
+
 # =========================================================
 # ユーザー挙動（各エンドポイント用タスク）
 # =========================================================
-class AppUser(HttpUser):
+# kind の判定はレスポンス先頭だけを正規表現で見る（大きな本文を JSON として全部デコードしない）
+_KIND_RE = re.compile(rb'"kind"\s*:\s*"([^"]*)"')
+_KIND_SCAN_BYTES = 1024
+# サーバー側の処理時間（各エンドポイントの "seconds"）と、/ が返すインスタンス名
+_SECONDS_RE = re.compile(rb'"seconds"\s*:\s*([0-9.eE+-]+)')
+_HELLO_RE = re.compile(rb"Hello from (\S+) \(([^)]*)\)")
+
+class _ServerStats:
+    """サーバー側の処理時間と応答時間との差（ms）をエンドポイントごとに、応答したインスタンスごとの件数と一緒に貯める。
+    STAGE_REPORT_DIR が無くても常に集め、終了時に "[Server]" / "[Instances]" として出す。
+    値は約 2% 刻みの対数バケットの件数で持つので、件数が増えてもメモリは増えず、worker 分も足すだけで合算できる"""
+    _STEP = math.log(1.02)
+
+    def __init__(self):
+        self.server: Dict[str, Dict[str, int]] = {}
+        self.overhead: Dict[str, Dict[str, int]] = {}
+        self.instances: Dict[str, int] = {}
+
+    @classmethod
+    def _add(cls, hists: Dict[str, Dict[str, int]], name: str, ms: float, n: int = 1):
+        # キーは文字列にする（worker からのメッセージで送れる形） / String keys so the dict survives the worker message.
+        b = str(int(math.floor(math.log(max(ms, 0.001)) / cls._STEP)))
+        h = hists.setdefault(name, {})
+        h[b] = h.get(b, 0) + n
+
+    @classmethod
+    def pct(cls, h: Dict[str, int], q: float) -> float:
+        buckets = sorted((int(b), n) for b, n in h.items())
+        rank, seen = q * sum(n for _, n in buckets), 0
+        for b, n in buckets:
+            seen += n
+            if seen >= rank:
+                return math.exp((b + 1) * cls._STEP)
+        return 0.0
+
+    def record(self, name: str, response_time: float, server_s: Optional[float], instance: Optional[str]):
+        if server_s is not None:
+            self._add(self.server, name, server_s * 1000)
+            self._add(self.overhead, name, response_time - server_s * 1000)
+        if instance is not None:
+            self.instances[instance] = self.instances.get(instance, 0) + 1
+
+    def take(self) -> dict:
+        data = {"server": self.server, "overhead": self.overhead, "instances": self.instances}
+        self.server, self.overhead, self.instances = {}, {}, {}
+        return data
+
+    def merge(self, data: dict):
+        for key in ("server", "overhead"):
+            for name, h in data[key].items():
+                dst = getattr(self, key).setdefault(name, {})
+                for b, n in h.items():
+                    dst[b] = dst.get(b, 0) + n
+        for instance, n in data["instances"].items():
+            self.instances[instance] = self.instances.get(instance, 0) + n
+
+_server_stats = _ServerStats()
+
+@events.report_to_master.add_listener
+def _send_server_stats(client_id, data, **kwargs):
+    data["server"] = _server_stats.take()
+
+@events.worker_report.add_listener
+def _merge_server_stats(client_id, data, **kwargs):
+    if "server" in data:
+        _server_stats.merge(data["server"])
+
+@events.test_start.add_listener
+def _reset_server_stats(environment, **kwargs):
+    _server_stats.take()
+
+@events.quitting.add_listener
+def _report_server_stats(environment, **kwargs):
+    # [Connect] と同じく、worker の最後の報告を待って終了時に出す
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    data = _server_stats.take()
+    for name in sorted(data["server"]):
+        server, overhead = data["server"][name], data["overhead"][name]
+        logger.info(
+            f"[Server] {name}: n={sum(server.values())} server p50/p99="
+            f"{_ServerStats.pct(server, .5):.1f}/{_ServerStats.pct(server, .99):.1f} ms, "
+            f"overhead p50/p99={_ServerStats.pct(overhead, .5):.1f}/{_ServerStats.pct(overhead, .99):.1f} ms"
+        )
+    total = sum(data["instances"].values())
+    if total:
+        shares = ", ".join(f"{k}={n / total:.1%}" for k, n in sorted(data["instances"].items()))
+        logger.info(f"[Instances] {len(data['instances'])} instances answered GET /: {shares}")
+
+def _observe_server(r):
+    """サーバー側の処理時間と応答したインスタンスを集計に渡す（STAGE_REPORT_DIR 指定時はステージ別レポートにも）"""
+    head = (r.content or b"")[:_KIND_SCAN_BYTES]
+    server_s, instance = None, None
+    m = _SECONDS_RE.search(head)
+    raw = m.group(1) if m else r.headers.get("X-Serialize-Seconds")  # /json は本文ではなくヘッダー
+    try:
+        server_s = float(raw) if raw else None
+    except ValueError:
+        pass
+    m = _HELLO_RE.match(head)
+    if m:
+        instance = m.group(2).decode(errors="replace")
+    name, response_time = r.request_meta["name"], r.request_meta["response_time"]
+    _server_stats.record(name, response_time, server_s, instance)
+    if _stage_recorder is not None:
+        _stage_recorder.record_server(name, response_time, server_s, instance)
+
+def _check_kind(r, expected: str):
+    if r.status_code != 200:
+        r.failure(f"HTTP {r.status_code}")
+        return
+    _observe_server(r)
+    m = _KIND_RE.search((r.content or b"")[:_KIND_SCAN_BYTES])
+    if m is None:
+        r.failure("kind not found in response")
+    elif m.group(1) != expected.encode():
+        r.failure(f'kind mismatch: expected "{expected}", got "{m.group(1).decode(errors="replace")}"')
+    else:
+        r.success()
+
+def _check_ok(r):
+    if r.status_code != 200:
+        r.failure(f"HTTP {r.status_code}")
+    else:
+        _observe_server(r)
+        r.success()
+
+class _AppTasks(User):
     """
-    各エンドポイントを叩く一般ユーザー。
+    各エンドポイントを叩く一般ユーザーのタスク定義（HTTP クライアントは派生クラスで選び、_get もそこで定義する）。
     タグで特定エンドポイントのみ実行可能（例: --tags cpu）
     """
-    wait_time = between(WAIT_MIN_S, WAIT_MAX_S)
+    abstract = True
+    _intended: Optional[float] = None
+    _mix_version = 0
+    conn_policy = "keepalive"
 
-    def _get(self, path: str, name: Optional[str] = None, params: Optional[Dict[str, Any]] = None):
-        qs = f"?{urlencode(params)}" if params else ""
-        return self.client.get(
-            f"{path}{qs}",
-            name=name or path,
-            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
-            catch_response=True,  # 失敗判定を呼び出し側で行う
-        )
+    def _conn_headers(self) -> Optional[dict]:
+        return {"Connection": "close"} if self.conn_policy == "close" else None
+
+    def _sync_mix(self):
+        # mix が変わっていたら、このユーザーのタスク表を作り直す
+        if self._mix_version != _mix.version:
+            self._mix_version = _mix.version
+            self.tasks = _mix.weighted_tasks(type(self).tasks)
+
+    def wait_time(self):
+        self._sync_mix()
+        if _pacer.rate > 0:
+            # 到着率モード: 次の送信予定時刻まで待つ
+            self._intended = _pacer.ticket()
+            return max(0.0, self._intended - time.time())
+        return random.uniform(WAIT_MIN_S, WAIT_MAX_S)
+
+    def _context(self) -> dict:
+        intended, self._intended = self._intended, None
+        return {} if intended is None else {"intended": intended}
 
     def on_start(self):
+        self._sync_mix()
         # 簡易ウォームアップ
         with self._get("/", name="GET / (warmup)") as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-            else:
-                r.success()
+            _check_ok(r)
 
-    @task(2)  # ルートは軽めの多頻度
+    @task(2)  # ルートは軽めの多頻度（重みは mix で上書きできる）
     @tag("root")
     def root(self):
         with self._get("/", name="GET /") as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-            else:
-                r.success()
+            _check_ok(r)
 
     @task(1)
     @tag("cpu")
     def cpu(self):
-        iters  = max(10000, int(CPU_ITERS * random.uniform(0.8, 1.2)))
-        rounds = max(1, int(CPU_ROUNDS * random.uniform(0.8, 1.2)))
-        with self._get("/cpu", name="GET /cpu", params={"iters": iters, "rounds": rounds}) as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-                return
-            try:
-                data = r.json()
-                if data.get("kind") != "cpu":
-                    r.failure(f'kind mismatch: expected "cpu", got "{data.get("kind")}"')
-                else:
-                    r.success()
-            except Exception as e:
-                r.failure(f"JSON parse error: {e}")
+        iters  = _mix.value("cpu", "iters")
+        rounds = _mix.value("cpu", "rounds")
+        with self._get(f"/cpu?iters={iters}&rounds={rounds}", name="GET /cpu") as r:
+            _check_kind(r, "cpu")
 
     @task(1)
     @tag("mem")
     def mem(self):
-        mb = max(1, int(MEM_MB * random.uniform(0.8, 1.2)))
-        ms = max(1, int(MEM_MS * random.uniform(0.8, 1.2)))
-        with self._get("/mem", name="GET /mem", params={"mb": mb, "ms": ms}) as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-                return
-            try:
-                data = r.json()
-                if data.get("kind") != "mem":
-                    r.failure(f'kind mismatch: expected "mem", got "{data.get("kind")}"')
-                else:
-                    r.success()
-            except Exception as e:
-                r.failure(f"JSON parse error: {e}")
+        mb = _mix.value("mem", "mb")
+        ms = _mix.value("mem", "ms")
+        with self._get(f"/mem?mb={mb}&ms={ms}", name="GET /mem") as r:
+            _check_kind(r, "mem")
 
     @task(1)
     @tag("json")
     def big_json(self):
-        kb = max(1, int(JSON_KB * random.uniform(0.8, 1.2)))
-        with self._get("/json", name="GET /json", params={"kb": kb}) as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-                return
+        kb = _mix.value("json", "kb")
+        with self._get(f"/json?kb={kb}", name="GET /json") as r:
             # 形式検証が必要ならここで r.json() を見る
-            r.success()
+            _check_ok(r)
 
     @task(1)
     @tag("io")
     def io(self):
-        kb = max(1, int(IO_KB * random.uniform(0.8, 1.2)))
-        with self._get("/io", name="GET /io", params={"kb": kb}) as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-                return
-            try:
-                data = r.json()
-                if data.get("kind") != "io":
-                    r.failure(f'kind mismatch: expected "io", got "{data.get("kind")}"')
-                else:
-                    r.success()
-            except Exception as e:
-                r.failure(f"JSON parse error: {e}")
+        kb = _mix.value("io", "kb")
+        with self._get(f"/io?kb={kb}", name="GET /io") as r:
+            _check_kind(r, "io")
 
     @task(1)
     @tag("mix")
     def mix(self):
-        iters   = max(10000, int(MIX_ITERS * random.uniform(0.8, 1.2)))
-        kb      = max(1, int(MIX_KB * random.uniform(0.8, 1.2)))
-        sleepms = max(0, int(MIX_SLEEPMS * random.uniform(0.8, 1.2)))
-        with self._get("/mix", name="GET /mix",
-                       params={"iters": iters, "kb": kb, "sleep_ms": sleepms}) as r:
-            if r.status_code != 200:
-                r.failure(f"HTTP {r.status_code}")
-                return
-            try:
-                data = r.json()
-                if data.get("kind") != "mix":
-                    r.failure(f'kind mismatch: expected "mix", got "{data.get("kind")}"')
+        iters   = _mix.value("mix", "iters")
+        kb      = _mix.value("mix", "kb")
+        sleepms = _mix.value("mix", "sleep_ms")
+        with self._get(f"/mix?iters={iters}&kb={kb}&sleep_ms={sleepms}", name="GET /mix") as r:
+            _check_kind(r, "mix")
+
+class AppUser(_AppTasks, HttpUser):
+    """python-requests ベース（HTTP_CLIENT=requests、既定）"""
+    abstract = HTTP_CLIENT != "requests"
+
+    def __init__(self, environment):
+        self.conn_policy = _pick_conn_policy()
+        if self.conn_policy == "shared":
+            if "requests" not in _shared_pools:
+                _shared_pools["requests"] = _timed_pool_manager()
+            self.pool_manager = _shared_pools["requests"]
+        else:
+            self.pool_manager = _timed_pool_manager()
+        super().__init__(environment)
+
+    def _get(self, path_qs: str, name: str):
+        return self.client.get(
+            path_qs,
+            name=name,
+            headers=self._conn_headers(),
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            catch_response=True,  # 失敗判定を呼び出し側で行う
+            context=self._context(),
+        )
+
+class FastAppUser(_AppTasks, FastHttpUser):
+    """geventhttpclient ベース（HTTP_CLIENT=fast）。1コアあたりのリクエスト数を稼ぎたいとき"""
+    abstract = HTTP_CLIENT != "fast"
+    connection_timeout = CONNECT_TIMEOUT
+    network_timeout    = READ_TIMEOUT
+    concurrency        = CONN_POOL_SIZE
+
+    def __init__(self, environment):
+        self.conn_policy = _pick_conn_policy()
+        super().__init__(environment)
+        agent = self.client.client
+        # 既定のプールと同じ引数（タイムアウト、TLS 設定、concurrency）で計測付きのものに置き換える
+        pool = _TimedHTTPClientPool(**agent.clientpool.client_args)
+        if self.conn_policy == "shared":
+            pool = _shared_pools.setdefault("fast", pool)
+        agent.clientpool = pool
+
+    def _get(self, path_qs: str, name: str):
+        return self.client.get(path_qs, name=name, headers=self._conn_headers(),
+                               catch_response=True, context=self._context())
+
+# =========================================================
+# ステージ別レポート: エンドポイントごとの HDR ヒストグラム（µs）をステージの切り替わりで締める
+#   応答時間に加えて、サーバー側の処理時間（seconds）、応答時間との差（ネットワーク + ALB/キュー待ち）、
+#   応答したインスタンスごとの件数も集める。実行全体の合計は run_report.json に書く。
+#   分散実行では master がステージ終了を worker に伝え、worker は手元のヒストグラムを送り返す。
+#   master はそれを合算し、全 worker 分がそろった時点で書き出す。
+# =========================================================
+_HDR_MAX_US = 3600 * 1000 * 1000
+_PERCENTILES = (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("p99_9_ms", 99.9))
+
+class _StageRecorder:
+    def __init__(self, out_dir: Path):
+        self.out_dir = out_dir
+        self.hists: Dict[str, "HdrHistogram"] = {}
+        self.failures: Dict[str, int] = {}
+        self.server: Dict[str, "HdrHistogram"] = {}    # サーバー側の処理時間
+        self.overhead: Dict[str, "HdrHistogram"] = {}  # 応答時間 - サーバー側の処理時間
+        self.instances: Dict[str, int] = {}
+        self.run = {"hists": {}, "failures": {}, "server": {}, "overhead": {}, "instances": {}}  # 実行全体（出力側）
+        self.index: Optional[int] = None  # 計測中のステージ（master / 単一プロセス）
+        self.stage: Optional[dict] = None
+        self.start_s = 0.0
+        self.pending: Dict[int, dict] = {}  # 締めたが未出力のステージ
+
+    @staticmethod
+    def _record_ms(hists: Dict[str, "HdrHistogram"], name: str, ms: float):
+        h = hists.get(name)
+        if h is None:
+            h = hists[name] = HdrHistogram(1, _HDR_MAX_US, 3)
+        h.record_value(min(_HDR_MAX_US, max(1, int(ms * 1000))))
+
+    def record(self, name: str, response_time: float, failed: bool):
+        self._record_ms(self.hists, name, response_time)
+        if failed:
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    def record_server(self, name: str, response_time: float, server_s: Optional[float], instance: Optional[str]):
+        if server_s is not None:
+            self._record_ms(self.server, name, server_s * 1000)
+            self._record_ms(self.overhead, name, response_time - server_s * 1000)
+        if instance is not None:
+            self.instances[instance] = self.instances.get(instance, 0) + 1
+
+    def take(self) -> dict:
+        """現ステージ分を取り出して空にする（メッセージで送れる形）"""
+        data = {
+            "hists": {n: h.encode().decode() for n, h in self.hists.items()},
+            "server": {n: h.encode().decode() for n, h in self.server.items()},
+            "overhead": {n: h.encode().decode() for n, h in self.overhead.items()},
+            "failures": self.failures, "instances": self.instances,
+        }
+        self.hists, self.failures, self.server, self.overhead, self.instances = {}, {}, {}, {}, {}
+        return data
+
+    @staticmethod
+    def _merge(dst: dict, data: dict):
+        for key in ("hists", "server", "overhead"):
+            for name, h in data[key].items():
+                if isinstance(h, str):  # worker から届いたエンコード済みのもの
+                    h = HdrHistogram.decode(h)
+                if name in dst[key]:
+                    dst[key][name].add(h)
                 else:
-                    r.success()
-            except Exception as e:
-                r.failure(f"JSON parse error: {e}")
+                    dst[key][name] = h
+        for key in ("failures", "instances"):
+            for name, n in data[key].items():
+                dst[key][name] = dst[key].get(name, 0) + n
+
+    def on_tick(self, runner, index: int, stage: dict, run_time: float):
+        if index == self.index:
+            return
+        if self.index is not None:
+            self.end_stage(runner, run_time)
+        self.index, self.stage, self.start_s = index, stage, run_time
+
+    def end_stage(self, runner, run_time: float):
+        if self.index is None:
+            return
+        st, i = self.stage, self.index
+        self.index = None
+        meta = {
+            "stage": i, "type": st["type"], "kind": st["kind"],
+            "start_s": round(self.start_s, 1), "end_s": round(run_time, 1),
+            "target_start": round(st["value"](0), 2), "target_end": round(st["value"](st["duration"]), 2),
+            "users_end": runner.user_count,
+        }
+        if isinstance(runner, MasterRunner):
+            self.pending[i] = self._empty(meta, max(1, runner.worker_count))
+            runner.send_message("stage_flush", i)
+        else:
+            self.pending[i] = self._empty(meta, 1)
+            self.add(i, self.take())
+
+    @staticmethod
+    def _empty(meta: dict, expected: int) -> dict:
+        return {"meta": meta, "hists": {}, "failures": {}, "server": {}, "overhead": {}, "instances": {},
+                "reports": 0, "expected": expected}
+
+    def add(self, i: int, data: dict):
+        p = self.pending.get(i)
+        if p is None:
+            return
+        self._merge(p, data)
+        p["reports"] += 1
+        if p["reports"] >= p["expected"]:
+            self.write(i)
+
+    @staticmethod
+    def _rows(p: dict, span: float) -> List[dict]:
+        """エンドポイントごとの行（最後に Aggregated）"""
+        def with_total(src: Dict[str, "HdrHistogram"]) -> Dict[str, "HdrHistogram"]:
+            out = dict(sorted(src.items()))
+            if out:
+                total = HdrHistogram(1, _HDR_MAX_US, 3)
+                for name, h in out.items():
+                    if not name.startswith(_CONNECT_PREFIX):  # 接続確立は別行のみ（合計には入れない）
+                        total.add(h)
+                out["Aggregated"] = total
+            return out
+
+        hists, servers, overheads = with_total(p["hists"]), with_total(p["server"]), with_total(p["overhead"])
+        failures = dict(p["failures"], Aggregated=sum(n for k, n in p["failures"].items()
+                                                      if not k.startswith(_CONNECT_PREFIX)))
+        rows = []
+        for name, h in hists.items():
+            n, f = h.get_total_count(), failures.get(name, 0)
+            server, overhead = servers.get(name), overheads.get(name)
+            rows.append({
+                "endpoint": name, "requests": n, "failures": f,
+                "error_rate": round(f / n, 4) if n else 0.0, "rps": round(n / span, 2),
+                **{k: h.get_value_at_percentile(q) / 1000 for k, q in _PERCENTILES},
+                "max_ms": h.get_max_value() / 1000,
+                "server_p50_ms": server.get_value_at_percentile(50) / 1000 if server else None,
+                "server_p99_ms": server.get_value_at_percentile(99) / 1000 if server else None,
+                "overhead_p50_ms": overhead.get_value_at_percentile(50) / 1000 if overhead else None,
+                "overhead_p99_ms": overhead.get_value_at_percentile(99) / 1000 if overhead else None,
+            })
+        return rows
+
+    @staticmethod
+    def _instance_shares(instances: Dict[str, int]) -> Dict[str, dict]:
+        total = sum(instances.values())
+        return {k: {"requests": n, "share": round(n / total, 4)} for k, n in sorted(instances.items())}
+
+    def write(self, i: int):
+        p = self.pending.pop(i)
+        meta = p["meta"]
+        rows = self._rows(p, max(0.001, meta["end_s"] - meta["start_s"]))
+        report = {**meta, "partial": p["reports"] < p["expected"], "endpoints": rows,
+                  "instances": self._instance_shares(p["instances"])}
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        (self.out_dir / f"stage_{i:02d}.json").write_text(json.dumps(report, indent=2), encoding="utf-8")
+        csv_path = self.out_dir / "stage_report.csv"
+        new = not csv_path.exists()
+        with open(csv_path, "a", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=[*meta.keys(), "partial", *(rows[0].keys() if rows else ["endpoint"])])
+            if new:
+                w.writeheader()
+            for r in rows:
+                w.writerow({**meta, "partial": report["partial"], **r})
+        agg = rows[-1] if rows else {}
+        logger.info(f"[Stage Report] stage {i} ({meta['type']}/{meta['kind']} "
+                    f"{meta['target_start']}->{meta['target_end']}): n={agg.get('requests', 0)} "
+                    f"p99={agg.get('p99_ms', 0):.0f}ms err={agg.get('error_rate', 0):.2%} "
+                    f"instances={len(p['instances'])}")
+
+        # 実行全体に足し込んで run_report.json を更新
+        self.run.setdefault("start_s", meta["start_s"])
+        self.run["end_s"] = meta["end_s"]
+        self.run["stages"] = self.run.get("stages", 0) + 1
+        self._merge(self.run, p)
+        run_rows = self._rows(self.run, max(0.001, self.run["end_s"] - self.run["start_s"]))
+        run_report = {"start_s": self.run["start_s"], "end_s": self.run["end_s"], "stages": self.run["stages"],
+                      "endpoints": run_rows, "instances": self._instance_shares(self.run["instances"])}
+        (self.out_dir / "run_report.json").write_text(json.dumps(run_report, indent=2), encoding="utf-8")
+
+    def flush_pending(self):
+        for i in sorted(self.pending):
+            self.write(i)
+
+_stage_recorder = _StageRecorder(Path(STAGE_REPORT_DIR)) if STAGE_REPORT_DIR and HdrHistogram else None
+
+@events.init.add_listener
+def _init_stage_report(environment, **kwargs):
+    if not STAGE_REPORT_DIR:
+        if not isinstance(environment.runner, WorkerRunner):
+            logger.info("[Locust Init] STAGE_REPORT_DIR is not set: server time and instances are reported "
+                        "for the whole run only ([Server] / [Instances] at exit), not per stage")
+        return
+    if HdrHistogram is None:
+        logger.error("[Locust Init] STAGE_REPORT_DIR needs the hdrhistogram package (pip install hdrhistogram)")
+        raise SystemExit(1)
+    runner = environment.runner
+    if isinstance(runner, WorkerRunner):
+        runner.register_message(
+            "stage_flush", lambda msg, **kw: runner.send_message("stage_hist", {"stage": msg.data, **_stage_recorder.take()})
+        )
+    elif isinstance(runner, MasterRunner):
+        runner.register_message("stage_hist", lambda msg, **kw: _stage_recorder.add(msg.data["stage"], msg.data))
+
+@events.request.add_listener
+def _record_stage_latency(name, response_time, exception=None, **kwargs):
+    if _stage_recorder is not None:
+        _stage_recorder.record(name, response_time, exception is not None)
+
+@events.test_start.add_listener
+def _reset_stage_report(environment, **kwargs):
+    if _stage_recorder is not None and not isinstance(environment.runner, WorkerRunner):
+        (_stage_recorder.out_dir / "stage_report.csv").unlink(missing_ok=True)
+        _stage_recorder.run = {"hists": {}, "failures": {}, "server": {}, "overhead": {}, "instances": {}}
+
+@events.test_stopping.add_listener
+def _end_last_stage(environment, **kwargs):
+    if isinstance(environment.runner, WorkerRunner):
+        return  # ステージを進めているのは master
+    if _stage_recorder is not None and environment.shape_class is not None:
+        _stage_recorder.end_stage(environment.runner, environment.shape_class.get_run_time())
+
+@events.quitting.add_listener
+def _write_partial_stages(environment, **kwargs):
+    if _stage_recorder is not None:
+        _stage_recorder.flush_pending()  # worker から揃わなかったステージも partial として出す
 
 # =========================================================
-# ステップロード形状
+# ロード形状（ステージ定義）
 # =========================================================
 _DEFAULT_STAGES = [
     {"duration": 60,  "users": 100, "spawn_rate": 50},
@@ -199,58 +1041,278 @@ _DEFAULT_STAGES = [
     {"duration": 180, "users": 400, "spawn_rate": 100},
 ]
 
-def _load_stages_json(path: Path):
+_STAGE_KEYS = {
+    "step":  {"duration", "users", "rps", "spawn_rate", "max_users"},
+    "ramp":  {"duration", "users", "rps", "spawn_rate", "max_users"},
+    "spike": {"duration", "users", "rps", "spawn_rate", "max_users", "peak", "at", "length"},
+    "sine":  {"duration", "users", "rps", "spawn_rate", "max_users", "amplitude", "period", "phase"},
+    "trace": {"file", "column", "interval", "speedup", "scale", "as", "spawn_rate", "max_users"},
+}
+
+class StageError(ValueError):
+    """stages JSON の定義エラー（どのステージのどのキーかをメッセージに含める）"""
+
+def _stage_num(s: dict, where: str, key: str, default: Optional[float] = None, lo: float = 0.0) -> float:
+    v = s.get(key, default)
+    if v is None:
+        raise StageError(f"{where}: missing key: {key}")
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise StageError(f"{where}.{key} must be a number, got {v!r}")
+    if v < lo:
+        raise StageError(f"{where}.{key} must be >= {lo}, got {v}")
+    return float(v)
+
+def _load_trace(path: Path, column: str, where: str) -> List[float]:
+    if not path.exists():
+        raise StageError(f'{where}: trace file not found: "{path}"')
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        if column not in (reader.fieldnames or []):
+            raise StageError(f'{where}: column "{column}" not in {reader.fieldnames} ({path})')
+        values = []
+        for line_no, row in enumerate(reader, start=2):
+            try:
+                values.append(float(row[column]))
+            except (TypeError, ValueError):
+                raise StageError(f'{where}: {path}:{line_no}: "{row[column]}" is not a number')
+    if not values:
+        raise StageError(f'{where}: trace file has no rows: "{path}"')
+    return values
+
+def _compile_stage(i: int, s: dict, base_dir: Path) -> dict:
     """
-    path で指定された JSON を読み込む。スキーマ:
-      [{"duration": <sec>, "users": <int>, "spawn_rate": <float>}, ...]
-    戻り値: (stages or None, メッセージ)
+    1ステージを {"kind": "users"|"rps", "duration", "value": t -> 値, "spawn_rate", "max_users"} にする。
+      step  : {"duration", "users"|"rps"}                                 一定
+      ramp  : {"type": "ramp", "duration", "users"|"rps": [開始, 終了]}    線形に変化
+      spike : {"type": "spike", "duration", "users"|"rps": 基準, "peak", "at", "length"}
+      sine  : {"type": "sine", "duration", "users"|"rps": 平均, "amplitude", "period"?, "phase"?}
+      trace : {"type": "trace", "file": CSV, "column"?, "interval"?, "speedup"?, "scale"?, "as"?}
+              1行 = interval 秒分のリクエスト数。rps = 値 / interval x scale。speedup 倍速で再生する
+    spawn_rate / max_users / mix は全タイプ共通で任意。
     """
+    where = f"stage[{i}]"
+    if not isinstance(s, dict):
+        raise StageError(f"{where} must be an object")
+    typ = s.get("type", "step")
+    if typ not in _STAGE_KEYS:
+        raise StageError(f"{where}.type must be one of {sorted(_STAGE_KEYS)}, got {typ!r}")
+    where = f"{where} ({typ})"
+    unknown = set(s) - _STAGE_KEYS[typ] - {"type", "mix"}
+    if unknown:
+        raise StageError(f"{where}: unknown keys: {sorted(unknown)}")
+
+    stage = {
+        "type": typ,
+        "spawn_rate": _stage_num(s, where, "spawn_rate", DEFAULT_SPAWN_RATE, lo=0.001),
+        "max_users": int(_stage_num(s, where, "max_users", lo=1)) if "max_users" in s else None,
+        "mix": _compile_mix(s.get("mix"), where),
+    }
+
+    if typ == "trace":
+        kind = s.get("as", "rps")
+        if kind not in ("rps", "users"):
+            raise StageError(f'{where}.as must be "rps" or "users", got {kind!r}')
+        file = Path(str(s.get("file", ""))).expanduser()
+        if not s.get("file"):
+            raise StageError(f"{where}: missing key: file")
+        values = _load_trace(file if file.is_absolute() else base_dir / file, s.get("column", "requests"), where)
+        interval = _stage_num(s, where, "interval", 60, lo=0.001)
+        speedup = _stage_num(s, where, "speedup", 1, lo=0.001)
+        scale = _stage_num(s, where, "scale", 1)
+        step_s = interval / speedup
+        rates = [v / interval * scale if kind == "rps" else v * scale for v in values]
+        stage.update(kind=kind, duration=step_s * len(rates),
+                     value=lambda t: rates[min(len(rates) - 1, int(t / step_s))])
+        return stage
+
+    if ("users" in s) == ("rps" in s):
+        raise StageError(f"{where} needs exactly one of: users, rps")
+    kind = "users" if "users" in s else "rps"
+    duration = _stage_num(s, where, "duration", lo=0.001)
+    stage.update(kind=kind, duration=duration)
+
+    if typ == "ramp":
+        pair = s[kind]
+        if not (isinstance(pair, list) and len(pair) == 2):
+            raise StageError(f"{where}.{kind} must be [start, end], got {pair!r}")
+        a = _stage_num({"start": pair[0]}, f"{where}.{kind}", "start")
+        b = _stage_num({"end": pair[1]}, f"{where}.{kind}", "end")
+        stage["value"] = lambda t: a + (b - a) * min(1.0, t / duration)
+        return stage
+
+    base = _stage_num(s, where, kind)
+    if typ == "step":
+        stage["value"] = lambda t: base
+    elif typ == "spike":
+        peak = _stage_num(s, where, "peak")
+        at = _stage_num(s, where, "at", 0)
+        length = _stage_num(s, where, "length", lo=0.001)
+        if at + length > duration:
+            raise StageError(f"{where}: spike at+length ({at + length}) exceeds duration ({duration})")
+        stage["value"] = lambda t: peak if at <= t < at + length else base
+    else:  # sine
+        amplitude = _stage_num(s, where, "amplitude")
+        period = _stage_num(s, where, "period", duration, lo=0.001)
+        phase = _stage_num(s, where, "phase", 0)
+        stage["value"] = lambda t: max(0.0, base + amplitude * math.sin(2 * math.pi * (t + phase) / period))
+    return stage
+
+def compile_stages(data, base_dir: Path) -> List[dict]:
+    if not isinstance(data, list) or not data:
+        raise StageError("stages json must be a non-empty list")
+    return [_compile_stage(i, s, base_dir) for i, s in enumerate(data)]
+
+def _load_stages_json(path: Path) -> List[dict]:
+    """path の JSON を読んで compile_stages する。見つからない/不正なら StageError"""
     if not path.exists():
-        return None, f'no stages json found: "{path}"'
+        raise StageError(f'no stages json found: "{path}"')
     try:
         data = json.loads(path.read_text(encoding="utf-8"))
-        if not isinstance(data, list):
-            return None, "stages json must be a list"
-        for i, s in enumerate(data):
-            if not isinstance(s, dict):
-                return None, f"stage[{i}] must be an object"
-            for k in ("duration", "users", "spawn_rate"):
-                if k not in s:
-                    return None, f"stage[{i}] missing key: {k}"
-        return data, f'loaded "{path}"'
-    except Exception as e:
-        return None, f'failed to load "{path}": {e}'
+    except json.JSONDecodeError as e:
+        raise StageError(f'invalid JSON in "{path}": {e}')
+    return compile_stages(data, path.parent)
 
 class StepLoadShape(LoadTestShape):
     """
-    形状はコンストラクタで渡された JSON を優先。
-    見つからない/不正なら _DEFAULT_STAGES にフォールバック。
+    形状はコンストラクタで渡された JSON（_compile_stage のスキーマ）。定義エラーは StageError で止める。
     Web UI（非 headless）でも LoadTestShape が優先される。
+    rps のステージでは、ユーザー数を rps x 直近の p95 応答時間（Little の法則）から決め、
+    目標 rps を各プロセスのペーサーに配る（ユーザー数は応答が遅くなるほど増える）。
     """
     def __init__(self, stages_path: Optional[Path] = None):
         self._stages_path = stages_path
 
         if stages_path is None:
             # Locust の自動インスタンス化（引数なし）に対応：一旦デフォルト
-            self.stages = _DEFAULT_STAGES
+            self.stages = compile_stages(_DEFAULT_STAGES, _LOCUSTFILE_DIR)
             self._source = "deferred: no stages path yet -> using _DEFAULT_STAGES"
         else:
-            stages, msg = _load_stages_json(stages_path)
-            self.stages = stages if stages else _DEFAULT_STAGES
-            self._source = msg if stages is not None else f"{msg} -> fallback to _DEFAULT_STAGES"
+            self.stages = _load_stages_json(stages_path)
+            self._source = f'loaded "{stages_path}"'
+
+        # 各ステージの終了時刻（累積）。tick() はここを bisect する
+        self.cutoffs: List[float] = []
+        total = 0.0
+        for st in self.stages:
+            total += st["duration"]
+            self.cutoffs.append(total)
+        self._source += (f" ({len(self.stages)} stages: "
+                         f"{', '.join(st['type'] for st in self.stages)}; {total:.0f}s)")
+        self._sent_rate = None
+        self._mix_stage: Optional[int] = None
+        self._mix_controller: Optional[_MixController] = None
+
+    def _send_mix(self, mix: Optional[dict]):
+        if isinstance(self.runner, MasterRunner):
+            self.runner.send_message("mix", mix)
+        else:
+            _mix.set(mix)
 
-        total = 0
-        self.timeline = []
-        for s in self.stages:
-            total += int(s["duration"])
-            self.timeline.append((total, int(s["users"]), float(s["spawn_rate"])))
+    def _update_mix(self, index: int, stage: dict, run_time: float):
+        if index != self._mix_stage:
+            self._mix_stage = index
+            mix = stage["mix"]
+            self._mix_controller = _MixController(mix) if mix and "target" in mix else None
+            self._send_mix(self._mix_controller.current() if self._mix_controller else mix)
+        if self._mix_controller is not None:
+            adjusted = self._mix_controller.update(run_time)
+            if adjusted is not None:
+                self._send_mix(adjusted)
+
+    def _set_arrival_rate(self, rps: float):
+        runner = self.runner
+        if isinstance(runner, MasterRunner):
+            per_worker = rps / max(1, runner.worker_count)
+            if per_worker != self._sent_rate:
+                runner.send_message("arrival_rate", per_worker)
+                self._sent_rate = per_worker
+        else:
+            _pacer.set_rate(rps)
+
+    def _arrival_users(self, stage: dict, rps: float) -> int:
+        p95_ms = self.runner.stats.total.get_current_response_time_percentile(0.95) or 0
+        needed = math.ceil(rps * max(p95_ms / 1000.0, 0.05) * ARRIVAL_HEADROOM)
+        users = max(1, min(stage["max_users"] or ARRIVAL_MAX_USERS, needed))
+        if isinstance(self.runner, MasterRunner):
+            # rps は worker に均等に配るので、ユーザーが 0 人の worker が出ないよう worker 数以上にする
+            users = max(users, self.runner.worker_count)
+        return users
+
+    def reset_rate(self):
+        """新しいテストの開始時に呼ぶ。worker は test_stop で rps を 0 に戻しているので、次の tick で必ず送り直す"""
+        self._sent_rate = None
 
     def tick(self):
         run_time = self.get_run_time()
-        for cutoff, users, spawn in self.timeline:
-            if run_time <= cutoff:
-                return users, spawn
-        return None  # 全ステージ終了 → テスト停止
+        i = bisect.bisect_left(self.cutoffs, run_time)
+        if i >= len(self.stages):
+            return None  # 全ステージ終了 → テスト停止
+        st = self.stages[i]
+        if _stage_recorder is not None:
+            _stage_recorder.on_tick(self.runner, i, st, run_time)
+        self._update_mix(i, st, run_time)
+        v = st["value"](run_time - (self.cutoffs[i - 1] if i else 0.0))
+        if st["kind"] == "rps":
+            if v <= 0:
+                self._set_arrival_rate(0)
+                return 0, st["spawn_rate"]
+            self._set_arrival_rate(v)
+            return self._arrival_users(st, v), st["spawn_rate"]
+        self._set_arrival_rate(0)
+        users = int(round(v))
+        return (min(st["max_users"], users) if st["max_users"] else users), st["spawn_rate"]
+
+@events.test_start.add_listener
+def _reset_arrival_rate(environment, **kwargs):
+    if isinstance(environment.shape_class, StepLoadShape):
+        environment.shape_class.reset_rate()
+
+# =========================================================
+# 負荷生成側の CPU 飽和チェック（master は各 worker の報告値、単一プロセスなら自分自身を見る）
+# =========================================================
+def _generator_cpu(runner) -> Dict[str, float]:
+    if isinstance(runner, MasterRunner):
+        return {f"worker {w.id}": float(w.cpu_usage) for w in runner.clients.values()}
+    if isinstance(runner, LocalRunner):
+        return {"local": runner.current_cpu_usage}
+    return {}
+
+def _watch_generator_cpu(environment, saturated: Dict[str, float]):
+    while True:
+        gevent.sleep(CPU_MONITOR_INTERVAL)
+        for name, usage in _generator_cpu(environment.runner).items():
+            if usage < GEN_CPU_WARN_PCT:
+                continue
+            if name not in saturated:
+                logger.warning(
+                    f"[Generator CPU] {name} at {usage:.0f}% CPU: throughput is limited by the load generator, "
+                    "not the target (add workers: python run_distributed.py --workers N)"
+                )
+            saturated[name] = saturated.get(name, 0.0) + CPU_MONITOR_INTERVAL
+
+@events.test_start.add_listener
+def _start_generator_cpu_watch(environment, **kwargs):
+    if not isinstance(environment.runner, (MasterRunner, LocalRunner)):
+        return
+    environment.generator_cpu_saturated = {}
+    environment.generator_cpu_watch = gevent.spawn(
+        _watch_generator_cpu, environment, environment.generator_cpu_saturated
+    )
+
+@events.test_stop.add_listener
+def _stop_generator_cpu_watch(environment, **kwargs):
+    watch = getattr(environment, "generator_cpu_watch", None)
+    if watch is None:
+        return
+    watch.kill()
+    environment.generator_cpu_watch = None
+    saturated = environment.generator_cpu_saturated
+    if saturated:
+        detail = ", ".join(f"{name}: ~{sec:.0f}s" for name, sec in sorted(saturated.items()))
+        logger.warning(
+            f"[Generator CPU] load generator was >= {GEN_CPU_WARN_PCT:.0f}% CPU ({detail}); "
+            "results in that window measure the client, not the target"
+        )
 
 # =========================================================
 # ログ：開始時に設定を出力
@@ -264,5 +1326,6 @@ def on_test_start(environment, **kwargs):
         f"CPU_ITERS={CPU_ITERS}, CPU_ROUNDS={CPU_ROUNDS}, "
         f"MEM_MB={MEM_MB}, MEM_MS={MEM_MS}, JSON_KB={JSON_KB}, IO_KB={IO_KB}, "
         f"MIX_ITERS={MIX_ITERS}, MIX_KB={MIX_KB}, MIX_SLEEPMS={MIX_SLEEPMS}, "
-        f"WAIT=({WAIT_MIN_S},{WAIT_MAX_S}), TIMEOUT=({CONNECT_TIMEOUT},{READ_TIMEOUT})"
+        f"WAIT=({WAIT_MIN_S},{WAIT_MAX_S}), TIMEOUT=({CONNECT_TIMEOUT},{READ_TIMEOUT}), HTTP_CLIENT={HTTP_CLIENT}, "
+        f"CONN_POLICY={CONN_POLICY}, CONN_POOL_SIZE={CONN_POOL_SIZE}"
     )
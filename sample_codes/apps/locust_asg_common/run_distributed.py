@@ -0,0 +1,70 @@
+"""
+locustfile.py を master 1 + worker N（既定: 使えるコア数）でローカル起動するランチャー。
+
+  python run_distributed.py -H http://<ALB DNS> --stages-file stages.json
+  python run_distributed.py --workers 4 -H http://<ALB DNS> -- --csv out/run --tags cpu
+
+ステージ（StepLoadShape）は master だけが進め、--stages-file や --tags などのカスタム引数は
+master から各 worker に配られる。"--" 以降の引数はそのまま master に渡す。
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import subprocess
+from pathlib import Path
+from typing import List
+
+_LOCUSTFILE = Path(__file__).resolve().parent / "locustfile.py"
+
+def _default_workers() -> int:
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:  # macOS など
+        return max(1, os.cpu_count() or 1)
+
+def _locust(*args: str) -> List[str]:
+    return [sys.executable, "-m", "locust", "-f", str(_LOCUSTFILE), *args]
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Run locustfile.py as a local master + N workers")
+    ap.add_argument("--workers", type=int, default=_default_workers(),
+                    help="number of worker processes (default: usable CPU cores)")
+    ap.add_argument("-H", "--host", required=True, help="target base URL (e.g. http://<ALB DNS>)")
+    ap.add_argument("--stages-file", default="stages.json",
+                    help="stages JSON (relative path is resolved from locustfile directory)")
+    ap.add_argument("--web", action="store_true", help="start the web UI instead of --headless")
+    ap.add_argument("--master-port", type=int, default=5557)
+    ap.add_argument("master_args", nargs=argparse.REMAINDER, help="extra args after -- go to the master")
+    args = ap.parse_args()
+    extra = args.master_args[1:] if args.master_args[:1] == ["--"] else args.master_args
+
+    master_cmd = _locust(
+        "--master", "--master-bind-port", str(args.master_port),
+        "--expect-workers", str(args.workers),
+        "-H", args.host, "--stages-file", args.stages_file,
+        *([] if args.web else ["--headless"]), *extra,
+    )
+    worker_cmd = _locust("--worker", "--master-host", "127.0.0.1", "--master-port", str(args.master_port))
+
+    print(f"[run_distributed] master + {args.workers} workers -> {args.host}", flush=True)
+    master = subprocess.Popen(master_cmd)
+    workers = [subprocess.Popen(worker_cmd) for _ in range(args.workers)]
+
+    # Ctrl-C は master にだけ渡し、master が worker を止めて集計を出すのを待つ
+    signal.signal(signal.SIGINT, lambda *_: master.send_signal(signal.SIGINT))
+    try:
+        rc = master.wait()
+    finally:
+        deadline = time.monotonic() + 10
+        for w in workers:
+            try:
+                w.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                w.terminate()
+                w.wait()
+    return rc
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,18 @@ import os
 import cv2
 import numpy as np
 
+from oil_painting import downscale, oil_painting
+
+# フィルタの設定（環境変数で変更可） / Filter settings, configurable through environment variables.
+OIL_SIZE = int(os.environ.get('OIL_SIZE', '7'))
+OIL_DYN_RATIO = int(os.environ.get('OIL_DYN_RATIO', '1'))
+# タイルの一辺（0 で画像全体を一度に処理） / Tile side length. 0 filters the whole image at once.
+OIL_TILE_SIZE = int(os.environ.get('OIL_TILE_SIZE', '512'))
+# 並列数（0 ならメモリサイズに応じた vCPU 数） / Parallel workers. 0 uses the vCPUs that the memory size gives.
+OIL_WORKERS = int(os.environ.get('OIL_WORKERS', '0'))
+# 長辺をこのピクセル数まで縮小してから処理（0 で縮小しない） / Shrink the long side to this many pixels before filtering. 0 disables it.
+OIL_MAX_SIDE = int(os.environ.get('OIL_MAX_SIDE', '0'))
+
 def apply_oil_painting(image_bytes):
     """
     OpenCVを使用して画像にOil Paintingフィルタを適用します。 / Apply Oil Painting filter to an image using OpenCV.
@@ -16,11 +28,14 @@ def apply_oil_painting(image_bytes):
     if img is None:
         raise ValueError("画像のデコードに失敗しました。 / Failed to decode image.")
     
-    # Oil Paintingフィルタを適用 / Apply Oil Painting filter
-    oil_painting = cv2.xphoto.oilPainting(img, size=7, dynRatio=1)
+    # 大きすぎる画像は先に縮小 / Shrink very large images first
+    img = downscale(img, OIL_MAX_SIDE)
+    
+    # Oil Paintingフィルタをタイルに分けて並列に適用 / Apply Oil Painting filter in parallel tiles
+    painted = oil_painting(img, size=OIL_SIZE, dyn_ratio=OIL_DYN_RATIO, tile=OIL_TILE_SIZE, workers=OIL_WORKERS or None)
     
     # 処理後の画像をエンコード / Encode processed image
-    _, buffer = cv2.imencode('.jpg', oil_painting)
+    _, buffer = cv2.imencode('.jpg', painted)
     return buffer.tobytes()
 
 def lambda_handler(event, context):
@@ -0,0 +1,109 @@
+"""
+合成画像で oil_painting のタイル並列化の速さを Lambda のメモリサイズごとに比べるローカルベンチマーク
+/ Local benchmark comparing tiled, parallel oil_painting against the whole-image filter per Lambda memory size, on synthetic images.
+
+    python benchmark.py
+    python benchmark.py --sizes 2048x2048,4096x3072 --memory 1769,3538,10240 --tile 256,512
+
+Lambda の vCPU 数はメモリに比例する（1,769MB で 1 vCPU、最大 6 vCPU）。各メモリサイズの vCPU 数だけのコアに
+プロセスを固定（sched_setaffinity）して測る。1 vCPU 未満のメモリサイズは 1 コアで測り、CPU の割り当て比率で割り戻した見積もりを出す。
+手元のコア数より多い vCPU のメモリサイズは測れないので飛ばす。
+/ Lambda vCPUs scale with memory (1 vCPU at 1,769MB, up to 6 vCPUs). Each memory size runs pinned (sched_setaffinity) to as many cores
+as it would get. Sizes below 1 vCPU run on one core and report an estimate scaled by their CPU share.
+Memory sizes needing more vCPUs than this machine has are skipped.
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import subprocess
+from pathlib import Path
+
+from oil_painting import lambda_vcpus
+
+def synthetic_image(width, height, seed=0):
+    """グラデーションと図形とノイズで、写真に近いヒストグラムの画像を作る / Gradients, shapes and noise, for a photo-like histogram."""
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([x / width * 255, y / height * 255, (x + y) / (width + height) * 255], axis=-1)
+    img = img.astype(np.uint8)
+    for _ in range(max(8, width * height // 40000)):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(img, center, int(rng.integers(4, max(5, min(width, height) // 8))), color, -1)
+    noise = rng.normal(0, 12, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+def run_child(spec):
+    """固定したコアの上で1つの組み合わせを測り、JSON を1行出す / Measure one combination on pinned cores and print one JSON line."""
+    os.sched_setaffinity(0, set(spec["cores"]))
+    import numpy as np
+    from oil_painting import oil_painting
+
+    img = synthetic_image(spec["width"], spec["height"])
+    kwargs = {"size": spec["filter_size"], "dyn_ratio": spec["dyn_ratio"]}
+
+    def best_of(fn):
+        best, result = math.inf, None
+        for _ in range(spec["repeat"]):
+            t0 = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - t0)
+        return best, result
+
+    # 全体処理は OpenCV 自身のスレッドで同じコア数を使う / The whole-image run uses OpenCV's own threads on the same cores.
+    full_s, full = best_of(lambda: oil_painting(img, tile=0, workers=len(spec["cores"]), **kwargs))
+    tiled_s, tiled = best_of(lambda: oil_painting(img, tile=spec["tile"], workers=len(spec["cores"]), **kwargs))
+    print(json.dumps({"full_s": full_s, "tiled_s": tiled_s, "identical": bool(np.array_equal(full, tiled))}), flush=True)
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark tiled oil_painting per Lambda memory size")
+    ap.add_argument("--sizes", default="2048x1536,4096x3072", help="comma separated WIDTHxHEIGHT of synthetic images")
+    ap.add_argument("--memory", default="512,1769,3538,5307,7076,10240", help="comma separated Lambda memory sizes in MB")
+    ap.add_argument("--tile", default="512", help="comma separated tile sizes")
+    ap.add_argument("--filter-size", type=int, default=7)
+    ap.add_argument("--dyn-ratio", type=int, default=1)
+    ap.add_argument("--repeat", type=int, default=2, help="runs per measurement (the best one is kept)")
+    ap.add_argument("--out", default="oil_benchmark.json")
+    ap.add_argument("--_child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args._child:
+        return run_child(json.loads(args._child))
+
+    host_cores = sorted(os.sched_getaffinity(0))
+    rows = []
+    print(f"{'image':<11}{'memory':>8}{'vcpus':>7}{'tile':>6}{'full_s':>9}{'tiled_s':>9}{'speedup':>9}{'est_s':>9}  identical")
+    for size in [s for s in args.sizes.split(",") if s]:
+        width, height = (int(v) for v in size.lower().split("x"))
+        for memory in [int(m) for m in args.memory.split(",") if m]:
+            vcpus = lambda_vcpus(memory)
+            cores = max(1, math.ceil(vcpus - 1e-9))
+            if cores > len(host_cores):
+                print(f"{size:<11}{memory:>8}{vcpus:>7.2f}  skipped (needs {cores} cores, this machine has {len(host_cores)})")
+                continue
+            for tile in [int(t) for t in args.tile.split(",") if t]:
+                spec = {"width": width, "height": height, "cores": host_cores[:cores], "tile": tile,
+                        "filter_size": args.filter_size, "dyn_ratio": args.dyn_ratio, "repeat": args.repeat}
+                out = subprocess.run([sys.executable, __file__, "--_child", json.dumps(spec)], cwd=Path(__file__).resolve().parent,
+                                     capture_output=True, text=True, check=True).stdout
+                m = json.loads(out.strip().splitlines()[-1])
+                # 1 vCPU 未満は CPU の割り当て比率ぶん遅くなる / Below one vCPU, Lambda throttles to its share of a core.
+                est_s = m["tiled_s"] / min(1.0, vcpus)
+                row = {"image": size, "memory_mb": memory, "vcpus": round(vcpus, 2), "cores_used": cores, "tile": tile,
+                       "full_s": round(m["full_s"], 3), "tiled_s": round(m["tiled_s"], 3),
+                       "speedup": round(m["full_s"] / m["tiled_s"], 2), "estimated_lambda_s": round(est_s, 3),
+                       "identical": m["identical"]}
+                rows.append(row)
+                print(f"{size:<11}{memory:>8}{vcpus:>7.2f}{tile:>6}{row['full_s']:>9}{row['tiled_s']:>9}"
+                      f"{row['speedup']:>9}{row['estimated_lambda_s']:>9}  {row['identical']}", flush=True)
+
+    Path(args.out).write_text(json.dumps({"host_cores": len(host_cores), "filter_size": args.filter_size,
+                                          "dyn_ratio": args.dyn_ratio, "rows": rows}, indent=2))
+    print(f"report: {args.out}")
+
+if __name__ == "__main__":
+    main()
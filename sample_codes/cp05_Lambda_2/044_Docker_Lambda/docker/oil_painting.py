@@ -0,0 +1,89 @@
+"""
+Oil Paintingフィルタをタイルに分けて複数コアで並列に適用する / Apply the Oil Painting filter in tiles, in parallel across cores.
+
+oilPainting の出力の各画素は周囲 size 画素だけで決まるので、各タイルを size 画素（halo）ずつ広げて処理し、
+広げた分を捨てて貼り合わせれば、画像全体に一度にかけた結果とつなぎ目なく一致する。
+/ Each output pixel of oilPainting depends only on pixels within `size` of it. Processing every tile with a `size`-pixel halo
+and cropping the halo away before stitching gives the same result as filtering the whole image, with no seams.
+
+Lambda の vCPU 数はメモリサイズに比例する（1,769MB で 1 vCPU、10,240MB で 6 vCPU）。
+OpenCV の関数は実行中に GIL を手放すので、タイルはスレッドで並列に処理できる（Lambda には /dev/shm が無く multiprocessing は使いにくい）。
+oilPainting 自身も OpenCV のスレッドで並列に動くので、タイル処理中は OpenCV 側を 1 スレッドにして二重に並列化しない。
+/ Lambda vCPUs scale with the memory size (1 vCPU at 1,769MB, 6 vCPUs at 10,240MB).
+OpenCV functions release the GIL while running, so threads process tiles in parallel. Lambda has no /dev/shm, which makes multiprocessing awkward.
+oilPainting also runs in parallel on OpenCV's own threads, so OpenCV is set to one thread while tiling to avoid nesting the two.
+"""
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+_MB_PER_VCPU = 1769
+_MAX_VCPUS = 6
+
+def lambda_vcpus(memory_mb):
+    """メモリサイズに対する Lambda の vCPU 数（1 未満は小数） / Lambda vCPUs for a memory size, fractional below one."""
+    return min(_MAX_VCPUS, memory_mb / _MB_PER_VCPU)
+
+def usable_cores():
+    """
+    並列に使えるコア数。Lambda ではメモリサイズから決める（sched_getaffinity はホストのコア数を返すため）
+    / Number of cores to run on. On Lambda it follows the memory size, because sched_getaffinity reports the host's cores.
+    """
+    memory_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory_mb:
+        return max(1, math.ceil(lambda_vcpus(int(memory_mb)) - 1e-9))
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:  # macOS など / For example, macOS.
+        return max(1, os.cpu_count() or 1)
+
+def downscale(img, max_side):
+    """長辺が max_side を超えていれば縮小する（0 以下なら何もしない） / Shrink so the long side is at most max_side. 0 or less disables it."""
+    h, w = img.shape[:2]
+    if max_side <= 0 or max(h, w) <= max_side:
+        return img
+    scale = max_side / max(h, w)
+    return cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+def tile_boxes(height, width, tile):
+    """画像を tile 四方のタイルに分けた (y0, y1, x0, x1) のリスト / (y0, y1, x0, x1) of tile-by-tile tiles covering the image."""
+    return [(y, min(y + tile, height), x, min(x + tile, width))
+            for y in range(0, height, tile) for x in range(0, width, tile)]
+
+def oil_painting(img, size=7, dyn_ratio=1, tile=512, workers=None):
+    """
+    img に oilPainting をかける。tile が 0 以下か workers が 1 なら画像全体に一度にかける（OpenCV のスレッドで並列）
+    / Apply oilPainting to img. With tile of 0 or less, or a single worker, filter the whole image at once on OpenCV's threads.
+    """
+    workers = workers or usable_cores()
+    h, w = img.shape[:2]
+    prev_threads = cv2.getNumThreads()
+    if tile <= 0 or workers <= 1 or (h <= tile and w <= tile):
+        cv2.setNumThreads(workers)
+        try:
+            return cv2.xphoto.oilPainting(img, size, dyn_ratio)
+        finally:
+            cv2.setNumThreads(prev_threads)
+
+    halo = size
+    out = np.empty_like(img)
+
+    def run(box):
+        y0, y1, x0, x1 = box
+        # halo の分だけ広げて処理し、元のタイルの範囲だけを書き戻す / Filter with the halo, then write back only the tile itself.
+        ys, ye, xs, xe = max(0, y0 - halo), min(h, y1 + halo), max(0, x0 - halo), min(w, x1 + halo)
+        filtered = cv2.xphoto.oilPainting(np.ascontiguousarray(img[ys:ye, xs:xe]), size, dyn_ratio)
+        out[y0:y1, x0:x1] = filtered[y0 - ys:y1 - ys, x0 - xs:x1 - xs]
+
+    # 並列化はタイル側だけにする（OpenCV の設定はプロセス全体に効くので終わったら戻す）
+    # / Parallelize only across tiles. The OpenCV setting is process-wide, so restore it afterwards.
+    cv2.setNumThreads(1)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run, tile_boxes(h, w, tile)))  # list() で例外をここに伝える / list() re-raises any tile's exception here.
+    finally:
+        cv2.setNumThreads(prev_threads)
+    return out
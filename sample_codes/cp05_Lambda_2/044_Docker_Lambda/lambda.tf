@@ -61,13 +61,15 @@ resource "aws_lambda_function" "opencv_lambda" {
   function_name = "s3_trigger_opencv_lambda"
   role          = aws_iam_role.lambda_role.arn
   package_type  = "Image"
-  memory_size   = 512
+  memory_size   = var.lambda_memory_size
   timeout       = 60
   image_uri     = data.aws_ecr_image.lambda_image.image_uri
 
   environment {
     variables = {
       OUTPUT_BUCKET = aws_s3_bucket.output_bucket.id
+      OIL_TILE_SIZE = 512 # タイルの一辺（0 で画像全体を一度に処理） / Tile side length (0 filters the whole image at once)
+      OIL_MAX_SIDE  = var.oil_max_side
     }
   }
 }
@@ -19,6 +19,19 @@ variable "ecr_docker_image_tag" {
   default = "lambda_opencv_oilpainting"
 }
 
+# メモリを増やすと vCPU も増え、タイルの並列数が上がる（1,769MB で 1 vCPU、10,240MB で 6 vCPU。docker/benchmark.py で比較）
+# / More memory also means more vCPUs and more parallel tiles (1 vCPU at 1,769MB, 6 at 10,240MB). Compare with docker/benchmark.py.
+variable "lambda_memory_size" {
+  type    = number
+  default = 512
+}
+
+# 長辺をこのピクセル数まで縮小してから処理（0 で縮小しない） / Shrink the long side to this many pixels before filtering (0 disables it)
+variable "oil_max_side" {
+  type    = number
+  default = 0
+}
+
 provider "aws" {
   profile = var.aws_profile_name
 }
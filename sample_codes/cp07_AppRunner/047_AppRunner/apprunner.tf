@@ -120,7 +120,8 @@ resource "aws_apprunner_service" "app_service" {
       image_configuration {
         port = var.app_port
         runtime_environment_variables = {
-          USERNAME = "terraform_aws" # 環境変数の指定 / Specify environment variable
+          USERNAME      = "terraform_aws" # 環境変数の指定 / Specify environment variable
+          INFER_BACKEND = var.infer_backend
         }
         runtime_environment_secrets = {
           PASSWORD = data.aws_ssm_parameter.apprunner_password.arn # ARN指定も可能 / ARN can also be specified
@@ -2,52 +2,49 @@
 
 import gradio as gr
 import torch
-from torchvision import models, transforms
-from PIL import Image
-import requests
-import json
 import os
 
-# 事前学習済みのResNet-50モデルをロード / Load pretrained ResNet-50 model
-model = models.resnet50(pretrained=True)
-model.eval()
-
-# クラスラベルのロード（ImageNet） / Load class labels (ImageNet)
-LABELS_URL = "https://raw.githubusercontent.com/anishathalye/imagenet-simple-labels/master/imagenet-simple-labels.json"
-labels = json.loads(requests.get(LABELS_URL).text)
-
-# 画像の前処理 / Image preprocessing
-def preprocess(image):
-    preprocess_transform = transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],  # ImageNetの平均 / ImageNet mean
-            std=[0.229, 0.224, 0.225]    # ImageNetの標準偏差 / ImageNet standard deviation
-        )
-    ])
-    return preprocess_transform(image).unsqueeze(0)  # バッチ次元を追加 / Add batch dimension
-
-# 予測関数 / Prediction function
-def classify_image(image):
-    input_tensor = preprocess(image)
-    with torch.no_grad():
-        outputs = model(input_tensor)
-    probabilities = torch.nn.functional.softmax(outputs[0], dim=0)
-    top5_prob, top5_catid = torch.topk(probabilities, 5)
-    results = {}
-    for i in range(top5_prob.size(0)):
-        results[labels[top5_catid[i]]] = top5_prob[i].item()
-    return results
+import model_artifacts
+
+# Gradio がまとめて渡してくる最大枚数 / Max number of images Gradio hands over at once
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+
+# 事前学習済みのResNet-50モデルとクラスラベル（ImageNet）をイメージに焼き込んだ artifacts から読み込む
+# / Load pretrained ResNet-50 model and class labels (ImageNet) from the artifacts baked into the image
+# 推論バックエンドは INFER_BACKEND（eager / channels_last / int8_static / torchscript / compile / onnx）、
+# スレッド数は INFER_THREADS（未指定なら App Runner の vCPU 割り当て）で選ぶ
+# / Pick the inference backend with INFER_BACKEND and the thread count with INFER_THREADS (defaults to the App Runner vCPU quota)
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts"))
+INFER_BACKEND = os.getenv("INFER_BACKEND", "eager")
+infer_threads = model_artifacts.configure_threads()
+model, labels, load_seconds = model_artifacts.load(ARTIFACTS_DIR, INFER_BACKEND)
+print(f"[app] {INFER_BACKEND} model and labels loaded from {ARTIFACTS_DIR} in {load_seconds:.2f}s "
+      f"(threads={infer_threads})", flush=True)
+
+# 画像の前処理（一度だけ作り、確保済みのバッファを使い回す） / Image preprocessing (built once, reuses preallocated buffers)
+preprocessor = model_artifacts.BatchPreprocessor(BATCH_MAX_SIZE)
+
+# 予測関数（Gradio の batch=True で画像のリストを受け取る） / Prediction function (receives a list of images via Gradio batch=True)
+def classify_images(images):
+    # デコードと縮小はスレッドプールで並列に行う / Decode and resize in parallel in the thread pool
+    arrays = [f.result() for f in [preprocessor.decode_async(image) for image in images]]
+    with preprocessor.lock, torch.no_grad():
+        probabilities = torch.nn.functional.softmax(model(preprocessor.to_batch(arrays)), dim=1)
+    top5_prob, top5_catid = torch.topk(probabilities, 5, dim=1)
+    results = []
+    for row in range(len(images)):
+        results.append({labels[c]: p for p, c in zip(top5_prob[row].tolist(), top5_catid[row].tolist())})
+    return [results]  # 出力コンポーネントごとのリスト / One list per output component
 
 # Gradioインターフェースの設定 / Configure Gradio interface
 iface = gr.Interface(
-    fn=classify_image,
+    fn=classify_images,
     inputs=gr.Image(type="pil"),
     outputs=gr.Label(num_top_classes=5),
     title="画像分類アプリケーション / Image Classification Application",
-    description="事前学習済みのResNet-50モデルを使用して、アップロードした画像を分類します。 / Classify uploaded images using a pretrained ResNet-50 model."
+    description="事前学習済みのResNet-50モデルを使用して、アップロードした画像を分類します。 / Classify uploaded images using a pretrained ResNet-50 model.",
+    batch=True,
+    max_batch_size=BATCH_MAX_SIZE,
 )
 
 if __name__ == "__main__":
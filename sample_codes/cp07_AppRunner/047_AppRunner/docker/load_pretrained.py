@@ -1,4 +0,0 @@
-from torchvision import models
-
-# 事前学習済みのResNet-50モデルをロード / Load pretrained ResNet-50 model
-model = models.resnet50(pretrained=True)
\ No newline at end of file
@@ -43,6 +43,18 @@ variable "memory" {
   default = "1024" # 1 GB
 }
 
+# 推論バックエンド（apps/gradio_image_classification/model_artifacts.py を参照） / Inference backend (see apps/gradio_image_classification/model_artifacts.py)
+variable "infer_backend" {
+  description = "eager / channels_last / int8_static / torchscript / compile / onnx。int8_static はイメージのビルド時に CALIB_DIR で作っておく。動的 INT8 は ResNet-50 では全結合層にしか効かないので無い / int8_static must be prebuilt with CALIB_DIR at image build time. Dynamic INT8 is not offered: on ResNet-50 it only touches the fc layer."
+  type        = string
+  default     = "eager"
+
+  validation {
+    condition     = contains(["eager", "channels_last", "int8_static", "torchscript", "compile", "onnx"], var.infer_backend)
+    error_message = "eager / channels_last / int8_static / torchscript / compile / onnx のどれかを指定してください。 / Use one of eager, channels_last, int8_static, torchscript, compile, onnx."
+  }
+}
+
 provider "aws" {
   profile = var.aws_profile_name
 }
@@ -0,0 +1,36 @@
+# app.py は user_data（16KB 制限）に埋め込まず S3 から配る / Deliver app.py from S3 instead of embedding it in user_data, which is limited to 16 KB
+# 一意なバケット名が必要 / A unique bucket name is required
+resource "random_id" "suffix" {
+  byte_length = 4
+}
+
+locals {
+  app_bucket_name = "${var.vpc_name}-flask-app-${random_id.suffix.hex}"
+  app_prefix      = "app" # s3://bucket/app/...
+}
+
+resource "aws_s3_bucket" "app" {
+  bucket        = local.app_bucket_name
+  force_destroy = true
+  tags          = { Name = local.app_bucket_name }
+}
+
+resource "aws_s3_bucket_public_access_block" "app" {
+  bucket                  = aws_s3_bucket.app.id
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_ownership_controls" "app" {
+  bucket = aws_s3_bucket.app.id
+  rule { object_ownership = "BucketOwnerEnforced" }
+}
+
+resource "aws_s3_object" "app_py" {
+  bucket = aws_s3_bucket.app.bucket
+  key    = "${local.app_prefix}/app.py"
+  source = "${path.module}/../../apps/flask_load_test/app.py"
+  etag   = filemd5("${path.module}/../../apps/flask_load_test/app.py")
+}
@@ -19,6 +19,25 @@ resource "aws_iam_role_policy_attachment" "ssm_core" {
   policy_arn = "arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore"
 }
 
+# EC2 ロールに S3 読み取り権限を付与 / Give S3 read permissions to the EC2 role
+resource "aws_iam_policy" "s3_read_app" {
+  name        = "${var.vpc_name}-s3-read-flask-app"
+  description = "Allow GetObject for app artifacts"
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [{
+      Effect   = "Allow",
+      Action   = ["s3:GetObject"],
+      Resource = "arn:aws:s3:::${local.app_bucket_name}/${local.app_prefix}/*"
+    }]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "ec2_s3_read_app" {
+  role       = aws_iam_role.ssm_role.name
+  policy_arn = aws_iam_policy.s3_read_app.arn
+}
+
 resource "aws_iam_instance_profile" "ssm_profile" {
   name = "${var.vpc_name}-ec2-ssm-profile"
   role = aws_iam_role.ssm_role.name
@@ -68,12 +87,17 @@ data "aws_ssm_parameter" "ubuntu_2404_default_x86_64" {
   name = "/aws/service/canonical/ubuntu/server/24.04/stable/current/amd64/hvm/ebs-gp3/ami-id"
 }
 
+data "aws_region" "current" {}
+
 locals {
   user_data = templatefile(
     "${path.module}/../../apps/flask_load_test/cloudinit.yaml.tftpl",
     {
-      app_py_b64           = base64encode(file("${path.module}/../../apps/flask_load_test/app.py"))
-      gunicorn_service_b64 = base64encode(file("${path.module}/../../apps/flask_load_test/gunicorn.service"))
+      bucket           = aws_s3_bucket.app.bucket
+      app_key          = aws_s3_object.app_py.key
+      app_etag         = aws_s3_object.app_py.etag
+      region           = data.aws_region.current.region
+      gunicorn_service = file("${path.module}/../../apps/flask_load_test/gunicorn.service")
     }
   )
 }
@@ -99,8 +123,8 @@ resource "aws_launch_template" "web" {
     http_tokens = "required"
   }
 
-  # user_data は base64 エンコード文字列 / user_data is a Base64-encoded string
-  user_data = base64encode(local.user_data)
+  # user_data は base64 エンコード文字列。16KB制限に収めるため gzip 圧縮する（cloud-init が展開する） / user_data is a Base64-encoded string, gzip-compressed to stay within the 16 KB limit. cloud-init decompresses it
+  user_data = base64gzip(local.user_data)
 
   tag_specifications {
     resource_type = "instance"
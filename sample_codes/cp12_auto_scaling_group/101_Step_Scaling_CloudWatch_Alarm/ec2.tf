@@ -25,6 +25,25 @@ resource "aws_iam_role_policy_attachment" "cwagent" {
   policy_arn = "arn:aws:iam::aws:policy/CloudWatchAgentServerPolicy"
 }
 
+# EC2 ロールに S3 読み取り権限を付与 / Give S3 read permissions to the EC2 role
+resource "aws_iam_policy" "s3_read_app" {
+  name        = "${var.vpc_name}-s3-read-flask-app"
+  description = "Allow GetObject for app artifacts"
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [{
+      Effect   = "Allow",
+      Action   = ["s3:GetObject"],
+      Resource = "arn:aws:s3:::${local.app_bucket_name}/${local.app_prefix}/*"
+    }]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "ec2_s3_read_app" {
+  role       = aws_iam_role.ssm_role.name
+  policy_arn = aws_iam_policy.s3_read_app.arn
+}
+
 resource "aws_iam_instance_profile" "ssm_profile" {
   name = "${var.vpc_name}-ec2-ssm-profile"
   role = aws_iam_role.ssm_role.name
@@ -74,16 +93,19 @@ data "aws_ssm_parameter" "ubuntu_2404_default_x86_64" {
   name = "/aws/service/canonical/ubuntu/server/24.04/stable/current/amd64/hvm/ebs-gp3/ami-id"
 }
 
+data "aws_region" "current" {}
+
 # Cloudwatch Agent対応のユーザーデータに置き換え / Replace with user data that supports CloudWatch Agent
 locals {
   user_data = templatefile(
     "${path.module}/../../apps/flask_load_test/cloudinit_cwagent.yaml.tftpl",
     {
-      app_py_b64           = base64encode(file("${path.module}/../../apps/flask_load_test/app.py"))
-      gunicorn_service_b64 = base64encode(file("${path.module}/../../apps/flask_load_test/gunicorn.service"))
-      cwagent_config_b64 = base64encode(
-        templatefile("${path.module}/../../apps/flask_load_test/amazon-cloudwatch-agent.json.tftpl", {})
-      )
+      bucket           = aws_s3_bucket.app.bucket
+      app_key          = aws_s3_object.app_py.key
+      app_etag         = aws_s3_object.app_py.etag
+      region           = data.aws_region.current.region
+      gunicorn_service = file("${path.module}/../../apps/flask_load_test/gunicorn.service")
+      cwagent_config   = templatefile("${path.module}/../../apps/flask_load_test/amazon-cloudwatch-agent.json.tftpl", {})
     }
   )
 }
@@ -112,10 +134,12 @@ resource "aws_launch_template" "web" {
 
   metadata_options {
     http_tokens = "required"
+    # アプリの EMF 出力が IMDS から AutoScalingGroupName タグを読めるようにする / Let the app's EMF output read the AutoScalingGroupName tag from IMDS
+    instance_metadata_tags = "enabled"
   }
 
-  # user_data は base64 エンコード文字列 / user_data is a Base64-encoded string
-  user_data = base64encode(local.user_data)
+  # user_data は base64 エンコード文字列。16KB制限に収めるため gzip 圧縮する（cloud-init が展開する） / user_data is a Base64-encoded string, gzip-compressed to stay within the 16 KB limit. cloud-init decompresses it
+  user_data = base64gzip(local.user_data)
 
   tag_specifications {
     resource_type = "instance"
@@ -10,6 +10,11 @@ terraform {
       source  = "hashicorp/aws"
       version = ">= 6.8.0"
     }
+
+    random = {
+      source  = "hashicorp/random"
+      version = ">= 3.7.2"
+    }
   }  
 }
 
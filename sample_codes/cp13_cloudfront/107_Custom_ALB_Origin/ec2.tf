@@ -116,7 +116,11 @@ resource "aws_autoscaling_group" "web" {
   min_size                  = 2
   desired_capacity          = 2
   vpc_zone_identifier       = module.vpc.private_subnet_ids
-  health_check_type         = "ELB" # ← TG/ALBヘルスチェックを使う / Use target group and ALB health checks
+  # ALB のヘルスチェック（/readyz）は混雑中も 503 を返す。ELB にすると過負荷でインスタンスが入れ替えられて容量が減るので、
+  # ASG は EC2 のステータスだけを見て、ALB は振り分けから外すだけにする
+  # / The ALB health check (/readyz) also returns 503 while saturated. With "ELB" the ASG would replace overloaded instances
+  # / and lose capacity, so the ASG follows EC2 status checks only and the ALB just takes the target out of rotation.
+  health_check_type         = "EC2"
   health_check_grace_period = 300
 
   launch_template {
@@ -60,7 +60,7 @@ resource "aws_lb_target_group" "web" {
   }
 
   health_check {
-    path                = "/healthz"
+    path                = "/readyz" # ウォームアップ前と推論待ちが溢れている間は 503 / Returns 503 before the warm-up finishes and while the inference queue is saturated.
     protocol            = "HTTP"
     matcher             = "200-399"
     healthy_threshold   = 5
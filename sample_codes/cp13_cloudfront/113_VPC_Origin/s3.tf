@@ -32,7 +32,7 @@ resource "aws_s3_bucket_versioning" "app" {
   versioning_configuration { status = "Enabled" }
 }
 
-# 置きたい3ファイルをアップロード（ローカルの既存ファイルを利用） / Upload the three files to place, using existing local files
+# 置きたい4ファイルをアップロード（ローカルの既存ファイルを利用） / Upload the four files to place, using existing local files
 resource "aws_s3_object" "requirements" {
   bucket       = aws_s3_bucket.app.bucket
   key          = "${local.app_prefix}/requirements.txt"
@@ -48,6 +48,13 @@ resource "aws_s3_object" "app_py" {
   etag   = filemd5("${path.module}/../../apps/gradio_image_classification/app.py")
 }
 
+resource "aws_s3_object" "model_artifacts_py" {
+  bucket = aws_s3_bucket.app.bucket
+  key    = "${local.app_prefix}/model_artifacts.py"
+  source = "${path.module}/../../apps/gradio_image_classification/model_artifacts.py"
+  etag   = filemd5("${path.module}/../../apps/gradio_image_classification/model_artifacts.py")
+}
+
 resource "aws_s3_object" "service" {
   bucket       = aws_s3_bucket.app.bucket
   key          = "${local.app_prefix}/gradio.service"